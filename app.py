@@ -1,7 +1,13 @@
 # app.py
 import logging
 import os
+import time
+import settings
+from asynchttp import AsyncHttp
+from debounce import Debouncer
+from event_bus import EventBus, EventCounter, INPUT, OUTPUT, ATTACHED, DETACHED
 from ha_mqtt import HAMQTTClient
+from webhook import WebhookSink
 
 from phidget_io import PhidgetsManager
 from gpio import GpiosManager
@@ -15,25 +21,59 @@ class PhidgetApp:
         self.phidgets = None
         self.relay = None
         self.gpios = None
+        self.webhook = None
 
         # Initialize MQTT client
         self.ha_mqtt = HAMQTTClient(
             os.environ.get('MQTT_BROKER', 'BROKER_IP'),
             os.environ.get('MQTT_PORT', 1883),
             os.environ.get('MQTT_USER', 'BROKER_USERNMAE'),
-            os.environ.get('MQTT_PASSWORD', 'BROKER_PSSWORD')
+            os.environ.get('MQTT_PASSWORD', 'BROKER_PSSWORD'),
+            coalesce_window=float(os.environ.get('MQTT_COALESCE_WINDOW', 0)),
+            max_inflight=int(os.environ.get('MQTT_MAX_INFLIGHT', 20)),
+            max_queued=int(os.environ.get('MQTT_MAX_QUEUED', 1000)),
+            offline_path=os.environ.get('MQTT_OFFLINE_PATH') or None
         )
         self.ha_mqtt.output_callback = self.handle_mqtt_output_command
         if not self.ha_mqtt.connect():
             exit(1)
 
+        # Post the events to the callback urls as well, when enabled
+        if os.environ.get('WEBHOOK_ENABLED', 'false').lower() == 'true' and settings.CALLBACK_URLS:
+            self.webhook = WebhookSink(settings.CALLBACK_URLS, AsyncHttp(
+                workers=int(os.environ.get('WEBHOOK_WORKERS', 4)),
+                batch_linger=float(os.environ.get('WEBHOOK_BATCH_LINGER', 0)),
+                spool_path=os.environ.get('WEBHOOK_SPOOL_PATH') or None
+            ))
+
+        # The handlers only write the events to the bus, the sinks consume them on their own threads
+        self.bus = EventBus(
+            capacity=int(os.environ.get('EVENT_BUS_CAPACITY', 4096)),
+            overflow=os.environ.get('EVENT_BUS_OVERFLOW', 'drop_oldest')
+        )
+        self.event_counter = EventCounter()
+        self.bus.subscribe('mqtt', self.handle_mqtt_events)
+        if self.webhook:
+            self.bus.subscribe('webhook', self.handle_webhook_events)
+        self.bus.subscribe('metrics', self.event_counter)
+
+        # Input changes of the managers are debounced before reaching handle_input_change
+        self.debouncer = Debouncer(
+            self.handle_input_change,
+            stable_time=float(os.environ.get('INPUT_STABLE_TIME', 0)),
+            min_pulse=float(os.environ.get('INPUT_MIN_PULSE', 0))
+        )
+
         # Initialize managers
         try:
             self.phidgets = PhidgetsManager(
                 channel_attached_external_handler=self.handle_channel_attached,
                 channel_detached_external_handler=None, #self.handle_channel_detached,
-                input_changed_external_handler=self.handle_input_change,
-                output_changed_external_handler=self.handle_output_change
+                input_changed_external_handler=self.debouncer.input_changed,
+                output_changed_external_handler=self.handle_output_change,
+                outputs_changed_external_handler=self.handle_outputs_change,
+                states_backend=os.environ.get('PHIDGETS_STATES_BACKEND', 'shelve'),
+                async_outputs=os.environ.get('PHIDGETS_ASYNC_OUTPUTS', 'false').lower() == 'true'
             )
             # Publish device configs for each Phidget
             #for sn in self.phidgets.get_device_serials():
@@ -45,8 +85,12 @@ class PhidgetApp:
             try:
                 self.gpios = GpiosManager(
                     channel_attached_external_handler=self.handle_channel_attached,
-                    input_changed_external_handler=self.handle_input_change,
-                    output_changed_external_handler=self.handle_output_change
+                    input_changed_external_handler=self.debouncer.input_changed,
+                    output_changed_external_handler=self.handle_output_change,
+                    outputs_changed_external_handler=self.handle_outputs_change,
+                    output_pins=[int(pin) for pin in os.environ.get('GPIO_OUTPUTS', '').split(',') if pin.strip()],
+                    backend=os.environ.get('GPIO_BACKEND', 'gpiozero'),
+                    poll_interval=float(os.environ.get('GPIO_POLL_INTERVAL', 0)) or None
                 )
             except Exception as ex:
                 self.logger.exception("GPIO Failed")
@@ -54,7 +98,9 @@ class PhidgetApp:
             try:
                 self.relay = SainSmartHid(
                     channel_attached_external_handler=self.handle_channel_attached,
-                    output_changed_external_handler=self.handle_output_change
+                    output_changed_external_handler=self.handle_output_change,
+                    outputs_changed_external_handler=self.handle_outputs_change,
+                    poll_interval=float(os.environ.get('SAINSMART_POLL_INTERVAL', 0)) or None
                 )
             except NotImplementedError:
                 self.logger.warning("SainSmartHid not found")
@@ -66,39 +112,78 @@ class PhidgetApp:
 
     def handle_channel_attached(self, sn, index, channel_type):
         self.logger.debug(f"Channel attached: {sn}/{index}: {channel_type}")
-        self.ha_mqtt.publish_channel_attached(sn, index, channel_type)
+        self.bus.publish(sn, index, ATTACHED, channel_type)
 
     def handle_channel_detached(self, sn, index, channel_type):
         self.logger.debug(f"Channel attached: {sn}/{index}: {channel_type}")
-        self.ha_mqtt.publish_channel_detached(sn, index, channel_type)
+        self.bus.publish(sn, index, DETACHED, channel_type)
 
     def handle_input_change(self, sn, index, state):
         self.logger.debug(f"Input changed: {sn}/{index}: {state}")
-        self.ha_mqtt.publish_input_state(sn, index, state)
+        self.bus.publish(sn, index, INPUT, state)
 
     def handle_output_change(self, sn, index, state):
         self.logger.debug(f"Output changed {sn}/{index}: {state}")
-        self.ha_mqtt.publish_output_state(sn, index, state)
+        self.bus.publish(sn, index, OUTPUT, state)
+
+    def handle_outputs_change(self, sn, states):
+        self.logger.debug(f"Outputs changed {sn}: {states}")
+        for index, state in states.items():
+            self.bus.publish(sn, index, OUTPUT, state)
+
+    def handle_mqtt_events(self, events):
+        for sn, index, kind, state, timestamp in events:
+            if kind == INPUT:
+                self.ha_mqtt.publish_input_state(sn, index, state)
+            elif kind == OUTPUT:
+                self.ha_mqtt.publish_output_state(sn, index, state)
+            elif kind == ATTACHED:
+                self.ha_mqtt.publish_channel_attached(sn, index, state)
+            elif kind == DETACHED:
+                self.ha_mqtt.publish_channel_detached(sn, index, state)
+
+    def handle_webhook_events(self, events):
+        # The bus timestamps are monotonic: post the wall time of the events, not the time they are consumed
+        wall_offset = time.time() - time.monotonic()
+        for sn, index, kind, state, timestamp in events:
+            if kind == INPUT:
+                self.webhook.input_changed(sn, index, state, timestamp + wall_offset)
+            elif kind == OUTPUT:
+                self.webhook.output_changed(sn, index, state, timestamp + wall_offset)
+            elif kind == ATTACHED:
+                self.webhook.channel_attached(sn, index, state, timestamp + wall_offset)
 
     def handle_mqtt_output_command(self, sn, index, state):
         self.logger.debug(f"MQTT command received: for {sn}/{index}: {state}")
         # if 'sainsmart' in sn and self.relay:
         #     self.relay.set_output_state(index, state, "mqtt")
         #     #self.output_changed(sn, index, state, "mqtt")  # for now, blindly notify that output was changed
-        # elif 'gpio' in sn and self.gpios:
-        #     self.gpios.set_output_state(index, state, "mqtt")
-        #     #self.output_changed(sn, index, state, "mqtt")  # for now, blindly notify that output was changed
         # elif self.phidgets:
         if self.phidgets:
             self.phidgets.set_output_state_from_sn_index(sn, index, state)
         if self.relay:
             self.relay.set_output_state(sn, index, state)
-        #if self.gpios:
-        #    self.gpios.set_output_state(sn, index, state)
+        if self.gpios:
+            self.gpios.set_output_state(sn, index, state)
+
+    def metrics(self):
+        """Metrics of the sinks, side by side"""
+        metrics = {'mqtt': self.ha_mqtt.metrics(), 'debounce': self.debouncer.metrics(),
+                   'bus': self.bus.metrics(), 'events': self.event_counter.metrics()}
+        if self.webhook:
+            metrics['webhook'] = self.webhook.metrics()
+        return metrics
 
     def close(self):
         if self.phidgets:
             self.phidgets.close()
+        if self.relay:
+            self.relay.close()
+        if self.gpios:
+            self.gpios.close()
+        self.debouncer.close()
+        self.bus.close()
+        if self.webhook:
+            self.webhook.close()
         if hasattr(self, 'ha_mqtt'):
-            self.ha_mqtt.client.loop_stop()
-            self.ha_mqtt.client.disconnect()
+            self.ha_mqtt.close()
@@ -1,11 +1,19 @@
+import json
+import os
 import queue
+import random
+import threading
 import time
 import uuid
+from urllib.parse import quote, unquote, urlsplit
 
 import requests
-import threading
 import logging
 
+from spool import SegmentSpool
+from timers import TimerService
+from workers import KeyedWorkerPool
+
 
 class RequestDetails:
     REQUEST_ID_HEADER = 'X-Request-ID'
@@ -16,63 +24,390 @@ class RequestDetails:
         self.json = json
         self.token = token
         self.request_id = request_id
+        self.attempts = 0
 
         if not self.request_id:
             self.request_id = uuid.uuid4().hex
-        self.headers = {self.REQUEST_ID_HEADER: request_id}
+        self.headers = {self.REQUEST_ID_HEADER: self.request_id}
         if self.token:
             self.headers['Authorization'] = 'Token ' + token
 
+    @property
+    def destination(self):
+        """scheme://host[:port] of the url"""
+        parts = urlsplit(self.url)
+        return '%s://%s' % (parts.scheme, parts.netloc)
+
+    def dumps(self):
+        """:return: The request serialized, for the spool"""
+        return json.dumps([self.method, self.url, self.json, self.token, self.request_id, self.attempts]).encode()
+
+    @classmethod
+    def loads(cls, data):
+        method, url, json_data, token, request_id, attempts = json.loads(data)
+        details = cls(method, url, json_data, token, request_id)
+        details.attempts = attempts
+        return details
+
     def __str__(self):
         return '%s %s: %s [%s]' % (self.method, self.url, self.json, self.request_id)
 
 
+class CircuitBreaker:
+    """
+    Tracks the health of a destination. After `failure_threshold` consecutive failures the circuit opens, and requests
+    are shed for `reset_timeout` seconds. Then a single trial request is let through (half open): its success closes
+    the circuit, its failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0           # Consecutive failures
+        self.open_until = 0.0
+        self.opened = 0             # Number of times the circuit opened
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """:return: True if a request may be sent now"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.open_until:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def shedding(self):
+        """:return: True while the circuit is open, without taking the trial request"""
+        return self.state == self.OPEN and time.monotonic() < self.open_until
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        """:return: True if the circuit opened"""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + self.reset_timeout
+                self.opened += 1
+                return True
+            return False
+
+
 class AsyncHttp:
-    q = queue.Queue(1000)
-    logger = logging.getLogger(__name__)
+    """
+    Sends HTTP requests from a pool of worker threads.
+    Requests are routed to a worker by destination (scheme://host:port), so the requests to a destination are sent in order,
+    while different destinations are served concurrently. Each destination has its own requests.Session, used only by its
+    worker, which keeps the connection alive between requests instead of doing a TCP (and TLS) handshake for each one.
+    Failed requests are not retried by the worker: they are re-queued from a TimerService after an exponential backoff
+    with jitter, so the other requests keep flowing (a retried request may then be sent after later ones).
+    A CircuitBreaker per destination sheds the requests to a destination that keeps failing.
+    With batch_linger, the POSTs to the same url and token are collected for batch_linger seconds (or up to batch_size)
+    and sent as one POST of a JSON array: [{"request_id": event request id, "data": event json}, ...],
+    with its own X-Request-ID.
+    With spool_path, the requests that don't fit in the queues, or whose destination's circuit is open, are written to
+    a SegmentSpool of their destination (<spool_path>/<quoted destination>) instead of being dropped, and moved back to
+    the queues in order as they drain. The destinations are spooled and drained independently, so a destination that
+    is down only holds back its own requests.
+    """
 
-    def __init__(self):
-        worker = threading.Thread(target=self.process_request)
-        worker.setDaemon(True)
-        worker.start()
+    def __init__(self, workers=4, max_queued=1000, timeout=10, max_retries=5, backoff=1.0, max_backoff=60.0,
+                 failure_threshold=5, reset_timeout=30.0, batch_linger=0, batch_size=100,
+                 spool_path=None, spool_segment_size=1 << 20, spool_max_bytes=64 << 20, spool_interval=0.1):
+        """
+        :param workers: Number of worker threads
+        :param max_queued: Max requests waiting per worker
+        :param timeout: Seconds to wait for a destination to connect / answer
+        :param max_retries: Max retries of a failed request
+        :param backoff: Seconds before the first retry, doubled for every following one
+        :param max_backoff: Max seconds between retries
+        :param failure_threshold: Consecutive failures of a destination that open its circuit
+        :param reset_timeout: Seconds a destination's requests are shed before a trial request
+        :param batch_linger: Seconds to collect POSTs into a batch (0: no batching)
+        :param batch_size: Max events per batch, a full batch is sent without waiting for the linger time
+        :param spool_path: Directory of the overflow spools (None: requests that don't fit are dropped)
+        :param spool_segment_size: Bytes per spool segment file
+        :param spool_max_bytes: Max bytes of the spool of a destination, its oldest requests are dropped beyond it
+        :param spool_interval: Seconds between attempts to move spooled requests back to the queues
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pool = KeyedWorkerPool(workers, max_queued, 'AsyncHttp')
+        self.timers = TimerService('HttpTimers')     # Retries and batch lingers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sessions = {}      # destination -> requests.Session
+        self.breakers = {}      # destination -> CircuitBreaker
+        self.breakers_lock = threading.Lock()
+        self.retried = 0
+        self.shed = 0           # Dropped while the circuit of their destination was open
+        self.given_up = 0       # Dropped after max_retries
+        self.batch_linger = batch_linger
+        self.batch_size = batch_size
+        self.batches = {}       # (url, token) -> [RequestDetails] collected for the next batch
+        self.batches_lock = threading.Lock()
+        self.batched = 0        # Events sent in batches
+        self.batches_sent = 0
+        self.spool_path = spool_path
+        self.spool_segment_size = spool_segment_size
+        self.spool_max_bytes = spool_max_bytes
+        self.spool_interval = spool_interval
+        self.spools = {}        # destination -> SegmentSpool
+        self.spool_lock = threading.Lock()
+        self.spool_draining = False
+        if spool_path:
+            os.makedirs(spool_path, exist_ok=True)
+            for name in os.listdir(spool_path):
+                if os.path.isdir(os.path.join(spool_path, name)):
+                    self.get_spool(unquote(name))
+            if self.spooled():
+                self.schedule_spool_drain()
 
     # Generates an async request
-    def request(self, method, url, json, token, request_id):
+    def request(self, method, url, json, token, request_id=None):
         try:
             details = RequestDetails(method, url, json, token, request_id)
+        except Exception:
+            self.logger.exception('Queue failed')
+            return False
+        if self.batch_linger and details.method == 'POST':
+            return self.add_to_batch(details)
+        return self.queue(details)
+
+    def queue(self, details):
+        try:
+            spool = self.spools.get(details.destination)
+            if spool is not None and len(spool):
+                # Behind the spooled requests of its destination
+                return self.spool_request(details)
+            if self.get_breaker(details.destination).shedding():
+                if self.spool_path:
+                    return self.spool_request(details)
+                self.shed += 1
+                self.logger.debug('Circuit open, shedding request: %s' % details)
+                return False
             self.logger.debug('queuing send request: %s' % details)
-            self.q.put_nowait(details)
+            self.pool.submit(details.destination, self.send, details)
             return True
         except queue.Full:
-            self.logger.exception('Queue full')
+            if self.spool_path:
+                return self.spool_request(details)
+            self.logger.error('Queue full, dropped request: %s' % details)
             return False
         except Exception:
             self.logger.exception('Queue failed')
             return False
 
-    def process_request(self, retry=0):
-        while True:
+    def add_to_batch(self, details):
+        key = (details.url, details.token)
+        with self.batches_lock:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = self.batches[key] = []
+                self.timers.call_later(self.batch_linger, self.flush_batch, key, batch)
+            batch.append(details)
+            if len(batch) < self.batch_size:
+                return True
+            del self.batches[key]
+        return self.send_batch(batch)
+
+    def flush_batch(self, key, batch):
+        """Sends a batch at the end of its linger time, unless it was already sent full. Runs on the timer thread"""
+        with self.batches_lock:
+            if self.batches.get(key) is not batch:
+                return
+            del self.batches[key]
+        self.send_batch(batch)
+
+    def send_batch(self, batch):
+        first = batch[0]
+        details = RequestDetails('POST', first.url, [{'request_id': event.request_id, 'data': event.json} for event in batch],
+                                 first.token)
+        self.logger.debug('Batching %i events in %s' % (len(batch), details.request_id))
+        queued = self.queue(details)
+        if queued:
+            self.batched += len(batch)
+            self.batches_sent += 1
+        return queued
+
+    def flush_batches(self):
+        """Sends all the batches collected so far"""
+        with self.batches_lock:
+            batches, self.batches = self.batches, {}
+        for batch in batches.values():
+            self.send_batch(batch)
+
+    def get_spool(self, destination):
+        spool = self.spools.get(destination)
+        if spool is None:
+            with self.spool_lock:
+                spool = self.spools.get(destination)
+                if spool is None:
+                    spool = self.spools[destination] = SegmentSpool(
+                        os.path.join(self.spool_path, quote(destination, safe='')),
+                        self.spool_segment_size, self.spool_max_bytes)
+        return spool
+
+    def spooled(self):
+        """:return: Number of spooled requests, all destinations"""
+        return sum(len(spool) for spool in list(self.spools.values()))
+
+    def spool_request(self, details):
+        self.logger.debug('Spooling request: %s' % details)
+        self.get_spool(details.destination).append(details.dumps())
+        self.schedule_spool_drain()
+        return True
+
+    def schedule_spool_drain(self):
+        with self.spool_lock:
+            if self.spool_draining:
+                return
+            self.spool_draining = True
+        self.timers.call_later(self.spool_interval, self.drain_spool)
+
+    def drain_spool(self):
+        """
+        Moves spooled requests back to the queues, in order per destination, while they have room and the destination
+        accepts requests. Runs on the timer thread, every spool_interval while a spool is not empty
+        """
+        for destination, spool in list(self.spools.items()):
             try:
-                details = self.q.get()
-                self.send(details)
+                self.drain_destination(destination, spool)
             except Exception:
-                self.logger.exception('failed to get from queue')
-            self.q.task_done()
+                self.logger.exception('Draining the spool of %s failed' % destination)
+        with self.spool_lock:
+            if not self.spooled():
+                self.spool_draining = False
+                return
+        self.timers.call_later(self.spool_interval, self.drain_spool)
+
+    def drain_destination(self, destination, spool):
+        breaker = self.get_breaker(destination)
+        while True:
+            trial = breaker.state == CircuitBreaker.OPEN and not breaker.shedding()
+            if breaker.state != CircuitBreaker.CLOSED and not trial:
+                return
+            data = spool.peek()
+            if data is None:
+                return
+            details = RequestDetails.loads(data)
+            try:
+                self.pool.submit(destination, self.send, details)
+            except queue.Full:
+                return
+            spool.pop()
+            if trial:
+                return
 
-    def send(self, details, retry=0):
+    def get_session(self, destination):
+        """Called from the worker of destination only"""
+        session = self.sessions.get(destination)
+        if session is None:
+            session = self.sessions[destination] = requests.Session()
+        return session
+
+    def get_breaker(self, destination):
+        breaker = self.breakers.get(destination)
+        if breaker is None:
+            with self.breakers_lock:
+                breaker = self.breakers.get(destination)
+                if breaker is None:
+                    breaker = self.breakers[destination] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def send(self, details):
+        """Sends a request. Runs on the worker of its destination"""
+        breaker = self.get_breaker(details.destination)
+        if not breaker.allow():
+            if self.spool_path:
+                self.spool_request(details)
+                return
+            self.shed += 1
+            self.logger.debug('Circuit open, shedding request: %s' % details)
+            return
+        details.attempts += 1
         try:
             self.logger.debug('Sending request: %s' % details)
-            r = requests.request(method=details.method, url=details.url, json=details.json, headers=details.headers)
+            r = self.get_session(details.destination).request(
+                method=details.method, url=details.url, json=details.json, headers=details.headers, timeout=self.timeout)
+            if 400 <= r.status_code < 500:
+                # The destination is up, but refuses this request: retrying won't help
+                breaker.success()
+                self.logger.error('Request refused: %s <-- %s' % (r.status_code, details))
+                return
             r.raise_for_status()
+            breaker.success()
             self.logger.debug('Request response code: %s <-- %s ' % (r.status_code, details))
             return
         except requests.exceptions.RequestException as e:
             self.logger.error('notify request failed on library exception \'%s\' for %s: ' % (type(e).__name__, details))
         except Exception:
             self.logger.exception('notify request failed on exception')
-        if retry < 5:
-            self.logger.info('Retrying (%i)...' % retry)
-            time.sleep(1)
-            self.send(details, retry+1)
-        else:
-            self.logger.info('Max retries reached. I give up.')
+        if breaker.failure():
+            self.logger.warning('Circuit opened for %s, shedding its requests for %s s' % (details.destination, self.reset_timeout))
+        self.schedule_retry(details)
+
+    def schedule_retry(self, details):
+        if details.attempts > self.max_retries:
+            self.given_up += 1
+            self.logger.info('Max retries reached. I give up: %s' % details)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (details.attempts - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)    # Jitter, so failed requests don't retry in lockstep
+        self.logger.info('Retrying (%i) in %.1f s: %s' % (details.attempts, delay, details))
+        self.retried += 1
+        self.timers.call_later(delay, self.resubmit, details)
+
+    def resubmit(self, details):
+        """Queues a request to retry. Runs on the timer thread"""
+        try:
+            self.pool.submit(details.destination, self.send, details)
+        except queue.Full:
+            if self.spool_path:
+                self.spool_request(details)
+                return
+            self.logger.error('Queue full, dropped retry: %s' % details)
+
+    def metrics(self):
+        metrics = self.pool.metrics()
+        metrics['sessions'] = len(self.sessions)
+        metrics['retried'] = self.retried
+        metrics['shed'] = self.shed
+        metrics['given_up'] = self.given_up
+        metrics['timers_pending'] = self.timers.pending()
+        metrics['batched'] = self.batched
+        metrics['batches'] = self.batches_sent
+        if self.spool_path:
+            metrics['spool'] = {destination: spool.metrics() for destination, spool in list(self.spools.items())}
+        metrics['open_circuits'] = [destination for destination, breaker in list(self.breakers.items())
+                                    if breaker.state != CircuitBreaker.CLOSED]
+        return metrics
+
+    def close(self):
+        self.flush_batches()
+        self.timers.close()
+        queued = self.pool.drain() if self.spool_path else []
+        self.pool.close()
+        if self.spool_path:
+            # Keep the requests still queued, and the retries still waiting for their backoff (including the ones
+            # scheduled by the requests that were being sent), for the next run
+            for fn, args in queued + self.timers.drain():
+                if fn == self.send or fn == self.resubmit:
+                    self.get_spool(args[0].destination).append(args[0].dumps())
+        for spool in list(self.spools.values()):
+            spool.close()
+        for session in list(self.sessions.values()):
+            session.close()
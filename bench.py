@@ -0,0 +1,178 @@
+# bench.py
+# Micro-benchmarks of the event hot paths. Run on the target (e.g. the Pi) to compare implementations:
+#   python bench.py mqtt [events]
+#   python bench.py http [requests] [destinations]
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubMqttClient:
+    """Stands in for paho's client, so only our side of publishing is measured"""
+    rc = 0
+
+    def __init__(self):
+        self.published = 0
+        self.on_publish = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published += 1
+        if self.on_publish:
+            self.on_publish(self, None, self.published)
+        return self     # As a MQTTMessageInfo, with rc
+
+    def is_connected(self):
+        return True
+
+
+class StubHttpHandler(BaseHTTPRequestHandler):
+    """Answers every request with an empty 200, keeping the connection alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_http_server():
+    """:return: The server, listening on a free localhost port"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHttpHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def report(name, events, seconds):
+    print('%-30s %10i events %8.3f s %12.0f events/s' % (name, events, seconds, events / seconds))
+
+
+def bench_mqtt(events=100000):
+    """
+    State publishing: building topic/payload per event (previous implementation) vs. the per-channel publication cache.
+    First straight to a stub client, as the original publish path did (every event is a client.publish).
+    Then through the publish filter and the outbound publisher to a connected stub client, timed until the
+    publisher is idle. The lanes keep the latest message per topic, so there are fewer publishes than events.
+    """
+    from ha_mqtt import HAMQTTClient
+
+    ha_mqtt = HAMQTTClient('localhost')
+    channels = [(344662, index) for index in range(16)]
+
+    def build_uncached(sn, index, state):
+        topic = f"phidget/{sn}/input/{index}/state"
+        payload = json.dumps({
+            "state": "ON" if state else "OFF",
+            "device_id": sn,
+            "channel": index
+        })
+        return topic, payload
+
+    client = StubMqttClient()
+
+    def publish_direct_uncached(sn, index, state):
+        topic, payload = build_uncached(sn, index, state)
+        client.publish(topic, payload, retain=True)
+
+    def publish_direct_cached(sn, index, state):
+        topic, payloads = ha_mqtt.state_publications.get(('input', sn, index)) or ha_mqtt.get_state_publication('input', sn, index)
+        client.publish(topic, payloads[bool(state)], retain=True)
+
+    for name, publish in (('direct uncached', publish_direct_uncached), ('direct cached', publish_direct_cached)):
+        for sn, index in channels:
+            publish(sn, index, True)      # Warm up
+        start = time.perf_counter()
+        for i in range(events):
+            sn, index = channels[i & 15]
+            publish(sn, index, i & 16)
+        report('mqtt %s' % name, events, time.perf_counter() - start)
+
+    ha_mqtt.client = ha_mqtt.publisher.client = StubMqttClient()
+    ha_mqtt.client.on_publish = ha_mqtt.publisher.on_publish
+    ha_mqtt.publisher.set_connected(True)
+
+    def publish_input_state_uncached(sn, index, state):
+        ha_mqtt.publish(*build_uncached(sn, index, state))
+
+    for name, publish in (('uncached', publish_input_state_uncached), ('cached', ha_mqtt.publish_input_state)):
+        for sn, index in channels:
+            publish(sn, index, True)      # Warm up
+        wait_publisher_idle(ha_mqtt.publisher)
+        published = ha_mqtt.client.published
+        start = time.perf_counter()
+        for i in range(events):
+            sn, index = channels[i & 15]
+            publish(sn, index, i & 16)
+        wait_publisher_idle(ha_mqtt.publisher)
+        report('mqtt publisher %s' % name, events, time.perf_counter() - start)
+        print('%30s %10i publishes' % ('', ha_mqtt.client.published - published))
+    ha_mqtt.publisher.close()
+
+
+def wait_publisher_idle(publisher):
+    while True:
+        metrics = publisher.metrics()
+        if not metrics['inflight'] and not any(lane['depth'] for lane in metrics['lanes'].values()):
+            return
+        time.sleep(0.0001)
+
+
+def bench_http(requests_count=2000, destinations=4):
+    """
+    Callbacks to local stub servers: a new connection per request (previous implementation) vs. AsyncHttp's pooled sessions,
+    without and with batching
+    """
+    import requests
+    from asynchttp import AsyncHttp
+
+    servers = [start_stub_http_server() for _ in range(destinations)]
+    urls = ['http://127.0.0.1:%i/api/' % server.server_address[1] for server in servers]
+    event = {'sn': 344662, 'index': 0, 'state': True}
+
+    start = time.perf_counter()
+    for i in range(requests_count):
+        requests.request('POST', urls[i % destinations], json=event).raise_for_status()
+    report('http unpooled', requests_count, time.perf_counter() - start)
+
+    for name, http in (('pooled', AsyncHttp(workers=destinations)),
+                       ('batched', AsyncHttp(workers=destinations, batch_linger=0.01))):
+        start = time.perf_counter()
+        for i in range(requests_count):
+            while not http.request('POST', urls[i % destinations], event, None):
+                time.sleep(0.001)
+        http.flush_batches()
+        while True:
+            metrics = http.metrics()
+            if metrics['completed'] >= metrics['submitted'] and metrics['batched'] + metrics['completed'] >= requests_count:
+                break
+            time.sleep(0.001)
+        report('http %s x%i' % (name, destinations), requests_count, time.perf_counter() - start)
+        http.close()
+    for server in servers:
+        server.shutdown()
+
+
+BENCHMARKS = {
+    'mqtt': bench_mqtt,
+    'http': bench_http,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('Usage: python bench.py {%s} [events]' % '|'.join(BENCHMARKS))
+        sys.exit(1)
+    args = [int(arg) for arg in sys.argv[2:]]
+    BENCHMARKS[sys.argv[1]](*args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import threading
+
+
+class ChannelIndex:
+    """
+    Channels keyed by (type, sn, index), with secondary indexes by sn and by type.
+    Lookups are O(1) and lock-free; per-device and per-type queries only touch the channels of that device/type.
+    """
+
+    def __init__(self):
+        self.channels = {}      # (type, sn, index) -> channel
+        self.by_sn = {}         # sn -> {(type, index): channel}
+        self.by_type = {}       # type -> {(sn, index): channel}
+        self._lock = threading.Lock()   # Keeps the 3 dicts consistent between add/remove calls from different threads
+
+    def add(self, channel_type, sn, index, ch):
+        with self._lock:
+            self.channels[(channel_type, sn, index)] = ch
+            self.by_sn.setdefault(sn, {})[(channel_type, index)] = ch
+            self.by_type.setdefault(channel_type, {})[(sn, index)] = ch
+
+    def remove(self, channel_type, sn, index):
+        """
+        :return: The removed channel, or None if not found
+        """
+        with self._lock:
+            ch = self.channels.pop((channel_type, sn, index), None)
+            if ch is None:
+                return None
+            self._discard(self.by_sn, sn, (channel_type, index))
+            self._discard(self.by_type, channel_type, (sn, index))
+            return ch
+
+    def remove_device(self, sn):
+        """
+        Removes all the channels of a device
+        :return: The removed channels
+        """
+        with self._lock:
+            device = self.by_sn.pop(sn, {})
+            for (channel_type, index) in device:
+                del self.channels[(channel_type, sn, index)]
+                self._discard(self.by_type, channel_type, (sn, index))
+            return list(device.values())
+
+    @staticmethod
+    def _discard(index, key, sub_key):
+        channels = index.get(key)
+        if channels is not None:
+            channels.pop(sub_key, None)
+            if not channels:
+                del index[key]
+
+    def get(self, channel_type, sn, index):
+        return self.channels.get((channel_type, sn, index))
+
+    def device(self, sn):
+        """
+        :return: {(type, index): channel} of all the channels of a device
+        """
+        with self._lock:
+            return dict(self.by_sn.get(sn, {}))
+
+    def of_type(self, channel_type):
+        """
+        :return: {(sn, index): channel} of all the channels of a type
+        """
+        with self._lock:
+            return dict(self.by_type.get(channel_type, {}))
+
+    def serials(self):
+        with self._lock:
+            return list(self.by_sn)
+
+    def values(self):
+        with self._lock:
+            return list(self.channels.values())
+
+    def __contains__(self, key):
+        return key in self.channels
+
+    def __len__(self):
+        return len(self.channels)
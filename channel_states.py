@@ -1,36 +1,129 @@
-class ChannelStates(dict):
-    __slots__ = ()  # http://book.pythontips.com/en/latest/__slots__magic.html
+from collections.abc import MutableMapping
+
+
+class ChannelStates(MutableMapping):
+    """
+    States of the channels of all devices, keyed by integer sn and index.
+    Each device is packed into 3 bitmasks (bit i = channel i): channels that have a state, channels that are on, and '*' channels.
+    Still behaves like a mapping of sn -> {index: state}, so it can be logged and persisted as before.
+    """
+    __slots__ = ('devices',)
+    PRESENT, ON, ANY = range(3)
+
+    def __new__(cls, *args, **kwargs):
+        # Unpickling skips __init__, and states pickled by the older dict-based version are loaded through __setitem__
+        self = super().__new__(cls)
+        self.devices = {}       # sn -> [present bits, on bits, '*' bits]
+        return self
+
+    def __init__(self, states=None):
+        if states:
+            self.update(states)
 
     def get_state(self, sn, index):
+        """:return: True, False, '*', or None if not set (or sn/index are not numbers)"""
         try:
-            # return self.default_output_state_types.get(str(sn)).get(str(index))
-            return self.__getitem__(str(sn)).get(str(index))
-        except Exception:
+            masks = self.devices.get(sn if sn.__class__ is int else int(sn))
+            if masks is None:
+                return None
+            bit = 1 << int(index)
+        except (ValueError, TypeError):
             return None
+        if not masks[0] & bit:
+            return None
+        if masks[2] & bit:
+            return '*'
+        return (masks[1] & bit) != 0
 
     def set_state(self, sn, index, state):
-        sn = str(sn)
-        if sn not in self:
-            self[sn] = {}
-        self[sn][str(index)] = state
+        """Sets the state of a channel (None clears it). Ignored if sn or index are not numbers"""
+        try:
+            sn = sn if sn.__class__ is int else int(sn)
+            bit = 1 << int(index)
+        except (ValueError, TypeError):
+            return
+        masks = self.devices.get(sn)
+        if masks is None:
+            masks = self.devices[sn] = [0, 0, 0]
+        if state is None:
+            masks[0] &= ~bit
+            masks[1] &= ~bit
+            masks[2] &= ~bit
+        elif state == '*':
+            masks[0] |= bit
+            masks[1] &= ~bit
+            masks[2] |= bit
+        else:
+            masks[0] |= bit
+            masks[1] = masks[1] | bit if state else masks[1] & ~bit
+            masks[2] &= ~bit
 
     def set_state2(self, ch, state):
-        sn = str(ch.getDeviceSerialNumber())
-        if sn not in self:
-            self[sn] = {}
-        self[sn][str(ch.getChannel())] = state
+        self.set_state(ch.getDeviceSerialNumber(), ch.getChannel(), state)
 
     def del_state(self, sn, index):
         try:
-            del self[str(sn)][str(index)]
+            self.set_state(sn, index, None)
         except Exception:
             return None
 
     def del_sn(self, sn):
         try:
-            del self[str(sn)]
+            del self.devices[int(sn)]
         except Exception:
             return None
 
-    #def __contains__(self, k):
-    #    return super().__contains__(ensure_lower(k))
+    def copy(self):
+        states = ChannelStates()
+        states.devices = {sn: list(masks) for sn, masks in self.devices.items()}
+        return states
+
+    # Mapping of sn -> {index: state}
+    def __getitem__(self, sn):
+        try:
+            present, on, any_ = self.devices[int(sn)]
+        except (ValueError, TypeError):
+            raise KeyError(sn)
+        channels = {}
+        index = 0
+        while present:
+            if present & 1:
+                channels[index] = '*' if any_ & 1 else (on & 1) == 1
+            present >>= 1
+            on >>= 1
+            any_ >>= 1
+            index += 1
+        return channels
+
+    def __setitem__(self, sn, channels):
+        sn = int(sn)
+        self.devices[sn] = [0, 0, 0]
+        for index, state in channels.items():
+            self.set_state(sn, index, state)
+
+    def __delitem__(self, sn):
+        try:
+            del self.devices[int(sn)]
+        except (ValueError, TypeError):
+            raise KeyError(sn)
+
+    def __contains__(self, sn):
+        try:
+            return int(sn) in self.devices
+        except (ValueError, TypeError):
+            return False
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+        return self.devices
+
+    def __setstate__(self, state):
+        self.devices = state
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+
+from timers import TimerService
+
+
+class ChannelDebounce:
+    """Debouncing state of one input channel"""
+    __slots__ = ('raw', 'emitted', 'last_emit', 'timer', 'generation', 'stable_time', 'min_pulse', 'events', 'glitches')
+
+    def __init__(self, stable_time, min_pulse):
+        self.raw = None             # Latest state reported by the hardware
+        self.emitted = None         # Latest state passed to the handler
+        self.last_emit = None       # time.monotonic() of the latest emitted edge
+        self.timer = None           # Pending TimerService handle
+        self.generation = 0         # Identifies the pending timer, so a cancelled one that already fired is ignored
+        self.stable_time = stable_time
+        self.min_pulse = min_pulse
+        self.events = 0
+        self.glitches = 0           # Raw changes that reverted before being emitted
+
+
+class Debouncer:
+    """
+    Debounces input state changes between the hardware callbacks and the app handler.
+    A changed state is passed to the handler once it has been stable for `stable_time` seconds, and edges are passed
+    at least `min_pulse` seconds apart (a state that is still current when the pulse time is over is passed then).
+    Changes that revert within the window are counted as glitches and never reach the handler.
+    All the channels share one TimerService thread. With both times 0 (the default), changes are passed through at once.
+    """
+
+    def __init__(self, handler, stable_time=0.0, min_pulse=0.0, timers=None):
+        """
+        :param handler: Called with (sn, index, state) for every debounced change
+        :param stable_time: Default seconds a new state must hold before it is passed on
+        :param min_pulse: Default min seconds between two passed edges of a channel
+        :param timers: TimerService to use (default: a dedicated one)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.handler = handler
+        self.stable_time = stable_time
+        self.min_pulse = min_pulse
+        self.timers = timers or TimerService('Debounce')
+        self.own_timers = timers is None
+        self.channels = {}          # (sn, index) -> ChannelDebounce
+        self.lock = threading.Lock()
+        self.emitted = 0
+
+    def configure(self, sn, index, stable_time=None, min_pulse=None):
+        """Sets the windows of a channel (None: the default)"""
+        with self.lock:
+            channel = self.get_channel((sn, index))
+            channel.stable_time = self.stable_time if stable_time is None else stable_time
+            channel.min_pulse = self.min_pulse if min_pulse is None else min_pulse
+
+    def get_channel(self, key):
+        """Called with lock held"""
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = ChannelDebounce(self.stable_time, self.min_pulse)
+        return channel
+
+    def input_changed(self, sn, index, state):
+        """Hardware callback, same signature as the handler"""
+        key = (sn, index)
+        with self.lock:
+            channel = self.get_channel(key)
+            channel.events += 1
+            channel.raw = state
+            if channel.timer is not None:
+                if state == channel.emitted:
+                    # Reverted before being passed on: a bounce
+                    self.timers.cancel(channel.timer)
+                    channel.timer = None
+                    channel.glitches += 1
+                    return
+                if not channel.stable_time:
+                    # Waiting for min_pulse, the timer passes the latest state
+                    return
+                # Restart the stable time
+                self.timers.cancel(channel.timer)
+                channel.timer = None
+            if state == channel.emitted:
+                # Not a change (e.g. a refresh of the current state): pass it on
+                self.emitted += 1
+            else:
+                delay = channel.stable_time
+                if not delay and channel.last_emit is not None:
+                    delay = channel.last_emit + channel.min_pulse - time.monotonic()
+                if delay > 0:
+                    self.start_timer(channel, key, delay)
+                    return
+                self.emit(channel)
+        self.handler(sn, index, state)
+
+    def start_timer(self, channel, key, delay):
+        """Called with lock held"""
+        channel.generation += 1
+        channel.timer = self.timers.call_later(delay, self.on_timer, key, channel.generation)
+
+    def emit(self, channel):
+        """Records the raw state as passed on. Called with lock held"""
+        channel.timer = None
+        channel.emitted = channel.raw
+        channel.last_emit = time.monotonic()
+        self.emitted += 1
+
+    def on_timer(self, key, generation):
+        """The stable time or pulse time of a channel is over. Runs on the timer thread"""
+        with self.lock:
+            channel = self.channels[key]
+            if channel.generation != generation:
+                return
+            channel.timer = None
+            if channel.raw == channel.emitted:
+                return
+            # Stable, but an edge was passed less than min_pulse ago
+            if channel.last_emit is not None and channel.last_emit + channel.min_pulse > time.monotonic():
+                self.start_timer(channel, key, channel.last_emit + channel.min_pulse - time.monotonic())
+                return
+            self.emit(channel)
+            state = channel.raw
+        try:
+            self.handler(key[0], key[1], state)
+        except Exception:
+            self.logger.exception('Handler failed for %s/%s', *key)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'events': sum(channel.events for channel in self.channels.values()),
+                'emitted': self.emitted,
+                'glitches': sum(channel.glitches for channel in self.channels.values()),
+                'pending': sum(1 for channel in self.channels.values() if channel.timer is not None),
+            }
+
+    def channel_metrics(self, sn, index):
+        """:return: {'events', 'glitches'} of a channel, or None if it never changed"""
+        with self.lock:
+            channel = self.channels.get((sn, index))
+            return channel and {'events': channel.events, 'glitches': channel.glitches}
+
+    def close(self):
+        if self.own_timers:
+            self.timers.close()
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+# Event kinds
+INPUT = 0           # state: bool
+OUTPUT = 1          # state: bool
+ATTACHED = 2        # state: channel type
+DETACHED = 3        # state: channel type
+KIND_NAMES = ['input', 'output', 'attached', 'detached']
+
+# Overflow policies, when the slowest sink is `capacity` events behind
+DROP_OLDEST = 'drop_oldest'     # Overwrite: the late sinks skip the overwritten events
+DROP_NEWEST = 'drop_newest'     # Refuse the new event
+
+
+class EventBus:
+    """
+    Preallocated ring buffer of event records (sn, index, kind, state, monotonic timestamp).
+    Producers (hardware callback threads) only write a record and never block on a sink. Each sink has its own cursor
+    and thread, and consumes the records in batches at its own pace, so a slow sink never delays the others.
+    """
+
+    def __init__(self, capacity=4096, overflow=DROP_OLDEST):
+        """
+        :param capacity: Number of records in the ring
+        :param overflow: DROP_OLDEST or DROP_NEWEST
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.records = [None] * capacity
+        self.head = 0               # Sequence number of the next record; record n is in records[n % capacity]
+        self.condition = threading.Condition()
+        self.sinks = []
+        self.closed = False
+        self.published = 0
+        self.rejected = 0           # DROP_NEWEST: events refused
+
+    def publish(self, sn, index, kind, state):
+        """
+        Writes an event record. Never blocks on the sinks
+        :return: False if the event was refused (DROP_NEWEST overflow)
+        """
+        record = (sn, index, kind, state, time.monotonic())
+        with self.condition:
+            if self.overflow == DROP_NEWEST and self.sinks and self.head - self.min_cursor() >= self.capacity:
+                self.rejected += 1
+                return False
+            self.records[self.head % self.capacity] = record
+            self.head += 1
+            self.published += 1
+            self.condition.notify_all()
+        return True
+
+    def min_cursor(self):
+        """Called with condition held"""
+        return min(sink.cursor for sink in self.sinks)
+
+    def subscribe(self, name, handler, batch_size=256):
+        """
+        Adds a sink, which will receive the events published from now on
+        :param handler: Called with a list of records, from the sink's thread
+        :param batch_size: Max records per handler call
+        """
+        sink = EventSink(self, name, handler, batch_size)
+        with self.condition:
+            sink.cursor = self.head
+            self.sinks.append(sink)
+        sink.start()
+        return sink
+
+    def read(self, sink):
+        """
+        Waits for records after the sink's cursor
+        :return: The next batch of records, or None once the bus is closed and the sink has read everything
+        """
+        with self.condition:
+            while sink.cursor == self.head:
+                if self.closed:
+                    return None
+                self.condition.wait()
+            if self.head - sink.cursor > self.capacity:
+                # Overwritten before the sink read them
+                lost = self.head - self.capacity - sink.cursor
+                sink.lost += lost
+                sink.cursor += lost
+                self.logger.warning('Sink %s lagging, lost %i events', sink.name, lost)
+            end = min(self.head, sink.cursor + sink.batch_size)
+            start = sink.cursor % self.capacity
+            stop = end % self.capacity
+            if start < stop:
+                batch = self.records[start:stop]
+            else:
+                batch = self.records[start:] + self.records[:stop]
+            sink.cursor = end
+            if self.overflow == DROP_NEWEST:
+                self.condition.notify_all()
+            return batch
+
+    def metrics(self):
+        """Per sink lag, in events and in seconds (age of the oldest event not yet read)"""
+        now = time.monotonic()
+        with self.condition:
+            sinks = {}
+            for sink in self.sinks:
+                lag = min(self.head - sink.cursor, self.capacity)
+                sinks[sink.name] = {
+                    'lag': lag,
+                    'lag_seconds': now - self.records[(self.head - lag) % self.capacity][4] if lag else 0.0,
+                    'consumed': sink.consumed,
+                    'batches': sink.batches,
+                    'lost': sink.lost,
+                    'failed': sink.failed,
+                }
+            return {'published': self.published, 'rejected': self.rejected, 'sinks': sinks}
+
+    def close(self, timeout=5):
+        """Stops the sinks once they have consumed the events already published"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.thread.join(max(0, deadline - time.monotonic()))
+
+
+class EventSink:
+    """Consumer of an EventBus, with its own cursor and thread"""
+
+    def __init__(self, bus, name, handler, batch_size):
+        self.logger = logging.getLogger('%s.%s' % (self.__class__.__name__, name))
+        self.bus = bus
+        self.name = name
+        self.handler = handler
+        self.batch_size = batch_size
+        self.cursor = 0             # Sequence number of the next record to read
+        self.consumed = 0
+        self.batches = 0
+        self.lost = 0               # DROP_OLDEST: records overwritten before being read
+        self.failed = 0             # Batches the handler failed on
+        self.thread = threading.Thread(target=self._run, name='EventSink-%s' % name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.bus.read(self)
+            if batch is None:
+                return
+            try:
+                self.handler(batch)
+            except Exception:
+                self.failed += 1
+                self.logger.exception('Handling %i events failed', len(batch))
+            self.consumed += len(batch)
+            self.batches += 1
+
+
+class EventCounter:
+    """Metrics sink: counts the events per kind"""
+
+    def __init__(self):
+        self.counts = [0] * len(KIND_NAMES)
+
+    def __call__(self, batch):
+        for record in batch:
+            self.counts[record[2]] += 1
+
+    def metrics(self):
+        return dict(zip(KIND_NAMES, self.counts))
@@ -1,5 +1,7 @@
 from signal import pause
 from gpiozero import Button, LED
+import pigpio
+import threading
 import traceback
 import logging
 
@@ -7,40 +9,178 @@ from utils import get_device_id
 
 # RPi B (26 pins)
 BCM_INPUT_IDS = [2, 3, 4, 14, 15, 17, 18, 27, 22, 23, 24, 10, 9, 25, 11, 8, 7]  # total 17
-BCM_OUTPUT_IDS = []  # total 0
+BCM_OUTPUT_IDS = []  # total 0, set the output pins with GpiosManager(output_pins=...)
+
+
+GPIOZERO = 'gpiozero'
+PIGPIO = 'pigpio'
+
+
+def pins_mask(pins):
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+class PigpioBank:
+    """
+    Reads and writes the GPIOs as one bank (GPIO 0-31) through the pigpio daemon.
+    Inputs are sampled with a single read_bank_1(), diffed against the previous sample, and only the changed pins are
+    reported. Samples are taken on the edges reported by pigpio, or at a fixed rate with poll_interval.
+    Outputs are written with at most one set_bank_1() and one clear_bank_1().
+    """
+
+    def __init__(self, input_pins, output_pins, inputs_changed_handler, poll_interval=None, host='localhost', port=8888):
+        """
+        :param input_pins: BCM numbers of the inputs (pulled up, active low like gpiozero's Button)
+        :param output_pins: BCM numbers of the outputs (active high like gpiozero's LED)
+        :param inputs_changed_handler: Called with [(pin, state)] of the inputs changed since the previous sample
+        :param poll_interval: Seconds between samples (None: sample on the edges reported by pigpio)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pi = pigpio.pi(host, port)
+        if not self.pi.connected:
+            raise RuntimeError('pigpio daemon not running on %s:%s' % (host, port))
+        self.input_pins = list(input_pins)
+        self.output_pins = list(output_pins)
+        self.input_mask = pins_mask(self.input_pins)
+        self.output_mask = pins_mask(self.output_pins)
+        self.inputs_changed_handler = inputs_changed_handler
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.closed = threading.Event()
+        self.poller = None
+        self.samples = 0
+        for pin in self.input_pins:
+            self.pi.set_mode(pin, pigpio.INPUT)
+            self.pi.set_pull_up_down(pin, pigpio.PUD_UP)
+        for pin in self.output_pins:
+            self.pi.set_mode(pin, pigpio.OUTPUT)
+        self.levels = self.pi.read_bank_1() & self.input_mask   # Previous sample of the inputs
+        if poll_interval:
+            self.poller = threading.Thread(target=self._poll, name='GpioPoller', daemon=True)
+            self.poller.start()
+        else:
+            for pin in self.input_pins:
+                self.callbacks.append(self.pi.callback(pin, pigpio.EITHER_EDGE, self.on_edge))
+
+    def on_edge(self, pin, level, tick):
+        """pigpio callback. Edges already seen by a previous sample of the bank don't need a new one"""
+        if level < 2 and bool(self.levels & (1 << pin)) == bool(level):
+            return
+        self.sample()
+
+    def _poll(self):
+        while not self.closed.wait(self.poll_interval):
+            try:
+                self.sample()
+            except Exception:
+                self.logger.exception('Sampling inputs failed')
+
+    def sample(self):
+        """Reads the input bank, and notifies the inputs changed since the previous sample"""
+        with self.lock:
+            levels = self.pi.read_bank_1() & self.input_mask
+            changed = levels ^ self.levels
+            self.levels = levels
+            self.samples += 1
+        if changed:
+            self.inputs_changed_handler([(pin, not levels & (1 << pin)) for pin in self.input_pins if changed & (1 << pin)])
+
+    def get_input_states(self):
+        """:return: {pin: state} of all the inputs, from a single bank read"""
+        levels = self.pi.read_bank_1()
+        return {pin: not levels & (1 << pin) for pin in self.input_pins}
+
+    def get_output_states(self):
+        levels = self.pi.read_bank_1()
+        return {pin: bool(levels & (1 << pin)) for pin in self.output_pins}
+
+    def write_outputs(self, states):
+        """
+        Sets several outputs at once
+        :param states: {pin: state}
+        """
+        on = off = 0
+        for pin, state in states.items():
+            if state:
+                on |= 1 << pin
+            else:
+                off |= 1 << pin
+        if (on | off) & ~self.output_mask:
+            raise ValueError('Not output pins: %s' % [pin for pin in states if not self.output_mask & (1 << pin)])
+        if on:
+            self.pi.set_bank_1(on)
+        if off:
+            self.pi.clear_bank_1(off)
+
+    def close(self):
+        self.closed.set()
+        for callback in self.callbacks:
+            callback.cancel()
+        if self.poller:
+            self.poller.join(5)
+        self.pi.stop()
 
 
 # Manages all GPIOs
 class GpiosManager:
     manager22 = None
-    buttons = []    # Inputs
-    leds = []       # Outputs
     sn = ""
 
     # Initialization
     def __init__(self,
                  channel_attached_external_handler=None,
                  input_changed_external_handler=None,
-                 output_changed_external_handler=None):
+                 output_changed_external_handler=None,
+                 backend=GPIOZERO,
+                 poll_interval=None,
+                 input_pins=None,
+                 output_pins=None,
+                 outputs_changed_external_handler=None):
+        """
+        :param input_pins: BCM numbers of the inputs (default: BCM_INPUT_IDS)
+        :param output_pins: BCM numbers of the outputs (default: BCM_OUTPUT_IDS)
+        :param outputs_changed_external_handler: Called with (sn, {index: state}) when set_output_states() changes several outputs.
+                                                 If not set, output_changed_external_handler is called for each output
+        :param backend: GPIOZERO (a Button/LED object and callbacks per pin) or PIGPIO (PigpioBank: bank reads and writes)
+        :param poll_interval: PIGPIO backend: seconds between samples of the inputs (None: sample on edges)
+        """
         try:
             self.logger = logging.getLogger(self.__class__.__name__)
             self.logger.info('Starting')
             self.channel_attached_external_handler = channel_attached_external_handler
             self.input_changed_external_handler = input_changed_external_handler
             self.output_changed_external_handler = output_changed_external_handler
+            self.outputs_changed_external_handler = outputs_changed_external_handler
             self.sn = get_device_id()
+            self.input_pins = list(BCM_INPUT_IDS if input_pins is None else input_pins)
+            self.output_pins = list(BCM_OUTPUT_IDS if output_pins is None else output_pins)
+            self.buttons = []       # Inputs
+            self.leds = {}          # Outputs, pin -> LED
+            self.output_states = {} # Shadow of the outputs, pin -> state last written
+            self.io_lock = threading.Lock()
+            self.bank = None
+            if backend == PIGPIO:
+                self.bank = PigpioBank(self.input_pins, self.output_pins, self.inputs_changed, poll_interval)
+                self.output_states = self.bank.get_output_states()
             # Initialize and publish inputs
-            for id in BCM_INPUT_IDS:
-                button = Button("BCM" + str(id))
-                button.when_pressed = self.button_state_changed
-                button.when_released = self.button_state_changed
-                self.buttons.append(button)
+            for id in self.input_pins:
+                if not self.bank:
+                    button = Button("BCM" + str(id))
+                    button.when_pressed = self.button_state_changed
+                    button.when_released = self.button_state_changed
+                    self.buttons.append(button)
                 if self.channel_attached_external_handler:
                     self.channel_attached_external_handler(self.sn, id, 'Input')
             # Initialize and publish outputs
-            for id in BCM_OUTPUT_IDS:
-                led = LED("BCM" + str(id))
-                self.leds.append(led)
+            for id in self.output_pins:
+                if not self.bank:
+                    led = LED("BCM" + str(id))
+                    self.leds[id] = led
+                    self.output_states[id] = led.is_lit
                 if self.channel_attached_external_handler:
                     self.channel_attached_external_handler(self.sn, id, 'Output')
         except Exception as e:
@@ -50,49 +190,114 @@ class GpiosManager:
 
     def button_state_changed(self, button):
         pin = button.pin.number
-        state = button.is_active
-        print(pin, state, button)
+        self.notify_input_change(pin, button.is_active)
+
+    def inputs_changed(self, changes):
+        """PigpioBank handler"""
+        for pin, state in changes:
+            self.notify_input_change(pin, state)
 
+    def notify_input_change(self, pin, state):
         self.logger.info("Notifying GPIO %s/%i state changed to: %r" % (self.sn, pin, state))
         if self.input_changed_external_handler:
             self.input_changed_external_handler(self.sn, pin, state)
 
+    def notify_output_change(self, pin, state):
+        self.logger.info("Notifying GPIO %s/%i state changed to: %r" % (self.sn, pin, state))
+        if self.output_changed_external_handler:
+            self.output_changed_external_handler(self.sn, pin, state)
+
     def get_states(self):
+        if self.bank:
+            for pin, state in self.bank.get_input_states().items():
+                self.notify_input_change(pin, state)
+            for pin, state in self.bank.get_output_states().items():
+                self.notify_output_change(pin, state)
+            return
         for button in self.buttons:
             self.button_state_changed(button)
-        for led in self.leds:
+        for led in self.leds.values():
             self.led_state_changed(led)
 
-    def set_output_state(self, index, state, force_notify=False):
-        for led in self.leds:
-            if str(led.pin.number) == str(index):
+    def set_output_state(self, sn, index, state, force_notify=False):
+        if not sn == self.sn:  # Ignore if the serial number doesn't match
+            self.logger.debug(f'not my sn: {sn} vs {self.sn}')
+            return
+        pin = int(index)
+        state = bool(state)
+        if pin not in self.output_states:
+            self.logger.error('Failed finding output index {}'.format(index))
+            return
+        with self.io_lock:
+            changed = self.output_states[pin] != state
+            if changed:
+                self.write_outputs({pin: state})
+        if changed or force_notify:
+            self.notify_output_change(pin, state)
+
+    def set_output_states(self, sn, states):
+        """
+        Sets several outputs in one pass: only outputs whose state differs from the shadow state are written
+        (a single bank write with the PIGPIO backend), and the changes are notified as one batch.
+        :param states: {index: state}
+        :return: {index: state} of the outputs that changed
+        """
+        if not sn == self.sn:  # Ignore if the serial number doesn't match
+            self.logger.debug(f'not my sn: {sn} vs {self.sn}')
+            return {}
+        requested = {}
+        for index, state in states.items():
+            pin = int(index)
+            if pin not in self.output_states:
+                self.logger.error('Failed finding output index {}'.format(index))
+                continue
+            requested[pin] = bool(state)
+        with self.io_lock:
+            changed = {pin: state for pin, state in requested.items() if self.output_states[pin] != state}
+            if changed:
+                self.write_outputs(changed)
+        if changed:
+            if self.outputs_changed_external_handler:
+                self.logger.info("Notifying GPIO %s outputs changed to: %r" % (self.sn, changed))
+                self.outputs_changed_external_handler(self.sn, changed)
+            else:
+                for pin, state in changed.items():
+                    self.notify_output_change(pin, state)
+        return changed
+
+    def write_outputs(self, states):
+        """
+        Writes the outputs and updates the shadow state. Called with io_lock held
+        :param states: {pin: state}
+        """
+        if self.bank:
+            self.bank.write_outputs(states)
+        else:
+            for pin, state in states.items():
                 if state:
-                    led.on()
+                    self.leds[pin].on()
                 else:
-                    led.off()
-                return
+                    self.leds[pin].off()
+        self.output_states.update(states)
 
-        self.logger.exception('Failed finding output index {}]'.format(index))
+    def close(self):
+        if self.bank:
+            self.bank.close()
 
     def led_state_changed(self, led):
         pin = led.pin.number
-        state = led.is_lit
-        print(pin, state, led)
-
-        self.logger.info("Notifying GPIO %s/%i state changed to: %r" % (self.sn, pin, state))
-        if self.output_changed_external_handler:
-            self.output_changed_external_handler(self.sn, pin, state)
+        self.notify_output_change(pin, led.is_lit)
 
 
 def main():
-    gpios = GpiosManager(None, None)
+    gpios = GpiosManager(None, None, output_pins=[5])
     import time
 
     while True:
-        gpios.set_output_state(1, 1, False)
+        gpios.set_output_state(gpios.sn, 5, True)
         print('ready')
         time.sleep(1)
-        gpios.set_output_state(1, 0, False)
+        gpios.set_output_state(gpios.sn, 5, False)
         print('ready')
         time.sleep(1)
     pause()
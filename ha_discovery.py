@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import threading
+
+
+class DiscoveryManager:
+    """
+    Publishes Home Assistant MQTT discovery configs.
+    Keeps a content hash per config topic, and only publishes configs that changed. The configs announced during an attach storm
+    are collected for `linger` seconds and then published as one burst, paced `pace` seconds apart.
+    The configs are cached, so they can be re-announced after a broker reconnect without the hardware re-attaching.
+    """
+
+    def __init__(self, publish, timers, linger=0.5, pace=0.02):
+        """
+        :param publish: Called with (topic, payload) to publish a retained config
+        :param timers: TimerService used for the linger and pacing delays
+        :param linger: Seconds to wait for more configs before starting a burst
+        :param pace: Seconds between the publishes of a burst
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.publish = publish
+        self.timers = timers
+        self.linger = linger
+        self.pace = pace
+        self.configs = {}           # topic -> (hash, payload) of the latest announced config
+        self.published = {}         # topic -> hash of the config last published
+        self.pending = {}           # topic -> payload waiting for the next burst, in announcement order
+        self.scheduled = False      # A burst is scheduled or in progress
+        self.lock = threading.Lock()
+        self.announced = 0
+        self.unchanged = 0          # Announcements skipped since the same config was already published
+        self.bursts = 0
+
+    def announce(self, topic, config):
+        """
+        Queues a config for publishing, unless the same config was already published to topic
+        :param config: The config dict
+        """
+        payload = json.dumps(config)
+        digest = hashlib.sha1(payload.encode()).digest()
+        with self.lock:
+            self.announced += 1
+            self.configs[topic] = (digest, payload)
+            if self.published.get(topic) == digest:
+                self.pending.pop(topic, None)
+                self.unchanged += 1
+                return
+            self.pending[topic] = payload
+            self.schedule()
+
+    def forget(self, topic):
+        """Called when the publish of topic was dropped, so the next announcement of its config is published again"""
+        with self.lock:
+            self.published.pop(topic, None)
+
+    def republish(self):
+        """Re-announces all the cached configs, e.g. after a broker reconnect"""
+        with self.lock:
+            self.published.clear()
+            self.pending = {topic: payload for topic, (digest, payload) in self.configs.items()}
+            if self.pending:
+                self.logger.info('Re-publishing %i discovery configs', len(self.pending))
+                self.schedule()
+
+    def schedule(self):
+        """Schedules a burst. Called with lock held"""
+        if not self.scheduled:
+            self.scheduled = True
+            self.timers.call_later(self.linger, self.publish_next)
+
+    def publish_next(self):
+        """Publishes the next pending config, and schedules the one after it. Runs on the timer thread"""
+        with self.lock:
+            if not self.pending:
+                self.scheduled = False
+                self.bursts += 1
+                return
+            topic = next(iter(self.pending))
+            payload = self.pending.pop(topic)
+            self.published[topic] = self.configs[topic][0]
+        try:
+            self.publish(topic, payload)
+        except Exception:
+            self.logger.exception('Failed publishing %s', topic)
+        self.timers.call_later(self.pace, self.publish_next)
+
+    def metrics(self):
+        with self.lock:
+            return {'configs': len(self.configs), 'pending': len(self.pending), 'announced': self.announced,
+                    'unchanged': self.unchanged, 'bursts': self.bursts}
@@ -2,10 +2,32 @@
 import paho.mqtt.client as mqtt
 import logging
 import json
+import threading
+
+from ha_discovery import DiscoveryManager
+from mqtt_dispatch import CommandDispatcher, TopicRouter
+from mqtt_offline import OfflineBuffer
+from mqtt_publisher import OutboundPublisher, ACK, STATE, DISCOVERY
+from timers import TimerService
 
 
 class HAMQTTClient:
-    def __init__(self, broker_host, broker_port=1883, username=None, password=None):
+    def __init__(self, broker_host, broker_port=1883, username=None, password=None, coalesce_window=0,
+                 discovery_linger=0.5, discovery_pace=0.02, command_workers=2, command_queue=256,
+                 max_inflight=20, max_queued=1000, offline_path=None, offline_burst=100, offline_pace=0.05):
+        """
+        :param coalesce_window: Default seconds during which the state changes of a channel are coalesced:
+                                the first change is published at once, and only the latest one at the end of the window (0: off)
+        :param discovery_linger: Seconds to collect discovery configs (e.g. of an attach storm) before publishing them as one burst
+        :param discovery_pace: Seconds between the discovery publishes of a burst
+        :param command_workers: Threads running output commands, so slow devices never block the MQTT network thread
+        :param command_queue: Max output commands waiting per command worker
+        :param max_inflight: Max messages handed to the MQTT client and not yet sent
+        :param max_queued: Max messages waiting per outbound priority lane
+        :param offline_path: Shelve path persisting the states published while disconnected (None: memory only)
+        :param offline_burst: Number of buffered states re-published per step after a reconnect
+        :param offline_pace: Seconds between the steps of the re-publishing
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.client = mqtt.Client()
         self.broker_host = broker_host
@@ -14,12 +36,39 @@ class HAMQTTClient:
         self.password = password
         self.output_callback = None
         self.attached_channels = {}  # Track attached channels per device
+        # (channel_type, sn, index) -> (state topic, {True: ON payload, False: OFF payload})
+        # Built when the channel attaches, so publishing a state change is a lookup + publish
+        self.state_publications = {}
+        # Publish filter
+        self.retained = {}              # topic -> last retained payload published, identical publishes are dropped
+        self.coalesce_window = coalesce_window
+        self.coalesce_windows = {}      # (channel_type, sn, index) -> seconds, overrides coalesce_window
+        self.coalescing = {}            # topic -> latest payload held back during the window (None if nothing held)
+        self.filter_lock = threading.Lock()
+        self.timers = TimerService('MQTTTimers')
+        # Outbound messages are published from the priority lanes of a single publisher thread
+        self.publisher = OutboundPublisher(self.client, max_inflight, max_queued, on_drop=self.on_publish_dropped)
+        # Latest state per topic published while disconnected, re-published after reconnecting
+        self.offline = OfflineBuffer(offline_path)
+        self.offline_burst = offline_burst
+        self.offline_pace = offline_pace
+        self.offline_flushing = False
+        self.discovery = DiscoveryManager(self.publish_discovery, self.timers, discovery_linger, discovery_pace)
+        # Inbound commands
+        self.commands = CommandDispatcher(command_workers, command_queue)
+        self.router = TopicRouter()
+        self.router.add("phidget/+/output/+/command", self.on_output_command)
+        self.queued = 0                 # Passed the filter, handed to the publisher
+        self.suppressed = 0             # Identical to the retained value
+        self.coalesced = 0              # Replaced by a later state within a coalescing window
 
     def connect(self):
         self.logger.info(f"Connecting to MQTT broker {self.broker_host}:{self.broker_port} using {self.username}")
 
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.publisher.on_publish
 
         # Set username and password if provided
         if self.username and self.password:
@@ -32,24 +81,153 @@ class HAMQTTClient:
             self.logger.fatal(f"Error connecting to MQTT broker {self.broker_host}:{self.broker_port} {e}", exc_info=True)
             return False
 
+    def close(self):
+        self.publisher.close()
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.commands.close()
+        self.timers.close()
+        self.offline.close()
+
     def on_connect(self, client, userdata, flags, rc):
         self.logger.info(f"Connected to MQTT broker with result code {rc}")
+        # The broker may have lost the retained messages, so don't suppress the next publishes
+        with self.filter_lock:
+            self.retained.clear()
+        # Re-announce the channels from the cache, rather than waiting for the hardware to re-attach
+        self.discovery.republish()
         # Subscribe to all output command topics
         self.client.subscribe("phidget/+/output/+/command")
+        self.publisher.set_connected(rc == 0)
+        if rc == 0:
+            self.start_offline_flush()
+
+    def on_disconnect(self, client, userdata, *args):
+        self.logger.warning(f"Disconnected from MQTT broker: {args}")
+        self.publisher.set_connected(False)
 
     def on_message(self, client, userdata, msg):
         try:
-            if msg.topic.startswith("phidget/") and "/output/" in msg.topic:
-                parts = msg.topic.split("/")
-                if len(parts) == 5 and parts[4] == "command":
-                    sn = parts[1]
-                    index = int(parts[3])
-                    state = msg.payload.decode() == "ON"
-                    if self.output_callback:
-                        self.output_callback(sn, index, state)
+            if not self.router.route(msg.topic, msg.payload):
+                self.logger.debug(f"Ignoring MQTT message on {msg.topic}")
         except Exception as e:
             self.logger.error(f"Error processing MQTT message: {e}")
 
+    def on_output_command(self, sn, index, payload):
+        """Decodes an output command, and queues it for output_callback on the device's command worker"""
+        index = int(index)
+        state = payload.decode() == "ON"
+        if self.output_callback:
+            self.commands.dispatch(sn, self.output_callback, sn, index, state)
+
+    def publish(self, topic, payload, retain=True, lane=STATE):
+        """
+        Queues a message on a lane of the publisher, unless payload is the value already retained for topic
+        :param lane: ACK, STATE or DISCOVERY
+        """
+        if retain:
+            with self.filter_lock:
+                if self.retained.get(topic) == payload:
+                    self.suppressed += 1
+                    return
+                self.retained[topic] = payload
+        if lane != DISCOVERY:
+            if not self.publisher.connected:
+                self.offline.put(topic, payload, retain, lane)
+                return
+            if len(self.offline):
+                # Don't let the older buffered value overwrite this one
+                self.offline.discard(topic)
+        self.queued += 1
+        self.publisher.enqueue(lane, topic, payload, retain)
+
+    def start_offline_flush(self):
+        with self.filter_lock:
+            if self.offline_flushing or not len(self.offline):
+                return
+            self.offline_flushing = True
+        self.logger.info('Re-publishing %i states buffered while disconnected', len(self.offline))
+        self.timers.call_later(0, self.flush_offline)
+
+    def flush_offline(self):
+        """Re-publishes the next offline_burst buffered states, and schedules the next step. Runs on the timer thread"""
+        if self.publisher.connected:
+            for topic, payload, retain, lane in self.offline.take(self.offline_burst):
+                self.publish(topic, payload, retain, lane)
+            if len(self.offline) and self.publisher.connected:
+                self.timers.call_later(self.offline_pace, self.flush_offline)
+                return
+        with self.filter_lock:
+            self.offline_flushing = False
+        # States buffered by a disconnect during the last step
+        if self.publisher.connected:
+            self.start_offline_flush()
+
+    def publish_discovery(self, topic, payload):
+        self.publish(topic, payload, lane=DISCOVERY)
+
+    def on_publish_dropped(self, topic):
+        """Called for messages the publisher dropped, so the next publish to topic is not suppressed"""
+        with self.filter_lock:
+            self.retained.pop(topic, None)
+        self.discovery.forget(topic)
+
+    def publish_state(self, key, topic, payload):
+        """
+        Publishes a channel state, coalescing bursts if the channel has a coalescing window.
+        Output states are confirmations of commands, and go to the ACK lane.
+        :param key: (channel_type, sn, index)
+        """
+        lane = ACK if key[0] == 'output' else STATE
+        window = self.coalesce_windows.get(key, self.coalesce_window)
+        if window:
+            with self.filter_lock:
+                if topic in self.coalescing:
+                    if self.coalescing[topic] is not None:
+                        self.coalesced += 1
+                    self.coalescing[topic] = payload
+                    return
+                self.coalescing[topic] = None
+            self.timers.call_later(window, self.end_coalescing, topic, lane)
+        self.publish(topic, payload, lane=lane)
+
+    def end_coalescing(self, topic, lane):
+        with self.filter_lock:
+            payload = self.coalescing.pop(topic, None)
+        if payload is not None:
+            self.publish(topic, payload, lane=lane)
+
+    def set_coalesce_window(self, channel_type, sn, index, seconds):
+        """Sets the coalescing window of a channel (0: off, None: back to the default)"""
+        key = (channel_type.lower(), sn, index)
+        if seconds is None:
+            self.coalesce_windows.pop(key, None)
+        else:
+            self.coalesce_windows[key] = seconds
+
+    def metrics(self):
+        return {'queued': self.queued, 'suppressed': self.suppressed, 'coalesced': self.coalesced,
+                'publisher': self.publisher.metrics(), 'offline': self.offline.metrics(),
+                'discovery': self.discovery.metrics(), 'commands': self.commands.metrics()}
+
+    def get_state_publication(self, channel_type, sn, index):
+        """
+        :param channel_type: 'input' or 'output'
+        :return: (state topic, {True: ON payload, False: OFF payload}) of the channel
+        """
+        key = (channel_type, sn, index)
+        publication = self.state_publications.get(key)
+        if publication is None:
+            # Not attached (yet). The publication only depends on the key, so it is safe to cache it anyway
+            publication = self.state_publications[key] = (
+                f"phidget/{sn}/{channel_type}/{index}/state",
+                {state: json.dumps({
+                    "state": "ON" if state else "OFF",
+                    "device_id": sn,
+                    "channel": index,
+                }) for state in (True, False)})
+        return publication
+
     def publish_channel_attached(self, sn, index, channel_type):
         """Publish channel attached status and config"""
         # Track attached channel
@@ -59,6 +237,7 @@ class HAMQTTClient:
 
         # Publish status with channel type in topic
         channel_type = channel_type.lower()
+        self.get_state_publication(channel_type, sn, index)
         topic = f"phidget/{sn}/{channel_type}/{index}/status"
         payload = json.dumps({
             "state": "attached",
@@ -66,7 +245,7 @@ class HAMQTTClient:
             "channel": index,
             "type": channel_type,
         })
-        self.client.publish(topic, payload, retain=True)
+        self.publish(topic, payload, lane=DISCOVERY)
 
         # Publish config
         self.publish_channel_config(sn, index, channel_type)
@@ -80,6 +259,7 @@ class HAMQTTClient:
                 del self.attached_channels[sn]
 
         channel_type = channel_type.lower()
+        self.state_publications.pop((channel_type, sn, index), None)
         topic = f"phidget/{sn}/{channel_type}/{index}/status"
         payload = json.dumps({
             "state": "detached",
@@ -87,7 +267,7 @@ class HAMQTTClient:
             "channel": index,
             "type": channel_type
         })
-        self.client.publish(topic, payload, retain=True)
+        self.publish(topic, payload, lane=DISCOVERY)
 
     def publish_channel_config(self, sn, index, channel_type):
         """Publish Home Assistant MQTT discovery config for a single channel"""
@@ -129,27 +309,15 @@ class HAMQTTClient:
             }
             config_topic = f"{base_topic}/switch/phidget_{sn}_{channel_type}_{index}/config"
 
-        self.client.publish(config_topic, json.dumps(config), retain=True)
+        self.discovery.announce(config_topic, config)
 
     def publish_input_state(self, sn, index, state):
         """Publish input state change"""
-        print(f'Publish input state change: {sn}/{index} --> {state}')
-        topic = f"phidget/{sn}/input/{index}/state"
-        payload = json.dumps({
-            "state": "ON" if state else "OFF",
-            "device_id": sn,
-            "channel": index
-        })
-        self.client.publish(topic, payload, retain=True)
+        topic, payloads = self.state_publications.get(('input', sn, index)) or self.get_state_publication('input', sn, index)
+        self.publish_state(('input', sn, index), topic, payloads[bool(state)])
 
     def publish_output_state(self, sn, index, state):
         """Publish output state change"""
-        topic = f"phidget/{sn}/output/{index}/state"
-        payload = json.dumps({
-            "state": "ON" if state else "OFF",
-            "device_id": sn,
-            "channel": index,
-        })
-        print(f'Publish output state change: {topic} --> {payload}')
-        self.logger.info(f'Publishing to {topic}: {payload}')
-        self.client.publish(topic, payload, retain=True)
+        topic, payloads = self.state_publications.get(('output', sn, index)) or self.get_state_publication('output', sn, index)
+        self.logger.info('Publishing to %s: %s', topic, payloads[bool(state)])
+        self.publish_state(('output', sn, index), topic, payloads[bool(state)])
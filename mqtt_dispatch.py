@@ -0,0 +1,73 @@
+import logging
+import queue
+
+from workers import KeyedWorkerPool
+
+
+class TopicRouter:
+    """
+    Maps MQTT topics to handlers. Patterns use MQTT '+' wildcards and are compiled once into
+    (literal levels, wildcard positions), grouped by number of levels, so routing a topic is a split and a few comparisons.
+    """
+
+    def __init__(self):
+        self.routes = {}    # number of levels -> [((position, literal)..., wildcard positions, handler)]
+
+    def add(self, pattern, handler):
+        """
+        :param pattern: e.g. 'phidget/+/output/+/command'
+        :param handler: Called with the wildcard levels of the topic, followed by the route() args
+        """
+        levels = pattern.split('/')
+        literals = tuple((i, level) for i, level in enumerate(levels) if level != '+')
+        wildcards = tuple(i for i, level in enumerate(levels) if level == '+')
+        self.routes.setdefault(len(levels), []).append((literals, wildcards, handler))
+
+    def route(self, topic, *args):
+        """
+        Calls the handler of the first pattern matching topic
+        :return: True if a handler was found
+        """
+        levels = topic.split('/')
+        for literals, wildcards, handler in self.routes.get(len(levels), ()):
+            for i, literal in literals:
+                if levels[i] != literal:
+                    break
+            else:
+                handler(*[levels[i] for i in wildcards], *args)
+                return True
+        return False
+
+
+class CommandDispatcher:
+    """
+    Runs decoded commands on a bounded worker pool, off the MQTT network thread.
+    Commands with the same key (the device sn) run in arrival order; commands of different devices run concurrently.
+    """
+
+    def __init__(self, workers=2, max_queued=256):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pool = KeyedWorkerPool(workers, max_queued, 'MQTTCommands')
+        self.dropped = 0
+
+    def dispatch(self, key, fn, *args):
+        """
+        Queues fn(*args). Never blocks: drops the command if the queue of its worker is full
+        :return: True if queued
+        """
+        try:
+            self.pool.submit(key, fn, *args)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.logger.error('Command queue full, dropped command for %s: %s', key, args)
+            return False
+
+    def metrics(self):
+        """Queue depth, dispatch latency (wait_*: queued to started, run_*: handler duration, in seconds) and drops"""
+        metrics = self.pool.metrics()
+        metrics['dropped'] = self.dropped
+        return metrics
+
+    def close(self):
+        self.pool.close()
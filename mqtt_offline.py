@@ -0,0 +1,98 @@
+import collections
+import logging
+import shelve
+import threading
+
+from state_store import WriteBehind
+
+
+class OfflineBuffer:
+    """
+    Holds the state messages published while the broker is unreachable, keyed by topic.
+    Only the latest value of a topic is kept, so the buffer is bounded by the number of channels, not of events,
+    and topics keep the order in which they first changed.
+    With a path, the buffer is persisted to a shelve (write-behind), so a restart during an outage keeps the pending updates.
+    """
+
+    def __init__(self, path=None, flush_interval=1.0):
+        """
+        :param path: Shelve path to persist the buffer to (None: memory only)
+        :param flush_interval: Max seconds a change waits before being persisted
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.messages = collections.OrderedDict()   # topic -> (payload, retain, lane)
+        self.sequences = {}         # topic -> sequence of its place in messages, persisted to keep the order across a restart
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.buffered = 0
+        self.collapsed = 0          # Replaced by a later value of the same topic
+        self.writer = None
+        if path:
+            with shelve.open(path) as db:
+                stored = sorted(db.items(), key=lambda item: item[1][3])
+            self.messages.update((topic, message[:3]) for topic, message in stored)
+            self.sequences.update((topic, message[3]) for topic, message in stored)
+            if self.messages:
+                self.logger.info('Loaded %i offline messages from %s', len(self.messages), path)
+                self.sequence = stored[-1][1][3] + 1
+            self.writer = WriteBehind(self.write, flush_interval, name='OfflineBufferWriter')
+
+    def put(self, topic, payload, retain, lane):
+        with self.lock:
+            if topic in self.messages:
+                self.collapsed += 1
+            else:
+                self.sequences[topic] = self.sequence
+                self.sequence += 1
+            self.messages[topic] = (payload, retain, lane)
+            self.buffered += 1
+        if self.writer:
+            self.writer.mark_dirty(topic)
+
+    def discard(self, topic):
+        """Drops the buffered value of topic, e.g. when a newer one was published directly"""
+        with self.lock:
+            if self.messages.pop(topic, None) is None:
+                return
+            del self.sequences[topic]
+        if self.writer:
+            self.writer.mark_dirty(topic)
+
+    def take(self, count):
+        """
+        Removes up to count messages, oldest first
+        :return: [(topic, payload, retain, lane)]
+        """
+        with self.lock:
+            messages = []
+            while self.messages and len(messages) < count:
+                topic, message = self.messages.popitem(last=False)
+                del self.sequences[topic]
+                messages.append((topic, *message))
+        if self.writer and messages:
+            self.writer.mark_dirty(*[message[0] for message in messages])
+        return messages
+
+    def write(self, topics):
+        """WriteBehind callback: stores the buffered value of the dirty topics, deletes the others"""
+        with self.lock:
+            messages = {topic: self.messages[topic] + (self.sequences[topic],) if topic in self.messages else None
+                        for topic in topics}
+        with shelve.open(self.path) as db:
+            for topic, message in messages.items():
+                if message is None:
+                    db.pop(topic, None)
+                else:
+                    db[topic] = message
+
+    def __len__(self):
+        return len(self.messages)
+
+    def metrics(self):
+        with self.lock:
+            return {'depth': len(self.messages), 'buffered': self.buffered, 'collapsed': self.collapsed}
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
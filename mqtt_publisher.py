@@ -0,0 +1,162 @@
+import collections
+import logging
+import threading
+
+ACK = 0             # Output state confirmations of commands
+STATE = 1           # Input states
+DISCOVERY = 2       # Discovery configs and channel status
+LANE_NAMES = ['ack', 'state', 'discovery']
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+
+class Lane:
+    """
+    Bounded queue of messages of one priority.
+    With collapse, a message to a topic already queued replaces the queued payload (keeping its place in the queue),
+    so the lane holds at most one message per topic. When full, the overflow policy drops the oldest or the new message.
+    """
+
+    def __init__(self, name, max_queued, collapse=True, overflow=DROP_OLDEST):
+        self.name = name
+        self.max_queued = max_queued
+        self.collapse = collapse
+        self.overflow = overflow
+        self.messages = collections.OrderedDict()   # key -> (topic, payload, retain). key is the topic when collapsing
+        self.sequence = 0
+        self.collapsed = 0
+        self.dropped = 0
+
+    def put(self, topic, payload, retain):
+        """
+        :return: The topic of the dropped message, if any
+        """
+        if self.collapse and topic in self.messages:
+            self.messages[topic] = (topic, payload, retain)
+            self.collapsed += 1
+            return None
+        dropped = None
+        if len(self.messages) >= self.max_queued:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return topic
+            dropped = self.messages.popitem(last=False)[1][0]
+        if self.collapse:
+            key = topic
+        else:
+            key = self.sequence
+            self.sequence += 1
+        self.messages[key] = (topic, payload, retain)
+        return dropped
+
+    def get(self):
+        return self.messages.popitem(last=False)[1]
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class OutboundPublisher:
+    """
+    Publishes from a single thread, from bounded priority lanes: ACK first, then STATE, then DISCOVERY.
+    Producers only enqueue, and never block. At most max_inflight messages are handed to the MQTT client before it
+    reports them as sent (on_publish), and messages wait in their lanes while the client is disconnected.
+    """
+
+    def __init__(self, client, max_inflight=20, max_queued=1000, on_drop=None, lanes=None):
+        """
+        :param client: paho MQTT client
+        :param max_inflight: Max messages published and not yet reported sent by the client
+        :param max_queued: Max messages per lane (unless lanes is given)
+        :param on_drop: Called with the topic of every dropped message
+        :param lanes: [ack Lane, state Lane, discovery Lane], to override the default policies
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.client = client
+        self.max_inflight = max_inflight
+        self.on_drop = on_drop
+        self.lanes = lanes or [
+            Lane(LANE_NAMES[ACK], max_queued, collapse=True, overflow=DROP_OLDEST),
+            Lane(LANE_NAMES[STATE], max_queued, collapse=True, overflow=DROP_OLDEST),
+            Lane(LANE_NAMES[DISCOVERY], max_queued, collapse=True, overflow=DROP_NEWEST),
+        ]
+        self.inflight = 0
+        self.published = 0
+        self.failed = 0
+        self.connected = False
+        self.closed = False
+        self.condition = threading.Condition()
+        # paho limits only apply to QoS > 0, but keep them consistent
+        client.max_inflight_messages_set(max_inflight)
+        client.max_queued_messages_set(max_queued)
+        self.thread = threading.Thread(target=self._run, name='MQTTPublisher', daemon=True)
+        self.thread.start()
+
+    def enqueue(self, lane, topic, payload, retain=True):
+        with self.condition:
+            dropped = self.lanes[lane].put(topic, payload, retain)
+            self.condition.notify()
+        if dropped is not None:
+            self.logger.warning('%s lane full, dropped message to %s', LANE_NAMES[lane], dropped)
+            if self.on_drop:
+                self.on_drop(dropped)
+
+    def set_connected(self, connected):
+        """Called by the client's connect/disconnect callbacks. Messages in flight when the connection changes are lost to paho"""
+        with self.condition:
+            self.connected = connected
+            self.inflight = 0
+            self.condition.notify()
+
+    def on_publish(self, client, userdata, mid, *args):
+        with self.condition:
+            if self.inflight:
+                self.inflight -= 1
+            self.condition.notify()
+
+    def next_message(self):
+        """Waits for a message that may be published now. Called with condition held"""
+        while not self.closed:
+            if self.connected and self.inflight < self.max_inflight:
+                for lane in self.lanes:
+                    if lane:
+                        return lane.get()
+            self.condition.wait()
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                message = self.next_message()
+                if message is None:
+                    return
+                self.inflight += 1
+            topic, payload, retain = message
+            try:
+                info = self.client.publish(topic, payload, retain=retain)
+                if info.rc != 0:
+                    raise RuntimeError('rc %s' % info.rc)
+                self.published += 1
+            except Exception as e:
+                self.failed += 1
+                self.logger.error('Failed publishing to %s: %s', topic, e)
+                self.on_publish(self.client, None, None)
+                if self.on_drop:
+                    self.on_drop(topic)
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'inflight': self.inflight,
+                'published': self.published,
+                'failed': self.failed,
+                'lanes': {lane.name: {'depth': len(lane), 'collapsed': lane.collapsed, 'dropped': lane.dropped}
+                          for lane in self.lanes},
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(5)
@@ -1,16 +1,45 @@
 #!/usr/bin/env python
-import importlib
-import shelve
+import queue
+import threading
+import time
 import traceback
 import logging
 
 from Phidget22.ChannelClass import ChannelClass
-# from Phidget22.Devices.DigitalInput import DigitalInput            Loaded dynamically
-# from Phidget22.Devices.DigitalOutput import DigitalOutput          Loaded dynamically
+from Phidget22.Devices.DigitalInput import DigitalInput
+from Phidget22.Devices.DigitalOutput import DigitalOutput
 from Phidget22.Devices.Manager import Manager
 from Phidget22.ErrorCode import ErrorCode
 from Phidget22.PhidgetException import PhidgetException
+from channel_index import ChannelIndex
 from channel_states import ChannelStates
+import state_store
+from state_store import WriteBehind
+from workers import KeyedWorkerPool
+
+
+class ChannelClassEntry:
+    """How to create and set up a supported Phidget22 channel class"""
+    __slots__ = ('constructor', 'channel_type', 'setup')
+
+    def __init__(self, constructor, channel_type, setup=None):
+        """
+        :param constructor: Phidget22 channel class
+        :param channel_type: PhidgetsManager.INPUT or PhidgetsManager.OUTPUT
+        :param setup: Called with (PhidgetsManager, channel) to set class-specific handlers before the channel is opened
+        """
+        self.constructor = constructor
+        self.channel_type = channel_type
+        self.setup = setup
+
+
+# Supported channel classes, resolved once at import: ChannelClass enum -> ChannelClassEntry
+# Channels of any other class are ignored by the manager
+CHANNEL_CLASSES = {}
+
+
+def register_channel_class(channel_class, constructor, channel_type, setup=None):
+    CHANNEL_CLASSES[channel_class] = ChannelClassEntry(constructor, channel_type, setup)
 
 
 # Manages all Phidgets
@@ -19,22 +48,41 @@ from channel_states import ChannelStates
 
 class PhidgetsManager:
     manager22 = None
-    channels = {}
+    channels = None                             # ChannelIndex of the attached channels
     default_output_state = ChannelStates()
     output_states = ChannelStates()             # Needed to be able to set outputs on init to previous state
     input_changed_external_handler = None
     output_changed_external_handler = None
+    outputs_changed_external_handler = None
     INPUT = 'Input'
     OUTPUT = 'Output'
     OUTPUTS_STATES_DB = 'phidgets_outputs'
-    STATES = 'states'
-    DEFAULTS = 'defaults'
+    STATES = state_store.STATES
+    DEFAULTS = state_store.DEFAULTS
 
     # Initialization
     def __init__(self, channel_attached_external_handler=None,
                  channel_detached_external_handler=None,
                  input_changed_external_handler=None,
-                 output_changed_external_handler=None):
+                 output_changed_external_handler=None,
+                 outputs_changed_external_handler=None,
+                 states_flush_interval=1.0,
+                 states_flush_threshold=32,
+                 states_backend='shelve',
+                 attach_workers=8,
+                 attach_timeout=10000,
+                 async_outputs=False):
+        """
+        :param outputs_changed_external_handler: Called with (sn, {index: state}) when set_output_states() changes several outputs.
+                                                 If not set, output_changed_external_handler is called for each output
+        :param attach_workers: Number of channels opened concurrently when devices attach
+        :param attach_timeout: Milliseconds to wait for each opened channel to attach
+        :param async_outputs: set_output_state() uses setState_async and notifies/persists the new state on completion.
+                              Commands to a channel whose write is still in flight are collapsed into one write of the latest state
+        :param states_backend: How output states are persisted: 'shelve' (full rewrite per flush) or 'journal' (append-only, migrates the shelve)
+        :param states_flush_interval: Seconds between writes of changed output states to the db (0 writes on every change)
+        :param states_flush_threshold: Number of output state changes that forces an immediate write
+        """
         try:
             self.logger = logging.getLogger(self.__class__.__name__)
             self.logger.info('Starting')
@@ -42,7 +90,25 @@ class PhidgetsManager:
             self.channel_detached_handler = channel_detached_external_handler
             self.input_changed_external_handler = input_changed_external_handler
             self.output_changed_external_handler = output_changed_external_handler
+            self.outputs_changed_external_handler = outputs_changed_external_handler
+            self.channels = ChannelIndex()
+            self.async_outputs = async_outputs
+            self.inflight = {}          # (sn, index) -> [state being written, latest state requested meanwhile or None]
+            self.inflight_lock = threading.Lock()
+            self.async_writes = 0
+            self.collapsed_writes = 0
+            self.failed_writes = 0
+            self.states_lock = threading.RLock()     # Guards output_states/default_output_state against the flusher thread
+            self.states_store = state_store.create_state_store(states_backend, self.OUTPUTS_STATES_DB)
             self.read_output_states()
+            self.states_writer = WriteBehind(self.write_output_states, states_flush_interval, states_flush_threshold, 'OutputStatesWriter')
+            # Channels are opened on attach_pool, so the manager thread never waits for a channel to attach
+            self.attach_timeout = attach_timeout
+            self.attach_pool = KeyedWorkerPool(attach_workers, name='PhidgetAttach')
+            self.attach_lock = threading.Lock()
+            self.attach_bursts = {}      # sn -> [start time, channels pending, channels opened, channels failed]
+            self.attach_times = {}       # sn -> seconds it took all the channels of the last attach burst to attach
+            self.created_channels = []   # Every channel created for an attach, opened or not, closed by close()
             self.manager22 = Manager()
             self.manager22.setOnAttachHandler(self.on_manager_attach_handler)
             self.manager22.setOnDetachHandler(self.on_manager_detach_handler)
@@ -52,26 +118,35 @@ class PhidgetsManager:
             self.logger.exception('init')
             raise e
 
-    # def get_device_serials(self):
-    #     """Returns a list of serial numbers for all connected Phidget devices"""
-    #     return list(self.channels.keys())  # Assuming self.channels is a dict keyed by serial numbers
+    def get_device_serials(self):
+        """Returns a list of serial numbers for all connected Phidget devices"""
+        return self.channels.serials()
 
-    def write_output_states(self):
-        try:
-            self.logger.debug('Writing outputs states')
-            states = {self.STATES: self.output_states, self.DEFAULTS: self.default_output_state}
-            with shelve.open(self.OUTPUTS_STATES_DB) as db:
-                db.update(states)
-            #self.logger.debug('Saved output states: %s', states)       # This is a long log line
-        except Exception as e:
-            self.logger.exception('Failed writing to db')
+    def save_output_states(self, key, sn, index=None):
+        """
+        Marks an output state as changed. The actual db write is done later by states_writer, coalescing all changes made meanwhile.
+        :param key: STATES or DEFAULTS
+        :param index: None marks all the channels of the device
+        """
+        self.states_writer.mark_dirty((key, sn, index))
+
+    def write_output_states(self, entries):
+        """
+        Writes the changed output states to the db. Called by states_writer; use save_output_states() instead.
+        :param entries: (key, sn, index) of the changed states
+        """
+        self.logger.debug('Writing %i outputs states', len(entries))
+        with self.states_lock:
+            # Only collect what needs writing, so the states can keep changing while the db is written
+            payload = self.states_store.snapshot({self.STATES: self.output_states, self.DEFAULTS: self.default_output_state}, entries)
+        self.states_store.write(payload)
+        #self.logger.debug('Saved output states: %s', payload)       # This is a long log line
 
     def read_output_states(self):
         try:
             self.logger.info('Loading output states')
-            with shelve.open(self.OUTPUTS_STATES_DB) as db:
-                states = dict(db)
-                self.logger.debug('Loaded outputs states: %s', states)
+            states = self.states_store.load()
+            self.logger.debug('Loaded outputs states: %s', states)
             if self.STATES in states:
                 self.output_states = states[self.STATES]
             if self.DEFAULTS in states:
@@ -87,9 +162,23 @@ class PhidgetsManager:
         # Strange things will happen in the next run if the phidget objects aren't close
         if self.manager22:
             self.manager22.close()
-            for ch in self.channels.values():
-                ch.close()
+            self.attach_pool.drain()    # Channels not opened yet, closed below with the others
+            self.attach_pool.close()
+            for sn in self.channels.serials():
+                self.channels.remove_device(sn)
+            # Including the channels that never attached (e.g. openWaitForAttachment timed out), which are still open
+            with self.attach_lock:
+                channels, self.created_channels = self.created_channels, []
+            for ch in channels:
+                try:
+                    ch.close()
+                except PhidgetException as e:
+                    self.logger.exception('Error closing channel')
+                    self.display_error(e)
         self.logger.info('Closed all phidget objects')
+        if hasattr(self, 'states_writer'):
+            self.states_writer.close()      # Final flush of pending output states
+            self.states_store.close()
 
     def display_error(self, e):
         if e.code == ErrorCode.EPHIDGET_WRONGDEVICE:
@@ -113,27 +202,21 @@ class PhidgetsManager:
         :param ch_readonly: The READ-ONLY Phidget channel that fired the attach event
         """
         try:
-            details = ''
+            sn = index = -1
             sn = ch_readonly.getDeviceSerialNumber()
             index = ch_readonly.getChannel()
-            klass = ch_readonly.getChannelClassName()
-            details = '%s %i/%i' % (klass, sn, index)
-
-            # Dynamically create a phidget channel
-            if klass.startswith('Phidget'):  # PhidgetDigitalInput
-                python_klass_name = klass.split('Phidget')[1]
-            else:
-                self.logger.error('ERROR: Unknown classname: %s' % klass)
+            channel_class = CHANNEL_CLASSES.get(ch_readonly.getChannelClass())
+            if channel_class is None:
+                self.logger.debug('Ignoring unsupported channel class %s %i/%i', ch_readonly.getChannelClass(), sn, index)
                 return
-            details = '%s %i/%i' % (python_klass_name, sn, index)
-            # Dynamically create phidget channel class
-            ch_new = getattr(importlib.import_module('Phidget22.Devices.' + python_klass_name), python_klass_name)()
 
-            try:
-                ch_new.setOnStateChangeHandler(self.on_state_change_handler)
-            except:
-                pass  # if it fails, the it must not support state-change events
-            self.logger.debug("Manager attach event: %s %i/%i" % (python_klass_name, sn, index))
+            ch_new = channel_class.constructor()
+            ch_new.type = channel_class.channel_type
+            with self.attach_lock:
+                self.created_channels.append(ch_new)
+            if channel_class.setup:
+                channel_class.setup(self, ch_new)
+            self.logger.debug('Manager attach event: %s %i/%i', ch_new.type, sn, index)
 
             ch_new.setOnAttachHandler(self.on_channel_attach_handler)
             ch_new.setOnDetachHandler(self.on_channel_detach_handler)
@@ -142,20 +225,58 @@ class PhidgetsManager:
 
             ch_new.setDeviceSerialNumber(sn)
             ch_new.setChannel(index)
-            #ch_new.open()
-            # every so often, on_channel_attach_handler throws an exception on getDeviceSerialNumber(). calling openWaitForAttachment seems to fix it
-            ch_new.openWaitForAttachment(10000)
+            self.start_attach(sn)
+            # Channels of the same device open concurrently; opening is ordered only per channel (re-attach after detach)
+            try:
+                self.attach_pool.submit((sn, index), self.open_channel, ch_new, sn, index)
+            except queue.Full:
+                self.logger.error('Attach queue full, not opening %s %i/%i', ch_new.type, sn, index)
+                self.end_attach(sn, False)
 
-            # every so often, on_channel_attach_handler throws an exception on getDeviceSerialNumber()
-            # this seems to fix it...
-            #while not ch_new.getAttached():
-            #    self.logger.debug("Waiting for Attached: %s %i/%i" % (python_klass_name, sn, index))
-            #    time.sleep(0.01)
-            self.logger.debug("Attached: %s %i/%i" % (python_klass_name, sn, index))
+        except PhidgetException as e:
+            self.logger.exception('**************Error in Manager Attach Event: %i/%i', sn, index)
+            self.display_error(e)
 
+    def setup_input(self, ch):
+        """Channel setup of inputs: listen to state changes"""
+        ch.setOnStateChangeHandler(self.on_state_change_handler)
+
+    def open_channel(self, ch, sn, index):
+        """
+        Opens a channel created by on_manager_attach_handler. Runs on attach_pool.
+        """
+        opened = False
+        try:
+            #ch.open()
+            # every so often, on_channel_attach_handler throws an exception on getDeviceSerialNumber(). calling openWaitForAttachment seems to fix it
+            ch.openWaitForAttachment(self.attach_timeout)
+            opened = True
+            self.logger.debug('Attached: %s %i/%i', ch.type, sn, index)
         except PhidgetException as e:
-            self.logger.exception(f'**************Error in Manager Attach Event: {details}')
+            self.logger.exception('**************Error opening channel: %s %i/%i', ch.type, sn, index)
             self.display_error(e)
+        finally:
+            self.end_attach(sn, opened)
+
+    def start_attach(self, sn):
+        """Counts a channel of sn waiting to be opened, starting a new attach burst if none is in progress"""
+        with self.attach_lock:
+            burst = self.attach_bursts.get(sn)
+            if burst is None:
+                burst = self.attach_bursts[sn] = [time.monotonic(), 0, 0, 0]
+            burst[1] += 1
+
+    def end_attach(self, sn, opened):
+        """Counts a channel of sn that finished opening, and reports the burst duration once all its channels are done"""
+        with self.attach_lock:
+            burst = self.attach_bursts[sn]
+            burst[1] -= 1
+            burst[2 if opened else 3] += 1
+            if burst[1]:
+                return
+            del self.attach_bursts[sn]
+            self.attach_times[sn] = elapsed = time.monotonic() - burst[0]
+        self.logger.info('Device %i: %i channels attached in %.3f seconds (%i failed)', sn, burst[2], elapsed, burst[3])
 
     def on_channel_attach_handler(self, ch):
         """
@@ -166,17 +287,10 @@ class PhidgetsManager:
             sn = ch.getDeviceSerialNumber()
             index = ch.getChannel()
 
-            # getChannelClassName fails before channel is attached - will be fixed in phidget release after Jan/2019: https://www.phidgets.com/phorum/viewtopic.php?f=26&t=9199&p=29646#p29646
-            if ch.getChannelClass() == ChannelClass.PHIDCHCLASS_DIGITALINPUT:
-                ch.type = self.INPUT
-            elif ch.getChannelClass() == ChannelClass.PHIDCHCLASS_DIGITALOUTPUT:
-                ch.type = self.OUTPUT
-            else:
-                self.logger.warning('Attached unknown type %s %i/%i)' % (ch.getChannelClassName(), sn, index))
+            # ch.type was set from CHANNEL_CLASSES when the channel was created by on_manager_attach_handler
             self.logger.info('Channel attach event: %s %i/%i' % (ch.type, sn, index))
 
-            #if self.get_channel_id(ch.type, sn, index) not in self.channels:
-            self.channels[self.get_channel_id_from_ch(ch)] = ch
+            self.channels.add(ch.type, sn, index, ch)
 
             if ch.type == self.OUTPUT:
                 initial_state = self.get_initial_output_state(sn, index)
@@ -184,9 +298,11 @@ class PhidgetsManager:
                 # Force set_state to call notify_state_change even if state was not changed
                 self.set_output_state(ch, initial_state, force_notify=True)
 
-                # Force notification of initial state
-                current_state = ch.getState()
-                self.notify_state_change(ch, current_state)
+                # Force notification of initial state, unless an async write is in flight:
+                # getState() would still return the state from before the write, which on_set_state_async reports
+                if not self.write_in_flight(ch):
+                    current_state = ch.getState()
+                    self.notify_state_change(ch, current_state)
 
             # Notify external handler
             if self.channel_attached_handler:
@@ -214,13 +330,13 @@ class PhidgetsManager:
         """
 
         try:
-            self.logger.warning("Detach event: %s %d/%d" % (ch.type, ch.getDeviceSerialNumber(), ch.getChannel()))
-            self.channels.pop(self.get_channel_id_from_ch(ch), None)
+            sn = ch.getDeviceSerialNumber()
+            index = ch.getChannel()
+            self.logger.warning("Detach event: %s %d/%d" % (ch.type, sn, index))
+            self.channels.remove(ch.type, sn, index)
 
             # Notify external handler
             if self.channel_detached_handler:
-                sn = ch.getDeviceSerialNumber()
-                index = ch.getChannel()
                 self.channel_detached_handler(sn, index, ch.type)
 
         except PhidgetException as e:
@@ -260,24 +376,34 @@ class PhidgetsManager:
         self.notify_state_change(ch, state)
 
     def set_saved_output_state(self, ch, state):
-        sn = str(ch.getDeviceSerialNumber())
-        if sn not in self.output_states:
-            self.output_states[sn] = {}
-        self.output_states[sn][str(ch.getChannel())] = state
-        self.write_output_states()
+        with self.states_lock:
+            self.output_states.set_state2(ch, state)
+        self.save_output_states(self.STATES, ch.getDeviceSerialNumber(), ch.getChannel())
 
-    def get_channel_id_from_ch(self, ch):
-        return self.get_channel_id(ch.type, ch.getDeviceSerialNumber(), ch.getChannel())
-
-    def get_channel_id(self, classname, sn, index):
-        return classname + "_" + str(sn) + "_" + str(index)
+    @staticmethod
+    def to_sn(sn):
+        """
+        Phidget serial numbers are ints, but arrive as strings from MQTT topics
+        :return: The int serial number, or None if sn can't be a Phidget serial number
+        """
+        if sn.__class__ is int:
+            return sn
+        try:
+            return int(sn)
+        except (TypeError, ValueError):
+            return None
 
     def get_channel(self, classname, sn, index):
-        ch_id = self.get_channel_id(classname, sn, index)
-        if ch_id in self.channels:
-            return self.channels[ch_id]
-        else:
+        ch = self.channels.get(classname, self.to_sn(sn), index)
+        if ch is None:
             self.logger.warning('Channel %s %s/%s not found in channels{}', classname, sn, index)
+        return ch
+
+    def get_device_channels(self, sn):
+        """
+        :return: {(type, index): channel} of all the attached channels of a device
+        """
+        return self.channels.device(self.to_sn(sn))
 
     def notify_state_change(self, ch, state):
         sn = ch.getDeviceSerialNumber()
@@ -293,6 +419,18 @@ class PhidgetsManager:
         else:
             self.logger.error("Notifying State Change: %i/%i unknown channel type: %s" % (sn, index, ch.type))
 
+    def notify_outputs_change(self, sn, states):
+        """
+        Notifies the changes of several outputs of a device as one batch
+        :param states: {index: state}
+        """
+        self.logger.info("Notifying outputs %i state changed to: %r" % (sn, states))
+        if self.outputs_changed_external_handler:
+            self.outputs_changed_external_handler(sn, states)
+        elif self.output_changed_external_handler:
+            for index, state in states.items():
+                self.output_changed_external_handler(sn, index, state)
+
     def set_output_state_from_sn_index(self, sn, index, state):
         ch = self.get_channel(self.OUTPUT, sn, index)
         if ch is None:
@@ -317,20 +455,121 @@ class PhidgetsManager:
                 state = ch.getState()
             else:
                 return False
+        elif self.async_outputs:
+            if self.set_state_async(ch, state):
+                return True     # Notified and persisted by on_set_state_async
         elif ch and ch.getState() != state:
             ch.setState(int(state))
             state_changed = True
-            # TODO: consider using setState_async
 
         # TODO: Consider sending event even if state not changed, to resolve sync issues
         # PhidgetManager library only calls state change handler for Inputs.
         if state_changed or force_notify:
-            self.logger.info(f'Setting state: {ch.getDeviceSerialNumber()}/{ch.getChannel()} --> {state}')
-            self.notify_state_change(ch, state)
-            self.output_states.set_state(ch.getDeviceSerialNumber(), ch.getChannel(), state is True)
-            self.write_output_states()
+            self.output_state_set(ch, state)
         return state_changed
 
+    def output_state_set(self, ch, state):
+        """Notifies and persists the new state of an output"""
+        self.logger.info(f'Setting state: {ch.getDeviceSerialNumber()}/{ch.getChannel()} --> {state}')
+        self.notify_state_change(ch, state)
+        with self.states_lock:
+            self.output_states.set_state(ch.getDeviceSerialNumber(), ch.getChannel(), state is True)
+        self.save_output_states(self.STATES, ch.getDeviceSerialNumber(), ch.getChannel())
+
+    def set_state_async(self, ch, state):
+        """
+        Writes the state of an output without waiting for the device. If a write to the channel is already in flight,
+        only records the state, which on_set_state_async writes next (intermediate states are skipped).
+        :return: True if a write was issued or collapsed into the write in flight, False if the output already has that state
+        """
+        key = (ch.getDeviceSerialNumber(), ch.getChannel())
+        with self.inflight_lock:
+            inflight = self.inflight.get(key)
+            if inflight is not None:
+                inflight[1] = state
+                self.collapsed_writes += 1
+                return True
+            if ch.getState() == state:
+                return False
+            self.inflight[key] = [state, None]
+            self.async_writes += 1
+        try:
+            ch.setState_async(int(state), self.on_set_state_async)
+        except PhidgetException:
+            with self.inflight_lock:
+                self.inflight.pop(key, None)
+            raise
+        return True
+
+    def write_in_flight(self, ch):
+        """:return: True if a setState_async write to the channel has not completed yet"""
+        with self.inflight_lock:
+            return (ch.getDeviceSerialNumber(), ch.getChannel()) in self.inflight
+
+    def on_set_state_async(self, ch, res, details):
+        """
+        Fired when a setState_async write completes
+        :param ch: The DigitalOutput channel that was written
+        :param res: ErrorCode of the write
+        :param details: Error description
+        """
+        key = (ch.getDeviceSerialNumber(), ch.getChannel())
+        with self.inflight_lock:
+            state, latest = self.inflight[key]
+            if latest is not None and latest != state:
+                self.inflight[key] = [latest, None]
+                self.async_writes += 1
+            else:
+                del self.inflight[key]
+                latest = None
+            if res != ErrorCode.EPHIDGET_OK:
+                self.failed_writes += 1
+
+        if res == ErrorCode.EPHIDGET_OK:
+            self.output_state_set(ch, state)
+        else:
+            self.logger.error('Failed setting state %i/%i --> %s: %s (%s)', key[0], key[1], state, details, ErrorCode.getName(res))
+        if latest is not None:
+            try:
+                ch.setState_async(int(latest), self.on_set_state_async)
+            except PhidgetException as e:
+                with self.inflight_lock:
+                    self.inflight.pop(key, None)
+                self.logger.exception('Failed setting state %i/%i --> %s', key[0], key[1], latest)
+                self.display_error(e)
+
+    def set_output_states(self, sn, states):
+        """
+        Sets several outputs of a device in one pass: only the outputs whose state differs are set,
+        the new states are persisted once, and the changes are notified as one batch.
+        The outputs are written synchronously even with async_outputs, except for outputs with a write in flight.
+        :param sn:
+        :param states: {index: state}
+        :return: {index: state} of the outputs that changed
+        """
+        sn = self.to_sn(sn)
+        device = self.channels.device(sn)
+        changed = {}
+        for index, state in states.items():
+            ch = device.get((self.OUTPUT, index))
+            if ch is None:
+                self.logger.warning('Failed to find output %s/%s' % (sn, index))
+                continue
+            state = bool(state)
+            if self.async_outputs and self.write_in_flight(ch):
+                self.set_state_async(ch, state)     # Applied (and notified) after the write in flight
+            elif ch.getState() != state:
+                ch.setState(int(state))
+                changed[index] = state
+        self.logger.info(f'Request to change states: {sn} {states}, changed: {changed}')
+        if changed:
+            with self.states_lock:
+                for index, state in changed.items():
+                    self.output_states.set_state(sn, index, state)
+            self.states_writer.mark_dirty(*[(self.STATES, sn, index) for index in changed])
+            self.notify_outputs_change(sn, changed)
+        return changed
+
     def set_default_output_states(self, sn, states):
         """
         Sets the initial states of the outputs, for the next time that the phidget connects
@@ -339,14 +578,20 @@ class PhidgetsManager:
         :return: None
         """
         self.logger.info("Settings states for Phidget #%s, '%s'" % (sn, states))
-        self.default_output_state.del_sn(sn)  # Clear the states for this sn
+        if self.to_sn(sn) is None:
+            self.logger.warning('Ignoring the states of invalid Phidget serial number %s' % sn)
+            return
+        sn = int(sn)
+        with self.states_lock:
+            self.default_output_state.del_sn(sn)  # Clear the states for this sn
         for i in range(0, len(states)):
             state = 1 if states[i] in [1, '1'] else 0 if states[i] in [0, '0'] else '*' if states[i] in ['*'] else None
-            self.default_output_state.set_state(sn, i, state)
+            with self.states_lock:
+                self.default_output_state.set_state(sn, i, state)
             if state in [1, 0]:
                 self.logger.info("Setting Phidget #%s/%i, state: %s" % (sn, i, states[i]))
                 self.set_output_state_from_sn_index(sn, i, state)
-        self.write_output_states()
+        self.save_output_states(self.DEFAULTS, sn)
 
     def get_initial_output_state(self, sn, index):
         try:
@@ -360,9 +605,17 @@ class PhidgetsManager:
         except Exception:
             return None
 
-    def get_states(self):
-        for ch in self.channels.values():
-            self.notify_state_change(ch, ch.getState())
+    def get_states(self, sn=None):
+        """
+        Notifies the current state of all the channels, or only of the channels of device sn
+        """
+        for device_sn in (self.channels.serials() if sn is None else [self.to_sn(sn)]):
+            for ch in self.channels.device(device_sn).values():
+                self.notify_state_change(ch, ch.getState())
+
+
+register_channel_class(ChannelClass.PHIDCHCLASS_DIGITALINPUT, DigitalInput, PhidgetsManager.INPUT, PhidgetsManager.setup_input)
+register_channel_class(ChannelClass.PHIDCHCLASS_DIGITALOUTPUT, DigitalOutput, PhidgetsManager.OUTPUT)
 
 
 def main():
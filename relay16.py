@@ -17,6 +17,9 @@
 # Adapted from RJ's gitgist https://gist.github.com/RJ/7acba5b06a03c9b521601e08d0327d56
 # ... and pyusb tutorial:  https://github.com/pyusb/pyusb
 
+import errno
+import functools
+import threading
 import time
 import traceback
 
@@ -25,6 +28,79 @@ import usb.util
 import logging
 from utils import get_device_id
 
+
+# Modbus ASCII framing of the relay board commands: ':' + hex(address, function, data..., LRC) + CR LF
+MODBUS_ADDRESS = 0xFE
+MODBUS_READ_COILS = 0x01
+MODBUS_WRITE_COIL = 0x05
+MODBUS_WRITE_COILS = 0x0F
+RELAYS = 16
+ALL_RELAYS = (1 << RELAYS) - 1
+LIBUSB_ERROR_TIMEOUT = -7
+
+
+def lrc(data):
+    """Modbus ASCII Longitudinal Redundancy Check: two's complement of the byte sum"""
+    return -sum(data) & 0xFF
+
+
+def encode_frame(*data):
+    """
+    Encodes a Modbus ASCII frame to the relay board
+    :param data: Frame bytes after the address (function code and its data)
+    """
+    data = bytes((MODBUS_ADDRESS,) + data)
+    return b':' + (data + bytes((lrc(data),))).hex().upper().encode() + b'\r\n'
+
+
+def is_usb_timeout(e):
+    """pyusb 1.0 reports read timeouts as a USBError with errno ETIMEDOUT (usb.core.USBTimeoutError came in 1.1)"""
+    return e.errno == errno.ETIMEDOUT or getattr(e, 'backend_error_code', None) == LIBUSB_ERROR_TIMEOUT
+
+
+STATUS_FRAME = encode_frame(MODBUS_READ_COILS, 0, 0, 0, RELAYS)
+
+
+def parse_status(frame):
+    """
+    Parses the board response to STATUS_FRAME (read coils)
+    :param frame: The received bytes, ':' ... CR LF
+    :return: State of all the relays (bit 0 = relay 1), or None if the frame is invalid
+    """
+    try:
+        start = frame.index(b':')
+        data = bytes.fromhex(frame[start + 1:].split(b'\r')[0].decode())
+    except ValueError:
+        return None
+    # address, function, byte count, coil bytes..., LRC
+    if len(data) < 4 or data[0] != MODBUS_ADDRESS or data[1] != MODBUS_READ_COILS or lrc(data[:-1]) != data[-1]:
+        return None
+    count = data[2]
+    if len(data) != count + 4:
+        return None
+    return int.from_bytes(data[3:3 + count], 'little') & ALL_RELAYS
+
+
+@functools.lru_cache(maxsize=None)
+def coil_frame(index, state):
+    """
+    :param index: Relay 1-16
+    :return: Frame that sets a single relay
+    """
+    if not 1 <= index <= RELAYS:
+        raise ValueError('Invalid relay index: {}'.format(index))
+    return encode_frame(MODBUS_WRITE_COIL, 0, index - 1, 0xFF if state else 0, 0)
+
+
+@functools.lru_cache(maxsize=4096)
+def mask_frame(mask):
+    """
+    :param mask: State of all the relays, bit 0 = relay 1
+    :return: Frame that sets all the relays at once
+    """
+    return encode_frame(MODBUS_WRITE_COILS, 0, 0, 0, RELAYS, 2, mask & 0xFF, (mask >> 8) & 0xFF)
+
+
 class SainSmartHid:
     command = {
         'Status': [58, 70, 69, 48, 49, 48, 48, 48, 48, 48, 48, 49, 48, 70, 49, 13, 10],
@@ -58,9 +134,9 @@ class SainSmartHid:
         '14 ON': [58, 70, 69, 48, 53, 48, 48, 48, 68, 70, 70, 48, 48, 70, 49, 13, 10],
         '14 OFF': [58, 70, 69, 48, 53, 48, 48, 48, 68, 48, 48, 48, 48, 70, 48, 13, 10],
         '15 ON': [58, 70, 69, 48, 53, 48, 48, 48, 69, 70, 70, 48, 48, 70, 48, 13, 10],
-        '15 OFF': [58, 70, 69, 48, 53, 48, 48, 48, 69, 48, 48, 48, 48, 70, 70, 13, 10],
-        '16 ON': [58, 70, 69, 48, 53, 48, 48, 48, 70, 70, 70, 48, 48, 70, 70, 13, 10],
-        '16 OFF': [58, 70, 69, 48, 53, 48, 48, 48, 70, 48, 48, 48, 48, 70, 69, 13, 10],
+        '15 OFF': [58, 70, 69, 48, 53, 48, 48, 48, 69, 48, 48, 48, 48, 69, 70, 13, 10],
+        '16 ON': [58, 70, 69, 48, 53, 48, 48, 48, 70, 70, 70, 48, 48, 69, 70, 13, 10],
+        '16 OFF': [58, 70, 69, 48, 53, 48, 48, 48, 70, 48, 48, 48, 48, 69, 69, 13, 10],
         'ALL ON': [58, 70, 69, 48, 70, 48, 48, 48, 48, 48, 48, 49, 48, 48, 50, 70, 70, 70, 70, 69, 51, 13, 10],
         'ALL OFF': [58, 70, 69, 48, 70, 48, 48, 48, 48, 48, 48, 49, 48, 48, 50, 48, 48, 48, 48, 69, 49, 13, 10],
 
@@ -72,39 +148,43 @@ class SainSmartHid:
                     0x46, 0x46, 0x45, 0x33, 0x0D, 0x0A]
     }
 
-    command_indexes = [
-        {True: 'ALL ON', False: 'ALL OFF'},
-        {True: '1 ON', False: '1 OFF'},
-        {True: '2 ON', False: '2 OFF'},
-        {True: '3 ON', False: '3 OFF'},
-        {True: '4 ON', False: '4 OFF'},
-        {True: '5 ON', False: '5 OFF'},
-        {True: '6 ON', False: '6 OFF'},
-        {True: '7 ON', False: '7 OFF'},
-        {True: '8 ON', False: '8 OFF'},
-        {True: '9 ON', False: '9 OFF'},
-        {True: '10 ON', False: '10 OFF'},
-        {True: '11 ON', False: '11 OFF'},
-        {True: '12 ON', False: '12 OFF'},
-        {True: '13 ON', False: '13 OFF'},
-        {True: '14 ON', False: '14 OFF'},
-        {True: '15 ON', False: '15 OFF'},
-        {True: '16 ON', False: '16 OFF'},
-    ]
-
     def __init__(self,
                  channel_attached_external_handler=None,
-                 output_changed_external_handler=None):
+                 output_changed_external_handler=None,
+                 outputs_changed_external_handler=None,
+                 poll_interval=None,
+                 read_timeout=200):
+        """
+        :param outputs_changed_external_handler: Called with (sn, {index: state}) when several relays change.
+                                                 If not set, output_changed_external_handler is called for each relay
+        :param poll_interval: Seconds between reads of the relays status, to publish relays that differ from the shadow register (None: no polling)
+        :param read_timeout: Milliseconds to wait for the status response
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info('Starting')
         self.device = None
         self.ep = None
+        self.ep_in = None
+        # Shadow register of the relays (bit 0 = relay 1), updated on every write and status read
+        self.output_bits = 0
+        self.known_bits = 0     # Relays whose state is known
+        self.io_lock = threading.RLock()   # One command/response exchange with the board at a time
+        self.read_timeout = read_timeout
         self.channel_attached_external_handler = channel_attached_external_handler
         self.output_changed_external_handler = output_changed_external_handler
+        self.outputs_changed_external_handler = outputs_changed_external_handler
         self.sn = get_device_id()
         self.connect_device()
         # Publish available channels
         self.publish_available_channels()
+        self.poll_interval = poll_interval
+        self.closed = threading.Event()
+        if poll_interval:
+            threading.Thread(target=self.poll_status, name='SainSmartPoll', daemon=True).start()
+
+    def close(self):
+        self.closed.set()
+        self.disconnect_device()
 
     def publish_available_channels(self):
         """Publish all available relay channels for discovery by Home Assistant"""
@@ -121,7 +201,9 @@ class SainSmartHid:
             self.logger.exception('Failure disconnecting')
 
     def connect_device(self):
+        """Connects the board and reads the relays into the shadow register (the board may have been power-cycled)"""
         self.disconnect_device()
+        self.known_bits = 0
 
         try:
             self.logger.info('Connecting device')
@@ -156,6 +238,13 @@ class SainSmartHid:
 
             assert self.ep is not None
 
+            # The status response is read from the first IN endpoint
+            self.ep_in = usb.util.find_descriptor(
+                intf,
+                custom_match=lambda e: \
+                    usb.util.endpoint_direction(e.bEndpointAddress) == \
+                    usb.util.ENDPOINT_IN)
+
             # Since I'm using this to send a signal to a gate controller, I'm simulating just
             # pressing a button to make the circuit for 2 seconds, then releasing:
             # Example:
@@ -181,33 +270,182 @@ class SainSmartHid:
         except Exception as e:
             self.logger.exception('Failure connecting')
             raise RuntimeError('SainSmart init failed')
+        self.read_status()
 
-    def set_output_state(self, sn, index, state, force_notify=False):
+    def write_command(self, command, retry=True):
+        """
+        Write command to device with optional retry logic.
+        :return: True if written
+        """
+        try:
+            self.ep.write(command)
+            self.logger.debug(f'Writing command: {command}')
+            return True
+        except Exception as e:
+            # Logger.exception already includes the traceback
+            self.logger.exception(f'Failed writing to device {"(will retry)" if retry else "(gave up)"}')
+            if retry:
+                self.connect_device()
+                return self.write_command(command, retry=False)
+            return False
 
-        # Write command to device with optional retry logic.
-        def write_command_to_device(retry=True):
+    def read_status(self):
+        """
+        Reads the state of all the relays into the shadow register
+        :return: The relays state (bit 0 = relay 1), or None if it could not be read
+        """
+        if not self.ep_in:
+            return None
+        with self.io_lock:
             try:
-                self.ep.write(command)
-                self.logger.debug(f'Writing command: {command}')
-                return True
-            except Exception as e:
-                # Logger.exception already includes the traceback
-                self.logger.exception(f'Failed writing to device {"(will retry)" if retry else "(gave up)"}')
-                if retry:
-                    self.connect_device()
-                    return write_command_to_device(retry=False)
-                return False
+                self.drain_input()      # Drop the responses to previous write commands
+                self.ep.write(STATUS_FRAME)
+                buffer = b''
+                deadline = time.monotonic() + self.read_timeout / 1000
+                while time.monotonic() < deadline:
+                    try:
+                        buffer += bytes(self.ep_in.read(self.ep_in.wMaxPacketSize, self.read_timeout))
+                    except usb.core.USBError as e:
+                        if not is_usb_timeout(e):
+                            raise
+                        break
+                    *frames, buffer = buffer.split(b'\n')
+                    for frame in frames:
+                        bits = parse_status(frame)
+                        if bits is not None:
+                            self.output_bits = bits
+                            self.known_bits = ALL_RELAYS
+                            return bits
+                        self.logger.debug(f'Ignoring response: {frame}')
+            except Exception:
+                self.logger.exception('Failed reading status')
+                return None
+            self.logger.warning('No valid status response')
+            return None
+
+    def drain_input(self):
+        while True:
+            try:
+                if not self.ep_in.read(self.ep_in.wMaxPacketSize, 1):
+                    return
+            except usb.core.USBError as e:
+                if not is_usb_timeout(e):
+                    raise
+                return
+
+    def poll_status(self):
+        """Reconciles the shadow register with the board every poll_interval, notifying only the relays that differ"""
+        while not self.closed.wait(self.poll_interval):
+            with self.io_lock:
+                previous_bits, previous_known = self.output_bits, self.known_bits
+                bits = self.read_status()
+            if bits is None:
+                continue
+            differ = (bits ^ previous_bits) | (ALL_RELAYS & ~previous_known)
+            if differ:
+                self.logger.warning(f'Relays differ from shadow register: {differ:016b}')
+                self.notify_outputs_change({i + 1: bool(bits >> i & 1) for i in range(RELAYS) if differ >> i & 1})
+
+    def get_states(self):
+        """
+        Notifies the known relays states from the shadow register, without accessing the board
+        :return: {index: state} of the known relays
+        """
+        states = {i + 1: bool(self.output_bits >> i & 1) for i in range(RELAYS) if self.known_bits >> i & 1}
+        if states:
+            self.notify_outputs_change(states)
+        return states
+
+    def notify_outputs_change(self, states):
+        if self.outputs_changed_external_handler:
+            self.outputs_changed_external_handler(self.sn, states)
+        elif self.output_changed_external_handler:
+            for index, state in states.items():
+                self.output_changed_external_handler(self.sn, index, state)
+
+    def update_output_bits(self, states):
+        """Records the written states {index: state} of the relays"""
+        for index, state in states.items():
+            bit = 1 << (index - 1)
+            self.known_bits |= bit
+            self.output_bits = self.output_bits | bit if state else self.output_bits & ~bit
+
+    def set_output_state(self, sn, index, state, force_notify=False):
         try:
             if not sn == self.sn: # Ignore if the serial number doesn't match
                 self.logger.debug(f'not my sn: {sn} vs {self.sn}')
                 return
-            command = self.command[self.command_indexes[index][state]]
+            command = coil_frame(index, bool(state)) if index else mask_frame(ALL_RELAYS if state else 0)
         except Exception as e:
             self.logger.exception('Failed obtaining command for index: {}, state {}'.format(index, state))
             return
-        if write_command_to_device() and self.output_changed_external_handler:
-            # Use "kitchen" as the channel name for relay outputs
-            self.output_changed_external_handler(self.sn, index, state)
+        with self.io_lock:
+            bit = 1 << (index - 1) if index else 0
+            if bit and self.known_bits & bit and bool(self.output_bits & bit) == bool(state):
+                written = True      # Already in that state according to the shadow register, just notify
+            else:
+                written = self.write_command(command)
+            if written:
+                self.update_output_bits({index: state} if index else dict.fromkeys(range(1, 17), state))
+        if written:
+            if self.output_changed_external_handler:
+                # Use "kitchen" as the channel name for relay outputs
+                self.output_changed_external_handler(self.sn, index, state)
+
+    def set_output_states(self, sn, states):
+        """
+        Sets several relays in one pass: only relays whose state differs from the last written state are set,
+        with a single multi-coil frame, and the changes are notified as one batch.
+        :param states: {index: state}, index 1-16
+        :return: {index: state} of the relays that changed
+        """
+        if not sn == self.sn:  # Ignore if the serial number doesn't match
+            self.logger.debug(f'not my sn: {sn} vs {self.sn}')
+            return {}
+        with self.io_lock:
+            changed = self.write_output_states(states)
+        if changed:
+            self.notify_outputs_change(changed)
+        return changed
+
+    def write_output_states(self, states):
+        """
+        Writes the relays of states that differ from the shadow register. Called with io_lock held.
+        :return: {index: state} of the relays that changed
+        """
+        changed = {}
+        requested_bits = 0
+        new_bits = self.output_bits
+        for index, state in states.items():
+            if not 1 <= index <= RELAYS:
+                self.logger.error('Invalid relay index: {}'.format(index))
+                continue
+            state = bool(state)
+            bit = 1 << (index - 1)
+            requested_bits |= bit
+            new_bits = new_bits | bit if state else new_bits & ~bit
+            if not (self.known_bits & bit and bool(self.output_bits & bit) == state):
+                changed[index] = state
+        if not changed:
+            return changed
+
+        if len(changed) > 1 and not ALL_RELAYS & ~(self.known_bits | requested_bits):
+            # One write for any combination. Only possible when the state of the relays not in the request is known,
+            # since the frame sets all the relays
+            if not self.write_command(mask_frame(new_bits)):
+                return {}
+            # The frame set all the relays, also if the shadow register was re-read by a reconnect meanwhile
+            self.output_bits = new_bits
+            self.known_bits = ALL_RELAYS
+        else:
+            written = {}
+            for index, state in changed.items():
+                if not self.write_command(coil_frame(index, state)):
+                    break
+                written[index] = state
+            changed = written
+        self.update_output_bits(changed)
+        return changed
 
     def test_allonoff(self):
         time.sleep(10)
@@ -0,0 +1,181 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+
+
+class SegmentSpool:
+    """
+    FIFO of byte records on disk, in append-only segment files (<directory>/<number>.seg).
+    Records are appended to the newest segment, which is rotated once it exceeds `segment_size` bytes, and read from the
+    oldest one, which is deleted once it is fully read. When the segments exceed `max_bytes`, the oldest segment is
+    deleted with its unread records, so the spool is bounded on disk while keeping the latest records.
+    A record is a length and a CRC-32 followed by the data; a torn record (e.g. power cut) ends its segment.
+    The read position is only kept in memory, and the segment being read is rewritten without its read records on
+    close(): after a crash, the records of a partly read segment are read again.
+    """
+    HEADER = struct.Struct('<II')       # data length, crc32 of the data
+    SUFFIX = '.seg'
+
+    def __init__(self, directory, segment_size=1 << 20, max_bytes=64 << 20):
+        """
+        :param directory: Directory of the segment files, created if needed
+        :param segment_size: Bytes after which the segment written is rotated
+        :param max_bytes: Max bytes of all the segments
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Numbers of the segments, oldest first, and their sizes
+        self.segments = sorted(int(name[:-len(self.SUFFIX)]) for name in os.listdir(directory) if name.endswith(self.SUFFIX))
+        self.sizes = {number: os.path.getsize(self.segment_path(number)) for number in self.segments}
+        self.size = sum(self.sizes.values())
+        self.writer = None
+        self.reader = None
+        self.read_number = None
+        self.next_record = None     # Record read ahead by peek()
+        self.count = self.count_records()
+        self.appended = 0
+        self.dropped = 0            # Records deleted unread by the size cap
+        if self.count:
+            self.logger.info('%i spooled records in %i segments', self.count, len(self.segments))
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, '%08i%s' % (number, self.SUFFIX))
+
+    def count_records(self):
+        count = 0
+        for number in self.segments:
+            with open(self.segment_path(number), 'rb') as f:
+                while self.read_record(f) is not None:
+                    count += 1
+        return count
+
+    def read_record(self, f):
+        """:return: The data of the next record of f, or None at the end of the segment (or at a torn record)"""
+        header = f.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return None
+        length, crc = self.HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) != crc:
+            return None
+        return data
+
+    def append(self, data):
+        record = self.HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_size:
+                self.rotate()
+            self.writer.write(record)
+            self.writer.flush()
+            self.sizes[self.segments[-1]] += len(record)
+            self.size += len(record)
+            self.count += 1
+            self.appended += 1
+            self.enforce_cap()
+
+    def rotate(self):
+        """Starts a new segment. Called with lock held"""
+        if self.writer:
+            self.writer.close()
+        number = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(number)
+        self.sizes[number] = 0
+        self.writer = open(self.segment_path(number), 'ab')
+
+    def enforce_cap(self):
+        """Deletes the oldest segments beyond max_bytes. Called with lock held"""
+        while len(self.segments) > 1 and self.size > self.max_bytes:
+            number = self.segments[0]
+            with open(self.segment_path(number), 'rb') as f:
+                if number == self.read_number:
+                    f.seek(self.reader.tell())
+                    unread = 1 if self.next_record is not None else 0
+                else:
+                    unread = 0
+                while self.read_record(f) is not None:
+                    unread += 1
+            self.delete_segment(number)
+            self.count -= unread
+            self.dropped += unread
+            self.logger.warning('Spool full, dropped %i records', unread)
+
+    def delete_segment(self, number):
+        """Called with lock held"""
+        if number == self.read_number:
+            self.reader.close()
+            self.reader = None
+            self.read_number = None
+            self.next_record = None
+        self.segments.remove(number)
+        self.size -= self.sizes.pop(number)
+        os.remove(self.segment_path(number))
+
+    def peek(self):
+        """:return: The oldest record, or None if the spool is empty"""
+        with self.lock:
+            while self.next_record is None and self.segments:
+                if self.reader is None:
+                    self.read_number = self.segments[0]
+                    self.reader = open(self.segment_path(self.read_number), 'rb')
+                position = self.reader.tell()
+                self.next_record = self.read_record(self.reader)
+                if self.next_record is None:
+                    if self.read_number == self.segments[-1]:
+                        # Reached the segment being written: read from here once more records are appended
+                        self.reader.seek(position)
+                        return None
+                    self.delete_segment(self.read_number)
+            return self.next_record
+
+    def pop(self):
+        """Removes the record returned by peek()"""
+        with self.lock:
+            if self.next_record is not None:
+                self.next_record = None
+                self.count -= 1
+                if not self.count:
+                    # All read: delete the segments, so a restart doesn't read them again
+                    if self.writer:
+                        self.writer.close()
+                        self.writer = None
+                    for number in list(self.segments):
+                        self.delete_segment(number)
+
+    def __len__(self):
+        return self.count
+
+    def metrics(self):
+        with self.lock:
+            return {'records': self.count, 'segments': len(self.segments), 'bytes': self.size,
+                    'appended': self.appended, 'dropped': self.dropped}
+
+    def close(self):
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            if self.reader:
+                self.drop_read_records()
+                self.reader.close()
+                self.reader = None
+                self.read_number = None
+                self.next_record = None
+
+    def drop_read_records(self):
+        """
+        Rewrites the segment being read without its records already read, so a restart doesn't read them again.
+        Called with lock held
+        """
+        unread = self.reader.read()
+        if self.next_record is not None:
+            unread = self.HEADER.pack(len(self.next_record), zlib.crc32(self.next_record)) + self.next_record + unread
+        path = self.segment_path(self.read_number)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(unread)
+        os.replace(path + '.tmp', path)
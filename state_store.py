@@ -0,0 +1,328 @@
+import dbm
+import logging
+import os
+import shelve
+import struct
+import threading
+import zlib
+
+from channel_states import ChannelStates
+
+STATES = 'states'
+DEFAULTS = 'defaults'
+
+
+class WriteBehind:
+    """
+    Coalesces state changes and writes them from a background thread.
+    Changes only mark keys as dirty; the flush callback is called with the set of dirty keys
+    every `interval` seconds, or as soon as `threshold` changes are pending.
+    An interval of 0 (or None) flushes synchronously on every change.
+    """
+
+    def __init__(self, flush_callback, interval=1.0, threshold=32, name='WriteBehind'):
+        """
+        :param flush_callback: Called with the set of dirty keys, from the flusher thread
+        :param interval: Max seconds a change waits before being flushed
+        :param threshold: Number of pending changes that triggers an immediate flush
+        :param name: Name of the flusher thread
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self.threshold = threshold
+        self.changes = 0        # Number of state changes marked dirty
+        self.flushes = 0        # Number of times the dirty keys were actually written
+        self._dirty = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()     # Serializes flushes from the flusher thread and close()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self, *keys):
+        """Records a change of the supplied keys. Never blocks on I/O unless running synchronously (or closed)."""
+        with self._lock:
+            self._dirty.update(keys)
+            self.changes += 1
+            self._pending += 1
+            flush_now = self._pending >= self.threshold
+        if not self._thread or self._closed:
+            # Synchronous, or a late change after close(): the flusher thread is gone
+            self.flush()
+        elif flush_now:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all dirty keys
+        :return: True if anything was written
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                self._pending = 0
+            if not dirty:
+                return False
+            try:
+                self.flush_callback(dirty)
+            except Exception:
+                self.logger.exception('Flush failed, will retry')
+                with self._lock:
+                    self._dirty |= dirty
+                return False
+            self.flushes += 1
+            return True
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stops the flusher thread and forces a final flush"""
+        self._closed = True
+        if self._thread:
+            self._wakeup.set()
+            self._thread.join(5)
+        self.flush()
+        self.logger.info('Closed: %i changes written in %i flushes', self.changes, self.flushes)
+
+    def metrics(self):
+        with self._lock:
+            pending = len(self._dirty)
+        return {'changes': self.changes, 'flushes': self.flushes, 'dirty': pending}
+
+
+# Output states stores
+# A store persists {STATES: ChannelStates, DEFAULTS: ChannelStates}.
+# Changes are described by entries: (STATES|DEFAULTS, sn, index), or (STATES|DEFAULTS, sn, None) for a whole device.
+# snapshot() is called while the states are locked and must be quick; write() does the actual I/O, without the lock.
+
+class ShelveStateStore:
+    """Pickles the full ChannelStates of every changed key into a shelve"""
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+
+    def load(self):
+        with shelve.open(self.path) as db:
+            return dict(db)
+
+    def snapshot(self, states, entries):
+        return {key: states[key].copy() for key in {entry[0] for entry in entries}}
+
+    def write(self, payload):
+        with shelve.open(self.path) as db:
+            db.update(payload)
+
+    def close(self):
+        pass
+
+
+def read_shelve_states(path):
+    """
+    Reads the states of an existing shelve db (used to migrate it to another store)
+    :return: The stored states, or None if there is no such db
+    """
+    if not dbm.whichdb(path):
+        return None
+    with shelve.open(path, 'r') as db:
+        return dict(db)
+
+
+class JournalStateStore:
+    """
+    Append-only journal of fixed-size records, one per (sn, index) change, on top of a snapshot file.
+    Every write() appends its records with a single write+fsync, so persisting a change is O(1).
+    Once the journal holds more than `compact_records` records, the full states are written to a new snapshot
+    and the journal restarts empty, which keeps the startup replay bounded.
+    A torn record at the end of the journal (e.g. power cut) fails its CRC and is discarded on replay.
+    """
+    HEADER = struct.Struct('<4sI')          # magic, generation
+    RECORD = struct.Struct('<BBHII')        # kind, value code, index, sn, crc32 of the preceding fields
+    JOURNAL_MAGIC = b'PHJ1'
+    SNAPSHOT_MAGIC = b'PHS1'
+    DEVICE = 0xFFFF                         # index of a record that clears a whole device
+    KINDS = [STATES, DEFAULTS]
+    DECODE = [None, False, True, '*']       # value code -> state. 0 (None) removes the entry
+    ENCODE = {False: 1, True: 2, '*': 3}    # 0/1 ints hash like False/True
+
+    def __init__(self, path, compact_records=4096, fsync=True, migrate_from=None):
+        """
+        :param path: Base path, the store uses path.journal and path.snapshot
+        :param compact_records: Journal length that triggers a compaction into a new snapshot
+        :param fsync: fsync the journal after every write (one fsync per batch of records)
+        :param migrate_from: Path of a shelve db to import if this store does not exist yet
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.journal_path = path + '.journal'
+        self.snapshot_path = path + '.snapshot'
+        self.compact_records = compact_records
+        self.fsync = fsync
+        self.migrate_from = migrate_from
+        self.generation = 0
+        self.records = 0            # Records in the current journal
+        self.journal = None
+
+    # Encoding
+    def encode(self, kind, sn, index, state):
+        fields = (kind, self.ENCODE.get(state, 0), index, int(sn))
+        return self.RECORD.pack(*fields, zlib.crc32(struct.pack('<BBHI', *fields)))
+
+    def iter_records(self, data):
+        """Yields decoded (kind, sn, index, code) until the end of data or the first corrupt record"""
+        for offset in range(0, len(data) - self.RECORD.size + 1, self.RECORD.size):
+            kind, code, index, sn, crc = self.RECORD.unpack_from(data, offset)
+            if crc != zlib.crc32(data[offset:offset + self.RECORD.size - 4]) or kind >= len(self.KINDS) or code >= len(self.DECODE):
+                return
+            yield kind, sn, index, code
+
+    def encode_states(self, states, kind, sn=None):
+        """Encodes all the entries of a ChannelStates (or of a single device)"""
+        if sn is None:
+            devices = states.items()
+        else:
+            devices = [(sn, states[sn])] if sn in states else []
+        return [self.encode(kind, device_sn, index, state)
+                for device_sn, channels in devices for index, state in channels.items()]
+
+    # Files
+    def read_file(self, path, magic):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, b''
+        if len(data) < self.HEADER.size:
+            return None, b''
+        file_magic, generation = self.HEADER.unpack_from(data)
+        if file_magic != magic:
+            self.logger.error('%s: bad magic %r, ignored', path, file_magic)
+            return None, b''
+        return generation, data[self.HEADER.size:]
+
+    def replace_file(self, path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.fsync_dir(path)
+
+    def fsync_dir(self, path):
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def open_journal(self, generation):
+        """Starts a new, empty journal for the given snapshot generation"""
+        if self.journal:
+            self.journal.close()
+        self.replace_file(self.journal_path, self.HEADER.pack(self.JOURNAL_MAGIC, generation))
+        self.journal = open(self.journal_path, 'ab')
+        self.records = 0
+
+    def compact(self, records):
+        """Writes the full states as a new snapshot and starts a new journal"""
+        self.generation += 1
+        self.replace_file(self.snapshot_path, self.HEADER.pack(self.SNAPSHOT_MAGIC, self.generation) + b''.join(records))
+        # A crash right here leaves a journal of the previous generation, which load() ignores since the snapshot has it all
+        self.open_journal(self.generation)
+        self.logger.info('Compacted %i records into snapshot #%i', len(records), self.generation)
+
+    # Store interface
+    def load(self):
+        states = {STATES: ChannelStates(), DEFAULTS: ChannelStates()}
+        snapshot_generation, snapshot = self.read_file(self.snapshot_path, self.SNAPSHOT_MAGIC)
+        journal_generation, journal = self.read_file(self.journal_path, self.JOURNAL_MAGIC)
+
+        if snapshot_generation is None and journal_generation is None and self.migrate_from:
+            migrated = read_shelve_states(self.migrate_from)
+            if migrated:
+                self.logger.warning('Migrating output states from shelve %s', self.migrate_from)
+                for key in self.KINDS:
+                    if key in migrated:
+                        states[key] = migrated[key].copy()
+                self.compact(self.encode_states(states[STATES], 0) + self.encode_states(states[DEFAULTS], 1))
+                return states
+
+        self.generation = snapshot_generation or 0
+        count = 0
+        for kind, sn, index, code in self.iter_records(snapshot):
+            states[self.KINDS[kind]].set_state(sn, index, self.DECODE[code])
+        if journal_generation == self.generation:
+            for kind, sn, index, code in self.iter_records(journal):
+                count += 1
+                if index == self.DEVICE:
+                    states[self.KINDS[kind]].del_sn(sn)
+                elif code:
+                    states[self.KINDS[kind]].set_state(sn, index, self.DECODE[code])
+                else:
+                    states[self.KINDS[kind]].del_state(sn, index)
+            if count * self.RECORD.size != len(journal):
+                self.logger.warning('Discarded %i bytes of torn journal records', len(journal) - count * self.RECORD.size)
+        elif journal_generation is not None:
+            self.logger.info('Ignoring journal of old generation #%i', journal_generation)
+
+        # Start from a fresh snapshot, so the replay of the next startup is bounded as well
+        self.compact(self.encode_states(states[STATES], 0) + self.encode_states(states[DEFAULTS], 1))
+        self.logger.info('Replayed %i journal records', count)
+        return states
+
+    def snapshot(self, states, entries):
+        if self.records + len(entries) > self.compact_records:
+            return True, self.encode_states(states[STATES], 0) + self.encode_states(states[DEFAULTS], 1)
+        records = []
+        for key, sn, index in entries:
+            kind = self.KINDS.index(key)
+            if index is None:
+                records.append(self.encode(kind, sn, self.DEVICE, None))
+                records.extend(self.encode_states(states[key], kind, sn))
+            else:
+                records.append(self.encode(kind, sn, index, states[key].get_state(sn, index)))
+        return False, records
+
+    def write(self, payload):
+        compact, records = payload
+        if compact:
+            self.compact(records)
+            return
+        if not self.journal:
+            self.open_journal(self.generation)
+        self.journal.write(b''.join(records))
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        self.records += len(records)
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+
+def create_state_store(backend, path, **kwargs):
+    """
+    :param backend: 'shelve' or 'journal'
+    :param path: Path of the shelve db. The journal store uses it as its base path, and migrates it if found.
+    """
+    if backend == 'journal':
+        return JournalStateStore(path, migrate_from=path, **kwargs)
+    if backend == 'shelve':
+        return ShelveStateStore(path)
+    raise ValueError('Unknown states backend: %s' % backend)
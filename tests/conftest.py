@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeTimers:
+    """TimerService driven by the test: advance() moves the fake clock and runs the timers due, in deadline order"""
+
+    def __init__(self, name='Timers'):
+        self.now = 0.0
+        self.heap = []          # [deadline, sequence, fn, args], as TimerService
+        self.counter = itertools.count()
+
+    def monotonic(self):
+        return self.now
+
+    def call_later(self, delay, fn, *args):
+        timer = [self.now + delay, next(self.counter), fn, args]
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def pending(self):
+        return sum(1 for timer in self.heap if timer[2])
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while self.heap and self.heap[0][0] <= end:
+            deadline, _, fn, args = heapq.heappop(self.heap)
+            self.now = max(self.now, deadline)
+            if fn:
+                fn(*args)
+        self.now = end
+
+    def drain(self):
+        timers, self.heap = sorted(self.heap), []
+        return [(fn, args) for _, _, fn, args in timers if fn]
+
+    def close(self):
+        pass
+
+
+class PublishInfo:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class FakeMQTTClient:
+    """
+    paho Client recording the publishes. A publish is reported sent (on_publish) at once, unless hold_acks is set,
+    and returns rc (0: success)
+    """
+
+    def __init__(self):
+        self.published = []         # [(topic, payload, retain)]
+        self.subscribed = []
+        self.on_publish = None
+        self.hold_acks = False
+        self.rc = 0
+        self.mid = 0
+        self.max_inflight = self.max_queued = None
+
+    def max_inflight_messages_set(self, inflight):
+        self.max_inflight = inflight
+
+    def max_queued_messages_set(self, queue_size):
+        self.max_queued = queue_size
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    def publish(self, topic, payload, retain=False):
+        self.mid += 1
+        if self.rc == 0:
+            self.published.append((topic, payload, retain))
+            if self.on_publish and not self.hold_acks:
+                self.on_publish(self, None, self.mid)
+        return PublishInfo(self.rc)
+
+
+@pytest.fixture
+def timers():
+    return FakeTimers()
+
+
+@pytest.fixture
+def mqtt_client():
+    return FakeMQTTClient()
@@ -0,0 +1,202 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('requests')
+
+import asynchttp
+from asynchttp import AsyncHttp, CircuitBreaker, RequestDetails
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.received.append(self.rfile.read(int(self.headers['Content-Length'])))
+        # /status/<code> answers <code>
+        self.send_response(int(self.path.rsplit('/', 1)[1]) if self.path.startswith('/status/') else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.received = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_dead_destination_does_not_block_others(tmp_path, server):
+    http = AsyncHttp(workers=2, max_queued=1, timeout=1, backoff=30, failure_threshold=2, reset_timeout=60,
+                     spool_path=str(tmp_path))
+    dead = 'http://127.0.0.1:%i/events' % closed_port()
+    alive = 'http://127.0.0.1:%i/events' % server.server_port
+    for i in range(10):
+        assert http.request('POST', dead, {'i': i}, 'token')
+    assert wait_for(lambda: http.metrics()['open_circuits'])
+    for i in range(10):
+        assert http.request('POST', alive, {'i': i}, 'token')
+
+    assert wait_for(lambda: len(server.received) == 10)
+    spool = http.metrics()['spool']
+    assert spool[dead.rsplit('/', 1)[0]]['records'] > 0
+    assert spool[alive.rsplit('/', 1)[0]]['records'] == 0
+
+    # The requests to the dead destination, including the retries waiting for their backoff, are kept
+    http.close()
+    http = AsyncHttp(spool_path=str(tmp_path))
+    assert {destination: len(spool) for destination, spool in http.spools.items()} == {
+        dead.rsplit('/', 1)[0]: 10, alive.rsplit('/', 1)[0]: 0}
+    http.close()
+
+
+def test_destination_in_order(server):
+    http = AsyncHttp(workers=4)
+    url = 'http://127.0.0.1:%i/events' % server.server_port
+    for i in range(50):
+        assert http.request('POST', url, {'i': i}, 'token')
+    assert wait_for(lambda: len(server.received) == 50)
+    http.close()
+    assert [json.loads(body)['i'] for body in server.received] == list(range(50))
+    # One kept-alive session per destination
+    assert http.metrics()['sessions'] == 1
+
+
+def test_circuit_breaker(monkeypatch, timers):
+    monkeypatch.setattr(asynchttp, 'time', timers)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    assert not breaker.failure()
+    assert breaker.allow()
+    assert breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.shedding()
+    assert not breaker.allow()
+    timers.advance(30)
+    assert not breaker.shedding()
+    # A single trial request
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    # Failed: open again, at once
+    assert breaker.failure()
+    assert not breaker.allow()
+    timers.advance(30)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    assert breaker.opened == 2
+    # Consecutive failures only
+    assert not breaker.failure()
+    breaker.success()
+    assert not breaker.failure()
+
+
+@pytest.mark.parametrize('jitter', ['min', 'max'])
+def test_backoff_bounds(monkeypatch, timers, jitter):
+    monkeypatch.setattr(asynchttp, 'TimerService', lambda name: timers)
+    monkeypatch.setattr(asynchttp.random, 'uniform', lambda a, b: a if jitter == 'min' else b)
+    http = AsyncHttp(workers=1, max_retries=6, backoff=1, max_backoff=10)
+    details = RequestDetails('POST', 'http://127.0.0.1/events', {}, 'token')
+    for attempts in range(1, 8):
+        details.attempts = attempts
+        http.schedule_retry(details)
+    # backoff * 2^n capped at max_backoff, with the jitter in the upper half. The clock is at 0: deadlines are delays
+    expected = [1, 2, 4, 8, 10, 10]
+    assert sorted(timer[0] for timer in timers.heap) == (expected if jitter == 'max' else [delay / 2 for delay in expected])
+    timers.drain()
+    assert http.given_up == 1
+    assert http.retried == 6
+    http.close()
+
+
+def test_client_error_not_retried(server):
+    http = AsyncHttp(workers=1, backoff=60, failure_threshold=1)
+    base = 'http://127.0.0.1:%i/status/' % server.server_port
+    assert http.request('POST', base + '404', {}, 'token')
+    assert wait_for(lambda: len(server.received) == 1)
+    assert wait_for(lambda: http.pool.metrics()['completed'] == 1)
+    # The destination is up: its circuit stays closed
+    assert http.retried == 0
+    assert http.metrics()['open_circuits'] == []
+    assert http.request('POST', base + '503', {}, 'token')
+    assert wait_for(lambda: http.retried == 1)
+    assert http.metrics()['open_circuits'] == ['http://127.0.0.1:%i' % server.server_port]
+    http.close()
+
+
+def received_batches(server, count):
+    assert wait_for(lambda: len(server.received) >= count)
+    return [[event['data']['i'] for event in json.loads(body)] for body in server.received]
+
+
+def test_batch_linger_and_size(monkeypatch, timers, server):
+    monkeypatch.setattr(asynchttp, 'TimerService', lambda name: timers)
+    http = AsyncHttp(workers=1, batch_linger=1, batch_size=3)
+    url = 'http://127.0.0.1:%i/events' % server.server_port
+    for i in range(2):
+        http.request('POST', url, {'i': i}, 'token')
+    timers.advance(0.5)
+    assert server.received == []
+    timers.advance(0.5)
+    assert received_batches(server, 1) == [[0, 1]]
+    # Full: sent without waiting for the linger time
+    for i in range(2, 5):
+        http.request('POST', url, {'i': i}, 'token')
+    assert received_batches(server, 2) == [[0, 1], [2, 3, 4]]
+    timers.advance(0.5)
+    http.request('POST', url, {'i': 5}, 'token')
+    # The linger timer of the full batch must not send the next batch early
+    timers.advance(0.5)
+    time.sleep(0.1)
+    assert len(server.received) == 2
+    timers.advance(0.5)
+    assert received_batches(server, 3) == [[0, 1], [2, 3, 4], [5]]
+    assert http.metrics()['batches'] == 3
+    assert http.metrics()['batched'] == 6
+    http.close()
+
+
+def test_batches_per_url_and_token(monkeypatch, timers, server):
+    monkeypatch.setattr(asynchttp, 'TimerService', lambda name: timers)
+    http = AsyncHttp(workers=1, batch_linger=1)
+    url = 'http://127.0.0.1:%i/events' % server.server_port
+    http.request('POST', url, {'i': 0}, 'a')
+    http.request('POST', url, {'i': 1}, 'b')
+    http.request('POST', url, {'i': 2}, 'a')
+    # Not batched
+    http.request('GET', url + '?i=3', None, 'a')
+    assert wait_for(lambda: http.pool.metrics()['completed'] == 1)
+    assert server.received == []
+    assert http.retried == 0
+    # close() sends the batches still lingering
+    http.close()
+    assert sorted(received_batches(server, 2)) == [[0, 2], [1]]
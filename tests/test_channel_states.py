@@ -0,0 +1,75 @@
+import pickle
+import shelve
+
+import pytest
+
+import channel_states
+from channel_states import ChannelStates
+
+
+class LegacyChannelStates(dict):
+    """The dict-based ChannelStates, keyed by str sn and index, that older versions pickled into the shelve"""
+    __slots__ = ()
+
+
+LegacyChannelStates.__module__ = 'channel_states'
+LegacyChannelStates.__name__ = LegacyChannelStates.__qualname__ = 'ChannelStates'
+
+LEGACY_STATES = {'1234': {'0': True, '2': False, '5': '*'}, '5678': {}}
+
+
+def pickle_legacy(monkeypatch, dump):
+    """Pickles LEGACY_STATES with the legacy class, as channel_states.ChannelStates"""
+    with monkeypatch.context() as m:
+        m.setattr(channel_states, 'ChannelStates', LegacyChannelStates)
+        dump(LegacyChannelStates(LEGACY_STATES))
+
+
+def check_loaded(states):
+    assert isinstance(states, ChannelStates)
+    assert states.get_state(1234, 0) is True
+    assert states.get_state('1234', '2') is False
+    assert states.get_state(1234, 5) == '*'
+    assert states.get_state(1234, 1) is None
+    assert 5678 in states
+    assert dict(states.items()) == {1234: {0: True, 2: False, 5: '*'}, 5678: {}}
+
+
+@pytest.mark.parametrize('protocol', range(2, pickle.HIGHEST_PROTOCOL + 1))
+def test_loads_legacy_pickle(monkeypatch, protocol):
+    data = []
+    pickle_legacy(monkeypatch, lambda states: data.append(pickle.dumps(states, protocol)))
+    check_loaded(pickle.loads(data[0]))
+
+
+def test_loads_legacy_shelve(monkeypatch, tmp_path):
+    path = str(tmp_path / 'states')
+
+    def dump(states):
+        with shelve.open(path) as db:
+            db['states'] = states
+
+    pickle_legacy(monkeypatch, dump)
+    with shelve.open(path) as db:
+        check_loaded(db['states'])
+
+
+def test_pickle_roundtrip():
+    states = ChannelStates({1234: {0: True, 31: '*'}})
+    states.set_state(1234, 64, False)
+    loaded = pickle.loads(pickle.dumps(states))
+    assert loaded.devices == states.devices
+    assert loaded[1234] == {0: True, 31: '*', 64: False}
+
+
+def test_invalid_sn_or_index():
+    # As the dict-based version: not found, and nothing stored
+    states = ChannelStates({1234: {0: True}})
+    assert states.get_state('abc', 0) is None
+    assert states.get_state(None, 0) is None
+    assert states.get_state(1234, 'x') is None
+    assert states.get_state(1234, -1) is None
+    states.set_state('abc', 0, True)
+    states.set_state(1234, 'x', True)
+    states.set_state(1234, -1, True)
+    assert dict(states.items()) == {1234: {0: True}}
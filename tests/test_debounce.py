@@ -0,0 +1,134 @@
+import pytest
+
+import debounce
+from debounce import Debouncer
+
+SN = 1234
+
+
+@pytest.fixture
+def make_debouncer(monkeypatch, timers):
+    """Builds Debouncers on the fake timers and clock, recording (time, index, state) of the changes passed on"""
+    monkeypatch.setattr(debounce, 'time', timers)
+
+    def make_debouncer(**kwargs):
+        changes = []
+        debouncer = Debouncer(lambda sn, index, state: changes.append((timers.now, index, state)), timers=timers, **kwargs)
+        debouncer.changes = changes
+        return debouncer
+
+    return make_debouncer
+
+
+def test_passes_through_by_default(make_debouncer):
+    debouncer = make_debouncer()
+    for state in (True, False, False, True):
+        debouncer.input_changed(SN, 0, state)
+    assert debouncer.changes == [(0, 0, True), (0, 0, False), (0, 0, False), (0, 0, True)]
+    assert debouncer.metrics() == {'events': 4, 'emitted': 4, 'glitches': 0, 'pending': 0}
+
+
+def test_stable_time(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    assert debouncer.changes == []
+    timers.advance(0.125)
+    assert debouncer.changes == [(0.25, 0, True)]
+
+
+def test_glitch(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.input_changed(SN, 0, False)
+    timers.advance(0.25)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    # Back to the state passed on: never reaches the handler
+    debouncer.input_changed(SN, 0, False)
+    timers.advance(1)
+    assert debouncer.changes == [(0.25, 0, False)]
+    assert debouncer.channel_metrics(SN, 0) == {'events': 3, 'glitches': 1}
+    assert debouncer.metrics()['pending'] == 0
+    assert timers.pending() == 0
+
+
+def test_repeated_state_restarts_stable_time(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    assert debouncer.changes == []
+    timers.advance(0.125)
+    assert debouncer.changes == [(0.375, 0, True)]
+
+
+def test_min_pulse(make_debouncer, timers):
+    debouncer = make_debouncer(min_pulse=0.25)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    debouncer.input_changed(SN, 0, False)
+    assert debouncer.changes == [(0, 0, True)]
+    # Held back until the pulse time is over, then passed on as the latest state
+    timers.advance(0.125)
+    assert debouncer.changes == [(0, 0, True), (0.25, 0, False)]
+    timers.advance(1)
+    debouncer.input_changed(SN, 0, True)
+    assert debouncer.changes[-1] == (1.25, 0, True)
+
+
+def test_min_pulse_glitch(make_debouncer, timers):
+    debouncer = make_debouncer(min_pulse=0.25)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    debouncer.input_changed(SN, 0, False)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(1)
+    assert debouncer.changes == [(0, 0, True)]
+    assert debouncer.metrics()['glitches'] == 1
+
+
+def test_stable_time_and_min_pulse(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.125, min_pulse=0.5)
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.125)
+    debouncer.input_changed(SN, 0, False)
+    # Stable at 0.25, but the pulse time of the edge at 0.125 is over at 0.625
+    timers.advance(0.25)
+    assert debouncer.changes == [(0.125, 0, True)]
+    timers.advance(0.25)
+    assert debouncer.changes == [(0.125, 0, True), (0.625, 0, False)]
+
+
+def test_fired_timer_of_previous_generation_ignored(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.input_changed(SN, 0, True)
+    generation = debouncer.channels[(SN, 0)].generation
+    timers.advance(0.125)
+    debouncer.input_changed(SN, 0, True)
+    # The cancelled timer was already running on the timer thread
+    debouncer.on_timer((SN, 0), generation)
+    assert debouncer.changes == []
+    timers.advance(0.25)
+    assert debouncer.changes == [(0.375, 0, True)]
+
+
+def test_configure_channel(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.configure(SN, 1, stable_time=0)
+    debouncer.input_changed(SN, 0, True)
+    debouncer.input_changed(SN, 1, True)
+    assert debouncer.changes == [(0, 1, True)]
+    # Back to the defaults
+    debouncer.configure(SN, 1)
+    debouncer.input_changed(SN, 1, False)
+    timers.advance(0.25)
+    assert debouncer.changes == [(0, 1, True), (0.25, 0, True), (0.25, 1, False)]
+
+
+def test_failed_handler(make_debouncer, timers):
+    debouncer = make_debouncer(stable_time=0.25)
+    debouncer.handler = lambda sn, index, state: 1 / 0
+    debouncer.input_changed(SN, 0, True)
+    timers.advance(0.25)
+    assert debouncer.metrics()['emitted'] == 1
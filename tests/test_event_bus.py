@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from event_bus import EventBus, EventCounter, DROP_OLDEST, DROP_NEWEST, INPUT, OUTPUT, ATTACHED
+
+
+class BlockingSink:
+    """Records the indexes it receives, and blocks on its first batch until released"""
+
+    def __init__(self):
+        self.indexes = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, batch):
+        self.entered.set()
+        self.release.wait(5)
+        self.indexes.extend(record[1] for record in batch)
+
+
+def fill_behind_blocked_sink(overflow):
+    """Publishes 11 events on a bus of 4 records, while its sink is stuck on the first one"""
+    bus = EventBus(capacity=4, overflow=overflow)
+    sink = BlockingSink()
+    bus.subscribe('slow', sink, batch_size=1)
+    bus.publish(1234, 0, OUTPUT, True)
+    assert sink.entered.wait(5)
+    published = [bus.publish(1234, index, OUTPUT, True) for index in range(1, 11)]
+    sink.release.set()
+    bus.close()
+    return bus, sink, published
+
+
+def test_delivers_in_order_to_every_sink():
+    bus = EventBus(capacity=16)
+    received = {'a': [], 'b': []}
+    bus.subscribe('a', lambda batch: received['a'].extend(batch), batch_size=3)
+    bus.subscribe('b', lambda batch: received['b'].extend(batch))
+    for index in range(10):
+        assert bus.publish(1234, index, INPUT, index % 2 == 0)
+    bus.close()
+    for records in received.values():
+        assert [record[:4] for record in records] == [(1234, index, INPUT, index % 2 == 0) for index in range(10)]
+    assert bus.metrics()['sinks']['a']['batches'] >= 4
+
+
+def test_drop_oldest():
+    bus, sink, published = fill_behind_blocked_sink(DROP_OLDEST)
+    assert all(published)
+    # The sink skipped the events overwritten while it was stuck, and got the latest ones
+    assert sink.indexes == [0, 7, 8, 9, 10]
+    metrics = bus.metrics()
+    assert metrics['published'] == 11
+    assert metrics['rejected'] == 0
+    assert metrics['sinks']['slow']['lost'] == 6
+    assert metrics['sinks']['slow']['consumed'] == 5
+
+
+def test_drop_newest():
+    bus, sink, published = fill_behind_blocked_sink(DROP_NEWEST)
+    assert published == [True] * 4 + [False] * 6
+    assert sink.indexes == [0, 1, 2, 3, 4]
+    metrics = bus.metrics()
+    assert metrics['published'] == 5
+    assert metrics['rejected'] == 6
+    assert metrics['sinks']['slow']['lost'] == 0
+
+
+def test_failing_sink():
+    bus = EventBus()
+
+    def handler(batch):
+        raise RuntimeError('sink down')
+
+    bus.subscribe('failing', handler)
+    bus.publish(1234, 0, INPUT, True)
+    bus.close()
+    assert bus.metrics()['sinks']['failing']['failed'] == 1
+
+
+def test_unknown_overflow():
+    with pytest.raises(ValueError):
+        EventBus(overflow='block')
+
+
+def test_event_counter():
+    counter = EventCounter()
+    counter([(1234, 0, INPUT, True, 0.0), (1234, 1, INPUT, False, 0.0), (1234, 0, ATTACHED, 'Output', 0.0)])
+    assert counter.metrics() == {'input': 2, 'output': 0, 'attached': 1, 'detached': 0}
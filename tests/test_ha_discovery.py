@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from ha_discovery import DiscoveryManager
+
+
+@pytest.fixture
+def discovery(timers):
+    publishes = []
+    discovery = DiscoveryManager(lambda topic, payload: publishes.append((topic, json.loads(payload))), timers,
+                                 linger=0.5, pace=0.1)
+    discovery.publishes = publishes
+    return discovery
+
+
+def test_burst_after_linger(discovery, timers):
+    for index in range(3):
+        discovery.announce('config/%i' % index, {'index': index})
+    timers.advance(0.4)
+    assert discovery.publishes == []
+    timers.advance(0.1)
+    assert discovery.publishes == [('config/0', {'index': 0})]
+    # Paced, in announcement order
+    timers.advance(0.1)
+    assert [topic for topic, config in discovery.publishes] == ['config/0', 'config/1']
+    timers.advance(1)
+    assert [topic for topic, config in discovery.publishes] == ['config/0', 'config/1', 'config/2']
+    assert discovery.metrics()['bursts'] == 1
+    assert timers.pending() == 0
+
+
+def test_skips_unchanged_configs(discovery, timers):
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    assert discovery.publishes == [('config/0', {'name': 'a'})]
+    assert discovery.unchanged == 1
+    discovery.announce('config/0', {'name': 'b'})
+    timers.advance(1)
+    assert discovery.publishes[-1] == ('config/0', {'name': 'b'})
+
+
+def test_pending_config_changed_back(discovery, timers):
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    # Changed and changed back before the burst: nothing to publish
+    discovery.announce('config/0', {'name': 'b'})
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    assert discovery.publishes == [('config/0', {'name': 'a'})]
+
+
+def test_forget(discovery, timers):
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    # The publish was dropped: the next announcement publishes it again
+    discovery.forget('config/0')
+    discovery.announce('config/0', {'name': 'a'})
+    timers.advance(1)
+    assert discovery.publishes == [('config/0', {'name': 'a'})] * 2
+    assert discovery.unchanged == 0
+
+
+def test_republish(discovery, timers):
+    discovery.announce('config/0', {'name': 'a'})
+    discovery.announce('config/1', {'name': 'b'})
+    timers.advance(1)
+    discovery.republish()
+    timers.advance(1)
+    assert [topic for topic, config in discovery.publishes] == ['config/0', 'config/1'] * 2
+    assert discovery.metrics() == {'configs': 2, 'pending': 0, 'announced': 2, 'unchanged': 0, 'bursts': 2}
+
+
+def test_failed_publish_continues_burst(timers):
+    publishes = []
+
+    def publish(topic, payload):
+        if topic == 'config/0':
+            raise ConnectionError('lost')
+        publishes.append(topic)
+
+    discovery = DiscoveryManager(publish, timers, linger=0.5, pace=0.1)
+    discovery.announce('config/0', {})
+    discovery.announce('config/1', {})
+    timers.advance(1)
+    assert publishes == ['config/1']
@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('paho.mqtt.client')
+
+import ha_mqtt
+from ha_mqtt import HAMQTTClient
+
+SN = 1234
+
+
+@pytest.fixture
+def make_client(monkeypatch, timers, mqtt_client):
+    """Builds connected HAMQTTClients on the fake paho client, their timers driven by the test"""
+    monkeypatch.setattr(ha_mqtt.mqtt, 'Client', lambda: mqtt_client)
+    monkeypatch.setattr(ha_mqtt, 'TimerService', lambda name: timers)
+    clients = []
+
+    def make_client(**kwargs):
+        client = HAMQTTClient('localhost', **kwargs)
+        client.connect()
+        client.on_connect(mqtt_client, None, {}, 0)
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.close()
+
+
+def published(client):
+    """
+    Waits for the publisher to send the messages queued so far
+    :return: [(topic, state)] of the state messages published
+    """
+    # The discovery lane is the last one: once its sentinel is sent, the messages queued before it were sent too
+    sentinel = 'test/sentinel/%i' % len(client.client.published)
+    client.publish(sentinel, '', retain=False, lane=ha_mqtt.DISCOVERY)
+    for _ in range(500):
+        if any(message[0] == sentinel for message in client.client.published):
+            break
+        time.sleep(0.01)
+    return [(topic, json.loads(payload)['state']) for topic, payload, retain in client.client.published
+            if topic.endswith('/state')]
+
+
+def state_topic(index=0, channel_type='input'):
+    return 'phidget/%i/%s/%i/state' % (SN, channel_type, index)
+
+
+def test_suppresses_retained_duplicates(make_client):
+    client = make_client()
+    for state in (True, True, False, True):
+        client.publish_input_state(SN, 0, state)
+        published(client)           # Else the lane collapses the queued states
+    assert published(client) == [(state_topic(), 'ON'), (state_topic(), 'OFF'), (state_topic(), 'ON')]
+    assert client.suppressed == 1
+
+
+def test_reconnect_publishes_retained_again(make_client, mqtt_client):
+    client = make_client()
+    client.publish_input_state(SN, 0, True)
+    published(client)
+    client.on_disconnect(mqtt_client, None, 0)
+    client.on_connect(mqtt_client, None, {}, 0)
+    # The broker may have lost it
+    client.publish_input_state(SN, 0, True)
+    assert published(client) == [(state_topic(), 'ON')] * 2
+
+
+def test_dropped_publish_not_suppressed(make_client):
+    client = make_client()
+    client.publish_input_state(SN, 0, True)
+    published(client)
+    client.on_publish_dropped(state_topic())
+    client.publish_input_state(SN, 0, True)
+    assert published(client) == [(state_topic(), 'ON')] * 2
+    assert client.suppressed == 0
+
+
+def test_coalesces_within_window(make_client, timers):
+    client = make_client(coalesce_window=1)
+    for state in (True, False, True, False):
+        client.publish_input_state(SN, 0, state)
+    # The first change at once, the latest one at the end of the window
+    assert published(client) == [(state_topic(), 'ON')]
+    timers.advance(1)
+    assert published(client) == [(state_topic(), 'ON'), (state_topic(), 'OFF')]
+    assert client.coalesced == 2
+    # The window is over: the next change is published at once
+    client.publish_input_state(SN, 0, True)
+    assert published(client)[-1] == (state_topic(), 'ON')
+
+
+def test_coalesced_back_to_published_state(make_client, timers):
+    client = make_client(coalesce_window=1)
+    for state in (True, False, True):
+        client.publish_input_state(SN, 0, state)
+    timers.advance(1)
+    # The latest state is the one published at the start of the window
+    assert published(client) == [(state_topic(), 'ON')]
+    assert client.suppressed == 1
+
+
+def test_coalesce_window_per_channel(make_client, timers):
+    client = make_client(coalesce_window=1)
+    client.set_coalesce_window('Input', SN, 1, 0)
+    for state in (True, False):
+        client.publish_input_state(SN, 0, state)
+        client.publish_input_state(SN, 1, state)
+        published(client)
+    assert published(client) == [(state_topic(0), 'ON'), (state_topic(1), 'ON'), (state_topic(1), 'OFF')]
+    # Back to the default window
+    client.set_coalesce_window('Input', SN, 1, None)
+    timers.advance(1)
+    for state in (True, False):
+        client.publish_input_state(SN, 1, state)
+        published(client)
+    assert published(client)[3:] == [(state_topic(0), 'OFF'), (state_topic(1), 'ON')]
+
+
+def config_publishes(client):
+    published(client)
+    return [topic for topic, payload, retain in client.client.published if topic.endswith('/config')]
+
+
+def test_dropped_discovery_published_again(make_client, mqtt_client, timers):
+    client = make_client()
+    config_topic = 'homeassistant/binary_sensor/phidget_%i_input_0/config' % SN
+    mqtt_client.rc = 4              # MQTT_ERR_NO_CONN
+    client.publish_channel_attached(SN, 0, 'Input')
+    timers.advance(1)
+    for _ in range(500):
+        if client.publisher.failed:
+            break
+        time.sleep(0.01)
+    mqtt_client.rc = 0
+    assert config_publishes(client) == []
+    # The attach of the channel announces the same config again
+    client.publish_channel_attached(SN, 0, 'Input')
+    timers.advance(1)
+    assert config_publishes(client) == [config_topic]
+    client.publish_channel_attached(SN, 0, 'Input')
+    timers.advance(1)
+    assert config_publishes(client) == [config_topic]
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def test_output_command(make_client, mqtt_client):
+    client = make_client()
+    assert mqtt_client.subscribed == ['phidget/+/output/+/command']
+    commands = []
+    done = threading.Event()
+    client.output_callback = lambda sn, index, state: (commands.append((sn, index, state)), done.set())
+    client.on_message(mqtt_client, None, Message('phidget/1234/output/3/command', b'ON'))
+    client.on_message(mqtt_client, None, Message('phidget/1234/output/3/other', b'ON'))
+    assert done.wait(5)
+    client.commands.close()
+    # The sn is passed as in the topic
+    assert commands == [('1234', 3, True)]
+
+
+def test_bad_command_ignored(make_client, mqtt_client):
+    client = make_client()
+    client.output_callback = lambda sn, index, state: None
+    client.on_message(mqtt_client, None, Message('phidget/1234/output/x/command', b'ON'))
+    assert client.commands.metrics()['submitted'] == 0
+
+
+def test_offline_flush_paced(make_client, mqtt_client, timers):
+    client = make_client(offline_burst=2, offline_pace=0.5)
+    client.on_disconnect(mqtt_client, None, 0)
+    for state in (True, False):
+        for index in range(5):
+            client.publish_input_state(SN, index, state)
+    assert mqtt_client.published == []
+    assert len(client.offline) == 5
+    client.on_connect(mqtt_client, None, {}, 0)
+    timers.advance(0)
+    assert published(client) == [(state_topic(index), 'OFF') for index in range(2)]
+    timers.advance(0.5)
+    assert len(published(client)) == 4
+    timers.advance(0.5)
+    assert published(client) == [(state_topic(index), 'OFF') for index in range(5)]
+    assert not client.offline_flushing
+    assert timers.pending() == 0
+
+
+def test_publish_during_offline_flush(make_client, mqtt_client, timers):
+    client = make_client(offline_burst=1, offline_pace=0.5)
+    client.on_disconnect(mqtt_client, None, 0)
+    client.publish_input_state(SN, 0, True)
+    client.publish_input_state(SN, 1, True)
+    client.on_connect(mqtt_client, None, {}, 0)
+    timers.advance(0)
+    # Newer than the buffered state of input 1, which must not overwrite it
+    client.publish_input_state(SN, 1, False)
+    timers.advance(1)
+    assert published(client) == [(state_topic(0), 'ON'), (state_topic(1), 'OFF')]
+    assert len(client.offline) == 0
+
+
+def test_disconnect_during_offline_flush(make_client, mqtt_client, timers):
+    client = make_client(offline_burst=1, offline_pace=0.5)
+    client.on_disconnect(mqtt_client, None, 0)
+    for index in range(3):
+        client.publish_input_state(SN, index, True)
+    client.on_connect(mqtt_client, None, {}, 0)
+    timers.advance(0)
+    client.on_disconnect(mqtt_client, None, 0)
+    timers.advance(1)
+    assert len(client.offline) == 2
+    assert not client.offline_flushing
+    client.on_connect(mqtt_client, None, {}, 0)
+    timers.advance(1)
+    assert published(client) == [(state_topic(index), 'ON') for index in range(3)]
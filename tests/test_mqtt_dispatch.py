@@ -0,0 +1,60 @@
+import threading
+
+from mqtt_dispatch import CommandDispatcher, TopicRouter
+
+
+def test_router_matches_wildcards():
+    router = TopicRouter()
+    routed = []
+    router.add('phidget/+/output/+/command', lambda sn, index, payload: routed.append(('command', sn, index, payload)))
+    router.add('phidget/+/status', lambda sn, payload: routed.append(('status', sn, payload)))
+    assert router.route('phidget/1234/output/3/command', b'ON')
+    assert router.route('phidget/1234/status', b'online')
+    assert routed == [('command', '1234', '3', b'ON'), ('status', '1234', b'online')]
+
+
+def test_router_no_match():
+    router = TopicRouter()
+    router.add('phidget/+/output/+/command', lambda *args: None)
+    assert not router.route('phidget/1234/input/3/command', b'ON')
+    assert not router.route('phidget/1234/output/3', b'ON')
+    assert not router.route('phidget/1234/output/3/command/extra', b'ON')
+    assert not router.route('other/1234/output/3/command', b'ON')
+
+
+def test_router_first_match():
+    router = TopicRouter()
+    routed = []
+    router.add('a/+/c', lambda b: routed.append(('wildcard', b)))
+    router.add('a/b/c', lambda: routed.append('literal'))
+    router.route('a/b/c')
+    assert routed == [('wildcard', 'b')]
+
+
+def test_same_sn_in_order():
+    dispatcher = CommandDispatcher(workers=4)
+    done = {'1234': [], '5678': []}
+    for index in range(50):
+        for sn in done:
+            assert dispatcher.dispatch(sn, done[sn].append, index)
+    dispatcher.close()
+    assert done == {'1234': list(range(50)), '5678': list(range(50))}
+
+
+def test_drops_when_full():
+    dispatcher = CommandDispatcher(workers=1, max_queued=2)
+    release = threading.Event()
+    started = threading.Event()
+    done = []
+    dispatcher.dispatch('1234', lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    assert dispatcher.dispatch('1234', done.append, 1)
+    assert dispatcher.dispatch('5678', done.append, 2)
+    # Never blocks the network thread
+    assert not dispatcher.dispatch('1234', done.append, 3)
+    release.set()
+    dispatcher.close()
+    assert done == [1, 2]
+    metrics = dispatcher.metrics()
+    assert metrics['dropped'] == 1
+    assert metrics['completed'] == 3
@@ -0,0 +1,43 @@
+from mqtt_offline import OfflineBuffer
+from mqtt_publisher import ACK, STATE
+
+
+def test_keeps_latest_value_in_first_change_order():
+    buffer = OfflineBuffer()
+    buffer.put('a', 1, True, STATE)
+    buffer.put('b', 1, True, STATE)
+    buffer.put('a', 2, True, ACK)
+    assert len(buffer) == 2
+    assert buffer.take(1) == [('a', 2, True, ACK)]
+    assert buffer.take(10) == [('b', 1, True, STATE)]
+    assert buffer.take(10) == []
+    assert buffer.metrics() == {'depth': 0, 'buffered': 3, 'collapsed': 1}
+
+
+def test_discard():
+    buffer = OfflineBuffer()
+    buffer.put('a', 1, True, STATE)
+    buffer.discard('a')
+    buffer.discard('b')
+    assert len(buffer) == 0
+
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / 'offline')
+    buffer = OfflineBuffer(path, flush_interval=0)
+    for topic in 'cab':
+        buffer.put(topic, 1, True, STATE)
+    buffer.put('c', 2, False, ACK)
+    buffer.discard('a')
+    buffer.close()
+
+    # In the order of the first change, though c was written again after b
+    buffer = OfflineBuffer(path, flush_interval=0)
+    assert buffer.take(1) == [('c', 2, False, ACK)]
+    buffer.put('d', 1, True, STATE)
+    buffer.put('b', 2, True, STATE)
+    buffer.close()
+    # Taken messages are deleted, and topics buffered after a restart come after the loaded ones
+    buffer = OfflineBuffer(path, flush_interval=0)
+    assert buffer.take(10) == [('b', 2, True, STATE), ('d', 1, True, STATE)]
+    buffer.close()
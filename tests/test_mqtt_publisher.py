@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from mqtt_publisher import OutboundPublisher, Lane, ACK, STATE, DISCOVERY, DROP_OLDEST, DROP_NEWEST
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def make_publisher(mqtt_client):
+    publishers = []
+
+    def make_publisher(**kwargs):
+        publisher = OutboundPublisher(mqtt_client, **kwargs)
+        mqtt_client.on_publish = publisher.on_publish
+        publishers.append(publisher)
+        return publisher
+
+    yield make_publisher
+    for publisher in publishers:
+        publisher.close()
+
+
+def test_lane_collapses_topic():
+    lane = Lane('state', 10)
+    lane.put('a', 1, True)
+    lane.put('b', 1, True)
+    assert lane.put('a', 2, True) is None
+    # The latest payload, in the place of the first one
+    assert [lane.get() for _ in range(len(lane))] == [('a', 2, True), ('b', 1, True)]
+    assert lane.collapsed == 1
+
+
+def test_lane_without_collapse():
+    lane = Lane('state', 10, collapse=False)
+    lane.put('a', 1, True)
+    lane.put('a', 2, True)
+    assert [lane.get() for _ in range(len(lane))] == [('a', 1, True), ('a', 2, True)]
+
+
+def test_lane_drop_oldest():
+    lane = Lane('state', 2, overflow=DROP_OLDEST)
+    lane.put('a', 1, True)
+    lane.put('b', 1, True)
+    assert lane.put('c', 1, True) == 'a'
+    assert [lane.get()[0] for _ in range(len(lane))] == ['b', 'c']
+    assert lane.dropped == 1
+
+
+def test_lane_drop_newest():
+    lane = Lane('discovery', 2, overflow=DROP_NEWEST)
+    lane.put('a', 1, True)
+    lane.put('b', 1, True)
+    assert lane.put('c', 1, True) == 'c'
+    # A queued topic is still collapsed
+    assert lane.put('a', 2, True) is None
+    assert [lane.get() for _ in range(len(lane))] == [('a', 2, True), ('b', 1, True)]
+
+
+def test_lane_priority(make_publisher, mqtt_client):
+    publisher = make_publisher()
+    # Queued while disconnected
+    publisher.enqueue(DISCOVERY, 'discovery', 'd')
+    publisher.enqueue(STATE, 'state', 's')
+    publisher.enqueue(ACK, 'ack', 'a', retain=False)
+    publisher.set_connected(True)
+    assert wait_for(lambda: len(mqtt_client.published) == 3)
+    assert mqtt_client.published == [('ack', 'a', False), ('state', 's', True), ('discovery', 'd', True)]
+    assert publisher.metrics()['published'] == 3
+
+
+def test_inflight_cap(make_publisher, mqtt_client):
+    publisher = make_publisher(max_inflight=2)
+    assert mqtt_client.max_inflight == 2
+    mqtt_client.hold_acks = True
+    for index in range(5):
+        publisher.enqueue(STATE, 'state/%i' % index, index)
+    publisher.set_connected(True)
+    assert wait_for(lambda: len(mqtt_client.published) == 2)
+    time.sleep(0.05)
+    assert len(mqtt_client.published) == 2
+    assert publisher.metrics()['inflight'] == 2
+    # Sent: the next one goes
+    publisher.on_publish(mqtt_client, None, 1)
+    assert wait_for(lambda: len(mqtt_client.published) == 3)
+    # A reconnect loses the messages in flight
+    publisher.set_connected(False)
+    publisher.set_connected(True)
+    assert wait_for(lambda: len(mqtt_client.published) == 5)
+    assert [message[1] for message in mqtt_client.published] == list(range(5))
+
+
+def test_drops_reported(make_publisher, mqtt_client):
+    dropped = []
+    publisher = make_publisher(max_queued=2, on_drop=dropped.append)
+    for topic in ('a', 'b', 'c'):
+        publisher.enqueue(STATE, topic, 1)
+        publisher.enqueue(DISCOVERY, 'config/' + topic, 1)
+    assert dropped == ['a', 'config/c']
+    lanes = publisher.metrics()['lanes']
+    assert lanes['state'] == {'depth': 2, 'collapsed': 0, 'dropped': 1}
+    assert lanes['discovery'] == {'depth': 2, 'collapsed': 0, 'dropped': 1}
+
+
+def test_failed_publish_reported(make_publisher, mqtt_client):
+    dropped = []
+    publisher = make_publisher(on_drop=dropped.append)
+    mqtt_client.rc = 4              # MQTT_ERR_NO_CONN
+    publisher.set_connected(True)
+    publisher.enqueue(STATE, 'a', 1)
+    assert wait_for(lambda: dropped == ['a'])
+    metrics = publisher.metrics()
+    assert metrics['failed'] == 1
+    assert metrics['inflight'] == 0
@@ -0,0 +1,328 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('Phidget22')
+
+from Phidget22.ErrorCode import ErrorCode
+
+import phidget_io
+from phidget_io import PhidgetsManager
+
+SN = 1234
+
+
+class FakeManager:
+    """Phidget22 Manager that never reports devices"""
+
+    def setOnAttachHandler(self, handler):
+        self.attach_handler = handler
+
+    def setOnDetachHandler(self, handler):
+        self.detach_handler = handler
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeOutput:
+    """DigitalOutput whose setState_async writes complete when the test says so"""
+    type = PhidgetsManager.OUTPUT
+
+    def __init__(self, sn=SN, index=0, state=False):
+        self.sn = sn
+        self.index = index
+        self.state = state
+        self.pending = []           # [(state, callback)] of the async writes not completed yet
+        self.writes = []            # States written, sync or async
+        self.closed = False
+
+    def getDeviceSerialNumber(self):
+        return self.sn
+
+    def getChannel(self):
+        return self.index
+
+    def getState(self):
+        return self.state
+
+    def setState(self, state):
+        self.writes.append(bool(state))
+        self.state = bool(state)
+
+    def setState_async(self, state, callback):
+        self.writes.append(bool(state))
+        self.pending.append((bool(state), callback))
+
+    def close(self):
+        self.closed = True
+
+    def complete(self, res=ErrorCode.EPHIDGET_OK):
+        state, callback = self.pending.pop(0)
+        if res == ErrorCode.EPHIDGET_OK:
+            self.state = state
+        callback(self, res, 'failed' if res != ErrorCode.EPHIDGET_OK else '')
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)     # The states db
+    monkeypatch.setattr(phidget_io, 'Manager', FakeManager)
+    notified = []
+    manager = PhidgetsManager(output_changed_external_handler=lambda sn, index, state: notified.append((index, state)),
+                              outputs_changed_external_handler=lambda sn, states: notified.append(states),
+                              states_backend='journal', states_flush_interval=0, async_outputs=True)
+    manager.notified = notified
+    yield manager
+    manager.close()
+
+
+def add_output(manager, index=0, state=False):
+    ch = FakeOutput(index=index, state=state)
+    manager.channels.add(PhidgetsManager.OUTPUT, SN, index, ch)
+    return ch
+
+
+def test_async_write(manager):
+    ch = add_output(manager)
+    assert manager.set_output_state(ch, True)
+    assert ch.writes == [True]
+    assert manager.notified == []       # Notified on completion
+    ch.complete()
+    assert manager.notified == [(0, True)]
+    assert manager.output_states.get_state(SN, 0) is True
+    assert manager.inflight == {}
+    assert not manager.set_output_state(ch, True)     # Already in that state
+    assert ch.writes == [True]
+
+
+def test_collapses_writes_in_flight(manager):
+    ch = add_output(manager)
+    manager.set_output_state(ch, True)
+    for state in (False, True, False):
+        manager.set_output_state(ch, state)
+    # Only the latest state is written, once the write in flight completes
+    assert ch.writes == [True]
+    ch.complete()
+    assert ch.writes == [True, False]
+    ch.complete()
+    assert ch.pending == []
+    assert manager.notified == [(0, True), (0, False)]
+    assert manager.collapsed_writes == 3
+    assert manager.async_writes == 2
+    assert manager.inflight == {}
+
+
+def test_collapsed_to_state_in_flight(manager):
+    ch = add_output(manager)
+    manager.set_output_state(ch, True)
+    manager.set_output_state(ch, False)
+    manager.set_output_state(ch, True)
+    ch.complete()
+    # The latest state is the one just written: no extra write
+    assert ch.writes == [True]
+    assert ch.pending == []
+    assert manager.inflight == {}
+
+
+def test_failed_write_clears_in_flight(manager):
+    ch = add_output(manager)
+    manager.set_output_state(ch, True)
+    ch.complete(ErrorCode.EPHIDGET_TIMEOUT)
+    assert manager.failed_writes == 1
+    assert manager.inflight == {}
+    assert manager.notified == []
+    assert not manager.write_in_flight(ch)
+    # The next command is written again
+    manager.set_output_state(ch, True)
+    assert ch.writes == [True, True]
+
+
+def test_set_output_states_with_write_in_flight(manager):
+    ch0 = add_output(manager, 0)
+    ch1 = add_output(manager, 1)
+    manager.set_output_state(ch0, True)
+    assert manager.set_output_states(SN, {0: False, 1: True}) == {1: True}
+    # Output 1 is written at once, output 0 after its write in flight
+    assert ch1.writes == [True]
+    assert ch0.writes == [True]
+    ch0.complete()
+    assert ch0.writes == [True, False]
+    ch0.complete()
+    assert manager.notified == [{1: True}, (0, True), (0, False)]
+
+
+class FakeReadonlyChannel:
+    """Channel reported by the Manager attach event"""
+
+    def __init__(self, index, channel_class='digital_input', sn=SN):
+        self.sn = sn
+        self.index = index
+        self.channel_class = channel_class
+
+    def getDeviceSerialNumber(self):
+        return self.sn
+
+    def getChannel(self):
+        return self.index
+
+    def getChannelClass(self):
+        return self.channel_class
+
+
+class FakeInput:
+    """DigitalInput created by the manager. opener(ch) plays openWaitForAttachment, attaching by default"""
+    opener = None
+
+    def __init__(self):
+        self.closed = False
+
+    def setOnAttachHandler(self, handler):
+        self.attach_handler = handler
+
+    def setOnDetachHandler(self, handler):
+        self.detach_handler = handler
+
+    def setOnErrorHandler(self, handler):
+        pass
+
+    def setOnStateChangeHandler(self, handler):
+        pass
+
+    def setDeviceSerialNumber(self, sn):
+        self.sn = sn
+
+    def setChannel(self, index):
+        self.index = index
+
+    def getDeviceSerialNumber(self):
+        return self.sn
+
+    def getChannel(self):
+        return self.index
+
+    def openWaitForAttachment(self, timeout):
+        if FakeInput.opener:
+            FakeInput.opener(self)
+        else:
+            self.attach_handler(self)
+
+    def close(self):
+        self.closed = True
+
+
+def attach_timeout_error():
+    # PhidgetException() needs the Phidget22 library
+    e = phidget_io.PhidgetException.__new__(phidget_io.PhidgetException)
+    e.code = ErrorCode.EPHIDGET_TIMEOUT
+    e.details = 'Timed out'
+    return e
+
+
+@pytest.fixture
+def inputs(monkeypatch):
+    """Makes the manager create FakeInput channels, and records them"""
+    created = []
+
+    def constructor():
+        created.append(FakeInput())
+        return created[-1]
+
+    monkeypatch.setattr(phidget_io, 'CHANNEL_CLASSES', {})
+    phidget_io.register_channel_class('digital_input', constructor, PhidgetsManager.INPUT, PhidgetsManager.setup_input)
+    return created
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_attach_burst(manager, inputs):
+    attached = []
+    manager.channel_attached_handler = lambda sn, index, channel_type: attached.append(index)
+    for index in range(3):
+        manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(index))
+    manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(0, 'unsupported'))
+    assert wait_for(lambda: len(attached) == 3 and not manager.attach_bursts)
+    assert len(inputs) == 3
+    assert sorted(attached) == [0, 1, 2]
+    assert sorted(manager.get_device_channels(SN)) == [(PhidgetsManager.INPUT, index) for index in range(3)]
+    assert 0 <= manager.attach_times[SN] < 5
+
+
+def test_attach_ordered_per_channel(manager, inputs):
+    # A channel that attaches again waits for its previous open, other channels don't
+    other = next(index for index in range(1, 100)
+                 if hash((SN, index)) % len(manager.attach_pool.queues) != hash((SN, 0)) % len(manager.attach_pool.queues))
+    release = threading.Event()
+    opened = []
+
+    def opener(ch):
+        if not opened and ch.index == 0:
+            opened.append('first')
+            release.wait(5)
+        else:
+            opened.append(ch.index)
+        ch.attach_handler(ch)
+
+    FakeInput.opener = opener
+    try:
+        manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(0))
+        assert wait_for(lambda: opened == ['first'])
+        manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(0))
+        manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(other))
+        assert wait_for(lambda: other in opened)
+        assert 0 not in opened
+        release.set()
+        assert wait_for(lambda: SN in manager.attach_times)
+        assert opened == ['first', other, 0]
+    finally:
+        FakeInput.opener = None
+        release.set()
+
+
+def test_close_closes_channels_not_attached(manager, inputs):
+    release = threading.Event()
+
+    def opener(ch):
+        if ch.index == 0:
+            raise attach_timeout_error()
+        if ch.index == 1:
+            release.wait(5)
+        ch.attach_handler(ch)
+
+    manager.attach_pool.close()
+    manager.attach_pool = phidget_io.KeyedWorkerPool(1, name='PhidgetAttach')
+    FakeInput.opener = opener
+    try:
+        for index in range(4):
+            manager.on_manager_attach_handler(manager.manager22, FakeReadonlyChannel(index))
+        # 0 timed out, 1 is opening, 2 and 3 are waiting to be opened
+        assert wait_for(lambda: manager.attach_pool.completed == 1)
+        threading.Timer(0.1, release.set).start()
+        manager.close()
+    finally:
+        FakeInput.opener = None
+        release.set()
+    assert [ch.closed for ch in inputs] == [True] * 4
+
+
+def test_set_default_output_states(manager):
+    ch = add_output(manager, 1)
+    manager.set_default_output_states(str(SN), '*10')
+    assert manager.default_output_state[SN] == {0: '*', 1: True, 2: False}
+    assert ch.writes == [True]
+    assert manager.get_initial_output_state(SN, 2) is False
+
+
+def test_set_default_output_states_invalid_sn(manager):
+    manager.set_default_output_states('abc', '10')
+    assert dict(manager.default_output_state.items()) == {}
+    assert manager.states_writer.metrics()['dirty'] == 0
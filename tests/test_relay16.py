@@ -0,0 +1,162 @@
+import errno
+
+import pytest
+
+pytest.importorskip('usb.core')
+
+import usb.core
+import usb.util
+
+from relay16 import (SainSmartHid, STATUS_FRAME, MODBUS_ADDRESS, MODBUS_READ_COILS, lrc, encode_frame, parse_status,
+                     coil_frame, mask_frame, is_usb_timeout)
+
+COMMAND = {name: bytes(frame) for name, frame in SainSmartHid.command.items()}
+
+
+def test_lrc():
+    assert lrc(bytes((MODBUS_ADDRESS, 0x05, 0x00, 0x00, 0xFF, 0x00))) == 0xFE
+    assert lrc(b'') == 0
+    assert (sum(b'\x12\x34\xFE') + lrc(b'\x12\x34\xFE')) & 0xFF == 0
+
+
+def test_encode_frame():
+    assert encode_frame(0x05, 0x00, 0x00, 0xFF, 0x00) == b':FE050000FF00FE\r\n'
+
+
+def test_status_frame():
+    assert STATUS_FRAME == COMMAND['Status']
+
+
+@pytest.mark.parametrize('index', range(1, 17))
+def test_coil_frames(index):
+    assert coil_frame(index, True) == COMMAND['%i ON' % index]
+    assert coil_frame(index, False) == COMMAND['%i OFF' % index]
+
+
+def test_corrected_lrcs():
+    # The table had wrong LRCs for these frames
+    assert COMMAND['15 OFF'] == b':FE05000E0000EF\r\n'
+    assert COMMAND['16 ON'] == b':FE05000FFF00EF\r\n'
+    assert COMMAND['16 OFF'] == b':FE05000F0000EE\r\n'
+
+
+def test_mask_frames():
+    assert mask_frame(0xFFFF) == COMMAND['ALL ON']
+    assert mask_frame(0) == COMMAND['ALL OFF']
+    assert mask_frame(0x8001) == encode_frame(0x0F, 0, 0, 0, 16, 2, 0x01, 0x80)
+
+
+def test_invalid_relay():
+    with pytest.raises(ValueError):
+        coil_frame(0, True)
+    with pytest.raises(ValueError):
+        coil_frame(17, True)
+
+
+def test_parse_status():
+    assert parse_status(encode_frame(MODBUS_READ_COILS, 2, 0x05, 0x80)) == 0x8005
+    assert parse_status(b'\x00\x00' + encode_frame(MODBUS_READ_COILS, 2, 0xFF, 0xFF)) == 0xFFFF
+    frame = encode_frame(MODBUS_READ_COILS, 2, 0x05, 0x80)
+    assert parse_status(frame[:-4] + b'00\r\n') is None      # Bad LRC
+    assert parse_status(encode_frame(MODBUS_READ_COILS, 3, 0x05, 0x80)) is None     # Bad byte count
+    assert parse_status(b':ZZ\r\n') is None
+
+
+def test_usb_timeout():
+    # As raised by the libusb1 backend of pyusb 1.0: strerror, libusb error code, errno
+    assert is_usb_timeout(usb.core.USBError('Operation timed out', -7, errno.ETIMEDOUT))
+    assert is_usb_timeout(usb.core.USBError('Operation timed out', -7))
+    assert not is_usb_timeout(usb.core.USBError('Pipe error', -9, errno.EPIPE))
+
+
+class FakeBoard:
+    """SainSmart board behind fake USB endpoints: applies the coil/mask frames and answers the status frame"""
+
+    def __init__(self, bits=0):
+        self.bits = bits
+        self.frames = []            # Frames written, status reads excluded
+        self.responses = b''
+        self.fail_writes = 0        # Next writes to fail, as when the board is unplugged
+
+    def write(self, frame):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise usb.core.USBError('No such device', -4, errno.ENODEV)
+        data = bytes.fromhex(bytes(frame)[1:-2].decode())
+        if data[1] == MODBUS_READ_COILS:
+            self.responses += encode_frame(MODBUS_READ_COILS, 2, self.bits & 0xFF, self.bits >> 8)
+            return len(frame)
+        self.frames.append(bytes(frame))
+        if data[1] == 0x05:
+            bit = 1 << data[3]
+            self.bits = self.bits | bit if data[4] == 0xFF else self.bits & ~bit
+        elif data[1] == 0x0F:
+            self.bits = data[7] | data[8] << 8
+        return len(frame)
+
+    def read(self, size, timeout):
+        if not self.responses:
+            raise usb.core.USBError('Operation timed out', -7, errno.ETIMEDOUT)
+        data, self.responses = self.responses[:size], self.responses[size:]
+        return data
+
+
+class FakeEndpoint:
+    wMaxPacketSize = 32
+
+    def __init__(self, address, board):
+        self.bEndpointAddress = address
+        self.write = board.write
+        self.read = board.read
+
+
+class FakeDevice:
+    def __init__(self, board):
+        self.interface = [FakeEndpoint(0x02, board), FakeEndpoint(0x82, board)]
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def get_active_configuration(self):
+        return {(0, 0): self.interface}
+
+
+@pytest.fixture
+def board(monkeypatch):
+    board = FakeBoard()
+    monkeypatch.setattr(usb.core, 'find', lambda **kwargs: FakeDevice(board))
+    monkeypatch.setattr(usb.util, 'dispose_resources', lambda device: None)
+    return board
+
+
+def test_reads_shadow_on_connect(board):
+    board.bits = 0b101
+    hid = SainSmartHid()
+    assert hid.get_states() == {index: index in (1, 3) for index in range(1, 17)}
+    hid.set_output_state(hid.sn, 1, True)
+    assert board.frames == []       # Already on
+
+
+def test_reconnect_reads_shadow_again(board):
+    board.bits = 0b1
+    hid = SainSmartHid()
+    # Power cycle: the relays come back off, and the next write fails until reconnected
+    board.bits = 0
+    board.fail_writes = 1
+    hid.set_output_state(hid.sn, 2, True)
+    assert board.bits == 0b10
+    hid.set_output_state(hid.sn, 1, True)
+    assert board.frames[-1] == coil_frame(1, True)
+    assert board.bits == 0b11
+
+
+def test_reconnect_during_mask_write(board):
+    board.bits = 0b1
+    hid = SainSmartHid()
+    board.bits = 0
+    board.fail_writes = 1
+    assert hid.set_output_states(hid.sn, {index: index in (2, 3) for index in range(2, 17)}) == {2: True, 3: True}
+    assert board.frames[-1] == mask_frame(0b111)
+    # The mask frame also wrote relay 1 as last known: the shadow register follows the board
+    assert board.bits == 0b111
+    assert hid.get_states()[1] is True
@@ -0,0 +1,111 @@
+import os
+
+from spool import SegmentSpool
+
+RECORD_SIZE = SegmentSpool.HEADER.size + 10
+
+
+def record(i):
+    return b'record%04i' % i
+
+
+def read_all(spool):
+    records = []
+    while True:
+        data = spool.peek()
+        if data is None:
+            return records
+        records.append(data)
+        spool.pop()
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SegmentSpool.SUFFIX))
+
+
+def test_fifo_across_restart(tmp_path):
+    spool = SegmentSpool(str(tmp_path))
+    for i in range(5):
+        spool.append(record(i))
+    assert spool.peek() == record(0)
+    assert spool.peek() == record(0)
+    spool.pop()
+    spool.close()
+
+    spool = SegmentSpool(str(tmp_path))
+    assert len(spool) == 4
+    assert read_all(spool) == [record(i) for i in range(1, 5)]
+
+
+def test_crash_reads_again(tmp_path):
+    spool = SegmentSpool(str(tmp_path))
+    for i in range(5):
+        spool.append(record(i))
+    spool.peek()
+    spool.pop()
+
+    # Not closed: the read position is lost, the partly read segment is read again
+    spool = SegmentSpool(str(tmp_path))
+    assert len(spool) == 5
+    assert read_all(spool) == [record(i) for i in range(5)]
+
+
+def test_rotation(tmp_path):
+    spool = SegmentSpool(str(tmp_path), segment_size=3 * RECORD_SIZE)
+    for i in range(10):
+        spool.append(record(i))
+    assert segment_files(str(tmp_path)) == ['00000001.seg', '00000002.seg', '00000003.seg', '00000004.seg']
+    assert spool.metrics()['segments'] == 4
+
+    for i in range(4):
+        assert spool.peek() == record(i)
+        spool.pop()
+    # The first segment was fully read
+    assert segment_files(str(tmp_path))[0] == '00000002.seg'
+
+    spool.append(record(10))
+    assert read_all(spool) == [record(i) for i in range(4, 11)]
+    # Fully read: nothing left to read again after a restart
+    assert segment_files(str(tmp_path)) == []
+    spool.close()
+    assert len(SegmentSpool(str(tmp_path))) == 0
+
+
+def test_max_bytes(tmp_path):
+    spool = SegmentSpool(str(tmp_path), segment_size=2 * RECORD_SIZE, max_bytes=6 * RECORD_SIZE)
+    for i in range(10):
+        spool.append(record(i))
+    metrics = spool.metrics()
+    assert metrics['bytes'] <= 6 * RECORD_SIZE
+    assert metrics['appended'] == 10
+    assert metrics['dropped'] == 4
+    assert len(spool) == 6
+    # The oldest records were dropped
+    assert read_all(spool) == [record(i) for i in range(4, 10)]
+
+
+def test_max_bytes_while_reading(tmp_path):
+    spool = SegmentSpool(str(tmp_path), segment_size=2 * RECORD_SIZE, max_bytes=4 * RECORD_SIZE)
+    for i in range(4):
+        spool.append(record(i))
+    assert spool.peek() == record(0)
+    for i in range(4, 6):
+        spool.append(record(i))
+    # The segment being read was dropped, with its peeked record
+    assert spool.metrics()['dropped'] == 2
+    assert read_all(spool) == [record(i) for i in range(2, 6)]
+
+
+def test_torn_record(tmp_path):
+    spool = SegmentSpool(str(tmp_path))
+    for i in range(3):
+        spool.append(record(i))
+    spool.close()
+    path = os.path.join(str(tmp_path), segment_files(str(tmp_path))[-1])
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 2)    # Power cut while writing the last record
+
+    spool = SegmentSpool(str(tmp_path))
+    assert len(spool) == 2
+    spool.append(record(3))
+    assert read_all(spool) == [record(0), record(1), record(3)]
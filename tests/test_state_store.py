@@ -0,0 +1,166 @@
+import shelve
+import threading
+
+from channel_states import ChannelStates
+from state_store import WriteBehind, JournalStateStore, STATES, DEFAULTS
+
+
+class FlushRecorder:
+    """WriteBehind flush callback recording the dirty key sets, optionally failing"""
+
+    def __init__(self, fail=0):
+        self.flushed = []
+        self.fail = fail            # Next flushes to fail
+        self.called = threading.Event()
+
+    def __call__(self, dirty):
+        self.called.set()
+        if self.fail:
+            self.fail -= 1
+            raise OSError('disk full')
+        self.flushed.append(dirty)
+
+
+def test_write_behind_synchronous():
+    recorder = FlushRecorder()
+    write_behind = WriteBehind(recorder, interval=0)
+    write_behind.mark_dirty('a')
+    write_behind.mark_dirty('b', 'c')
+    assert recorder.flushed == [{'a'}, {'b', 'c'}]
+
+
+def test_write_behind_coalesces():
+    recorder = FlushRecorder()
+    write_behind = WriteBehind(recorder, interval=60, threshold=100)
+    for i in range(10):
+        write_behind.mark_dirty('a', i % 3)
+    assert recorder.flushed == []
+    assert write_behind.metrics() == {'changes': 10, 'flushes': 0, 'dirty': 4}
+    # close() writes the pending changes
+    write_behind.close()
+    assert recorder.flushed == [{'a', 0, 1, 2}]
+    assert write_behind.flushes == 1
+
+
+def test_write_behind_threshold():
+    recorder = FlushRecorder()
+    write_behind = WriteBehind(recorder, interval=60, threshold=3)
+    write_behind.mark_dirty('a')
+    write_behind.mark_dirty('a')
+    assert not recorder.called.wait(0.1)
+    write_behind.mark_dirty('b')
+    assert recorder.called.wait(5)
+    write_behind.close()
+    assert recorder.flushed == [{'a', 'b'}]
+
+
+def test_write_behind_retries_failed_flush():
+    recorder = FlushRecorder(fail=1)
+    write_behind = WriteBehind(recorder, interval=0)
+    write_behind.mark_dirty('a')
+    assert recorder.flushed == []
+    assert write_behind.metrics()['dirty'] == 1
+    write_behind.mark_dirty('b')
+    assert recorder.flushed == [{'a', 'b'}]
+
+
+def test_write_behind_after_close():
+    recorder = FlushRecorder()
+    write_behind = WriteBehind(recorder, interval=60)
+    write_behind.close()
+    # e.g. a late output callback while the manager closes
+    write_behind.mark_dirty('a')
+    assert recorder.flushed == [{'a'}]
+
+
+def open_store(tmp_path, **kwargs):
+    store = JournalStateStore(str(tmp_path / 'states'), fsync=False, **kwargs)
+    return store, store.load()
+
+
+def set_state(store, states, sn, index, state, key=STATES):
+    states[key].set_state(sn, index, state)
+    store.write(store.snapshot(states, [(key, sn, index)]))
+
+
+def test_replays_journal(tmp_path):
+    store, states = open_store(tmp_path)
+    set_state(store, states, 1234, 0, True)
+    set_state(store, states, 1234, 1, '*', DEFAULTS)
+    set_state(store, states, 1234, 0, False)
+    store.close()
+
+    store, states = open_store(tmp_path)
+    assert dict(states[STATES].items()) == {1234: {0: False}}
+    assert dict(states[DEFAULTS].items()) == {1234: {1: '*'}}
+
+
+def test_discards_torn_tail(tmp_path):
+    store, states = open_store(tmp_path)
+    set_state(store, states, 1234, 0, True)
+    set_state(store, states, 1234, 1, True)
+    store.close()
+    with open(store.journal_path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 3)    # Power cut while writing the last record
+
+    store, states = open_store(tmp_path)
+    assert dict(states[STATES].items()) == {1234: {0: True}}
+
+
+def test_discards_crc_bad_tail(tmp_path):
+    store, states = open_store(tmp_path)
+    set_state(store, states, 1234, 0, True)
+    set_state(store, states, 1234, 1, True)
+    store.close()
+    with open(store.journal_path, 'r+b') as f:
+        f.seek(-1, 2)
+        crc = f.read(1)[0]
+        f.seek(-1, 2)
+        f.write(bytes((crc ^ 0xFF,)))   # Corrupt the CRC of the last record
+
+    store, states = open_store(tmp_path)
+    assert dict(states[STATES].items()) == {1234: {0: True}}
+
+
+def test_ignores_journal_of_other_generation(tmp_path):
+    store, states = open_store(tmp_path)
+    set_state(store, states, 1234, 0, True)
+    store.close()
+    # A crash between the new snapshot and the new journal leaves the journal of the previous generation
+    with open(store.journal_path, 'r+b') as f:
+        f.write(JournalStateStore.HEADER.pack(JournalStateStore.JOURNAL_MAGIC, store.generation - 1))
+
+    store, states = open_store(tmp_path)
+    assert dict(states[STATES].items()) == {}
+
+
+def test_compacts_into_snapshot(tmp_path):
+    store, states = open_store(tmp_path, compact_records=4)
+    generation = store.generation
+    for index in range(10):
+        set_state(store, states, 1234, index, index % 2 == 0)
+    assert store.generation > generation
+    assert store.records <= 4
+    store.close()
+
+    store, states = open_store(tmp_path)
+    assert states[STATES][1234] == {index: index % 2 == 0 for index in range(10)}
+
+
+def test_migrates_shelve(tmp_path):
+    shelve_path = str(tmp_path / 'shelve')
+    with shelve.open(shelve_path) as db:
+        db[STATES] = ChannelStates({1234: {0: True, 3: False}})
+        db[DEFAULTS] = ChannelStates({5678: {2: '*'}})
+
+    store, states = open_store(tmp_path, migrate_from=shelve_path)
+    assert dict(states[STATES].items()) == {1234: {0: True, 3: False}}
+    assert dict(states[DEFAULTS].items()) == {5678: {2: '*'}}
+    set_state(store, states, 1234, 0, False)
+    store.close()
+
+    # Migrated once: the store now loads its own files
+    with shelve.open(shelve_path) as db:
+        db[STATES] = ChannelStates({1234: {0: True}})
+    store, states = open_store(tmp_path, migrate_from=shelve_path)
+    assert dict(states[STATES].items()) == {1234: {0: False, 3: False}}
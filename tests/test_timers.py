@@ -0,0 +1,50 @@
+import threading
+
+from timers import TimerService
+
+
+def test_runs_in_deadline_order():
+    timers = TimerService()
+    called = []
+    done = threading.Event()
+    timers.call_later(0.2, done.set)
+    timers.call_later(0.1, called.append, 'b')
+    timers.call_later(0.05, called.append, 'a')
+    # Same deadline: call order
+    timers.call_later(0.15, called.append, 'c')
+    timers.call_later(0.15, called.append, 'd')
+    assert done.wait(5)
+    timers.close()
+    assert called == ['a', 'b', 'c', 'd']
+
+
+def test_cancel():
+    timers = TimerService()
+    called = []
+    done = threading.Event()
+    timer = timers.call_later(0.05, called.append, 'cancelled')
+    timers.call_later(0.1, done.set)
+    timers.cancel(timer)
+    assert timers.pending() == 1
+    assert done.wait(5)
+    timers.close()
+    assert called == []
+
+
+def test_failed_callback_does_not_stop_timers():
+    timers = TimerService()
+    done = threading.Event()
+    timers.call_later(0, lambda: 1 / 0)
+    timers.call_later(0.01, done.set)
+    assert done.wait(5)
+    timers.close()
+
+
+def test_drain():
+    timers = TimerService()
+    timers.call_later(60, print, 2)
+    timers.cancel(timers.call_later(30, print, 'cancelled'))
+    timers.call_later(10, print, 1)
+    timers.close()
+    assert timers.drain() == [(print, (1,)), (print, (2,))]
+    assert timers.pending() == 0
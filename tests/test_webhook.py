@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('requests')
+
+from webhook import WebhookSink
+
+
+class FakeHttp:
+    def __init__(self, accept=True):
+        self.requests = []
+        self.accept = accept
+
+    def request(self, method, url, json, token, request_id=None):
+        self.requests.append((method, url, json, token))
+        return self.accept
+
+
+def test_posts_to_every_url():
+    http = FakeHttp()
+    sink = WebhookSink({'http://a/api/': 'ta', 'http://b/api/': 'tb'}, http)
+    sink.input_changed(1234, 3, 1, timestamp=1000.5)
+    assert http.requests == [
+        ('POST', 'http://a/api/', {'type': 'input', 'sn': 1234, 'index': 3, 'state': True, 'timestamp': 1000.5}, 'ta'),
+        ('POST', 'http://b/api/', {'type': 'input', 'sn': 1234, 'index': 3, 'state': True, 'timestamp': 1000.5}, 'tb'),
+    ]
+
+
+def test_event_timestamp():
+    http = FakeHttp()
+    sink = WebhookSink({'http://a/api/': 'ta'}, http)
+    sink.output_changed(1234, 0, False, timestamp=1000.5)
+    sink.channel_attached(1234, 0, 'Output', timestamp=1001.0)
+    sink.output_changed(1234, 0, True)
+    assert [request[2]['timestamp'] for request in http.requests[:2]] == [1000.5, 1001.0]
+    assert http.requests[2][2]['timestamp'] > 1001.0     # Default: now
+
+
+def test_dropped():
+    sink = WebhookSink({'http://a/api/': 'ta'}, FakeHttp(accept=False))
+    sink.input_changed(1234, 0, True)
+    assert sink.events == 1
+    assert sink.dropped == 1
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from workers import KeyedWorkerPool
+
+
+def keys_on_different_workers(pool):
+    worker = hash('a') % len(pool.queues)
+    return 'a', next(key for key in 'bcdefghijk' if hash(key) % len(pool.queues) != worker)
+
+
+def test_same_key_in_order():
+    pool = KeyedWorkerPool(4)
+    done = {'a': [], 'b': []}
+    for i in range(100):
+        for key in done:
+            pool.submit(key, done[key].append, i)
+    pool.close()
+    assert done == {'a': list(range(100)), 'b': list(range(100))}
+
+
+def test_other_keys_run_concurrently():
+    pool = KeyedWorkerPool(2)
+    a, b = keys_on_different_workers(pool)
+    release = threading.Event()
+    started = threading.Event()
+    done = []
+
+    def blocked():
+        started.set()
+        release.wait(5)
+        done.append(a)
+
+    pool.submit(a, blocked)
+    assert started.wait(5)
+    pool.submit(a, done.append, 'after ' + a)
+    pool.submit(b, done.append, b)
+    deadline = time.monotonic() + 5
+    while b not in done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert done == [b]
+    release.set()
+    pool.close()
+    assert done == [b, a, 'after ' + a]
+
+
+def test_full_and_drain():
+    pool = KeyedWorkerPool(1, max_queued=2)
+    release = threading.Event()
+    started = threading.Event()
+    pool.submit('a', lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    pool.submit('a', print, 1)
+    pool.submit('b', print, 2)
+    with pytest.raises(queue.Full):
+        pool.submit('c', print, 3)
+    assert pool.depth() == 2
+    assert pool.drain() == [(print, (1,)), (print, (2,))]
+    assert pool.depth() == 0
+    release.set()
+    pool.close()
+
+
+def test_metrics():
+    pool = KeyedWorkerPool(2)
+
+    def fail():
+        raise ValueError('task failed')
+
+    pool.submit('a', fail)
+    pool.submit('a', time.sleep, 0.01)
+    pool.close()
+    metrics = pool.metrics()
+    assert metrics['submitted'] == 2
+    assert metrics['completed'] == 2
+    assert metrics['failed'] == 1
+    assert metrics['depth'] == 0
@@ -0,0 +1,76 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerService:
+    """
+    Runs delayed callbacks from a single thread, using a heap of deadlines, instead of a thread (or threading.Timer) per delay.
+    Callbacks run on the timer thread, so they must be quick.
+    """
+
+    def __init__(self, name='Timers'):
+        self.logger = logging.getLogger('%s.%s' % (self.__class__.__name__, name))
+        self.heap = []          # [deadline, sequence, fn, args], a cancelled timer has fn None
+        self.counter = itertools.count()    # Keeps timers with the same deadline in call order
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, fn, *args):
+        """
+        Calls fn(*args) after delay seconds
+        :return: Timer handle, for cancel()
+        """
+        timer = [time.monotonic() + delay, next(self.counter), fn, args]
+        with self.condition:
+            heapq.heappush(self.heap, timer)
+            if self.heap[0] is timer:
+                self.condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        with self.condition:
+            timer[2] = None
+
+    def pending(self):
+        with self.condition:
+            return sum(1 for timer in self.heap if timer[2])
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    if self.heap:
+                        delay = self.heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self.condition.wait(delay)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+                _, _, fn, args = heapq.heappop(self.heap)
+            if fn:
+                try:
+                    fn(*args)
+                except Exception:
+                    self.logger.exception('Timer callback %s failed', getattr(fn, '__name__', fn))
+
+    def drain(self):
+        """
+        Removes the pending timers, e.g. to keep them after close()
+        :return: [(fn, args)] of the timers that were pending, in deadline order
+        """
+        with self.condition:
+            timers, self.heap = sorted(self.heap), []
+        return [(fn, args) for _, _, fn, args in timers if fn]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(5)
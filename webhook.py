@@ -0,0 +1,62 @@
+import logging
+import time
+
+from asynchttp import AsyncHttp
+
+
+class WebhookSink:
+    """
+    Posts the phidget events to the callback urls (settings.CALLBACK_URLS), each with its token. Enabled in the app by
+    WEBHOOK_ENABLED=true.
+    The handlers run on the hardware callback threads and only queue one request per url on AsyncHttp,
+    whose workers do the HTTP. Events are JSON objects: {"type", "sn", "index", "state", "timestamp"}.
+    """
+
+    def __init__(self, urls, http=None):
+        """
+        :param urls: {url: token}
+        :param http: AsyncHttp to send with (default: one with default settings)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.urls = list(urls.items())
+        self.http = http or AsyncHttp()
+        self.started = time.monotonic()
+        self.events = 0
+        self.dropped = 0            # Requests AsyncHttp refused (queue full, circuit open)
+
+    def post(self, event):
+        self.events += 1
+        for url, token in self.urls:
+            if not self.http.request('POST', url, event, token):
+                self.dropped += 1
+
+    def input_changed(self, sn, index, state, timestamp=None):
+        """:param timestamp: time.time() of the event (default: now)"""
+        self.post({'type': 'input', 'sn': sn, 'index': index, 'state': bool(state),
+                   'timestamp': timestamp or time.time()})
+
+    def output_changed(self, sn, index, state, timestamp=None):
+        self.post({'type': 'output', 'sn': sn, 'index': index, 'state': bool(state),
+                   'timestamp': timestamp or time.time()})
+
+    def channel_attached(self, sn, index, channel_type, timestamp=None):
+        self.post({'type': 'attached', 'sn': sn, 'index': index, 'state': channel_type,
+                   'timestamp': timestamp or time.time()})
+
+    def metrics(self):
+        """
+        Throughput (events_per_s since started) and lag (lag_*: seconds requests waited before being sent),
+        with the AsyncHttp metrics
+        """
+        http = self.http.metrics()
+        return {
+            'events': self.events,
+            'dropped': self.dropped,
+            'events_per_s': self.events / max(time.monotonic() - self.started, 1e-9),
+            'lag_avg': http['wait_avg'],
+            'lag_max': http['wait_max'],
+            'http': http,
+        }
+
+    def close(self):
+        self.http.close()
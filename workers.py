@@ -0,0 +1,109 @@
+import logging
+import queue
+import threading
+import time
+
+
+class KeyedWorkerPool:
+    """
+    Fixed pool of worker threads, each with its own bounded queue.
+    Tasks are routed to a worker by the hash of their key: tasks with the same key run one after the other,
+    in submission order, while tasks with different keys run concurrently.
+    """
+    STOP = object()
+
+    def __init__(self, workers=4, max_queued=1000, name='Worker'):
+        """
+        :param workers: Number of worker threads
+        :param max_queued: Max tasks waiting per worker, submit() raises queue.Full beyond it
+        :param name: Prefix of the worker thread names
+        """
+        self.logger = logging.getLogger('%s.%s' % (self.__class__.__name__, name))
+        self.queues = [queue.Queue(max_queued) for _ in range(workers)]
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0       # Seconds tasks waited in the queue
+        self.wait_max = 0.0
+        self.run_total = 0.0        # Seconds tasks ran
+        self._lock = threading.Lock()
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(q,), name='%s-%i' % (name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args, block=False, timeout=None):
+        """
+        Queues fn(*args) on the worker of key
+        :raises queue.Full: If the worker queue is full (and block is False, or timeout expired)
+        """
+        self.queues[hash(key) % len(self.queues)].put((time.monotonic(), fn, args), block, timeout)
+        with self._lock:
+            self.submitted += 1
+
+    def _run(self, q):
+        while True:
+            task = q.get()
+            if task is self.STOP:
+                return
+            queued, fn, args = task
+            started = time.monotonic()
+            try:
+                fn(*args)
+                failed = False
+            except Exception:
+                self.logger.exception('Task %s failed', getattr(fn, '__name__', fn))
+                failed = True
+            ended = time.monotonic()
+            with self._lock:
+                self.completed += 1
+                self.failed += failed
+                wait = started - queued
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.run_total += ended - started
+
+    def depth(self):
+        """Number of tasks waiting in all the queues"""
+        return sum(q.qsize() for q in self.queues)
+
+    def metrics(self):
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'depth': self.depth(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'wait_avg': self.wait_total / completed,
+                'wait_max': self.wait_max,
+                'run_avg': self.run_total / completed,
+            }
+
+    def drain(self):
+        """
+        Removes the tasks still waiting in the queues
+        :return: [(fn, args)]
+        """
+        tasks = []
+        for q in self.queues:
+            while True:
+                try:
+                    task = q.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not self.STOP:
+                    tasks.append(task[1:])
+        return tasks
+
+    def close(self, timeout=5):
+        """Stops the workers once they finish the tasks already queued"""
+        for q in self.queues:
+            try:
+                q.put(self.STOP, timeout=timeout)
+            except queue.Full:
+                self.logger.warning('Queue full, worker not stopped')
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))